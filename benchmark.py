@@ -0,0 +1,374 @@
+# Benchmarks for the build script itself, on generated projects
+# Runs offline: a fake compiler stands in for g++, so no toolchain is needed
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+COMPILE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compile.py")
+
+# Stand-in for g++/clang. Understands just enough of the command line to
+# produce outputs, depfiles and preprocessed text for compile.py.
+FAKE_COMPILER = r'''#!{python}
+import hashlib
+import os
+import re
+import sys
+import time
+
+args = sys.argv[1:]
+if "--version" in args:
+    print("fake-cxx 1.0 (km_compile benchmark)")
+    sys.exit(0)
+
+output = None
+depfile = None
+include_dirs = []
+sources = []
+i = 0
+while i < len(args):
+    arg = args[i]
+    if arg in ("-o", "-MF", "-x", "-include", "-iquote"):
+        value = args[i + 1]
+        if arg == "-o":
+            output = value
+        elif arg == "-MF":
+            depfile = value
+        elif arg == "-iquote":
+            include_dirs.append(value)
+        i += 2
+        continue
+    if arg.startswith("-I"):
+        include_dirs.append(arg[2:])
+    elif not arg.startswith("-"):
+        sources.append(arg)
+    i += 1
+
+def find_includes(path, found):
+    try:
+        with open(path, "r") as f:
+            text = f.read()
+    except OSError:
+        return
+    for name in re.findall(r'#include "([^"]+)"', text):
+        for base in [os.path.dirname(path)] + include_dirs:
+            candidate = os.path.normpath(os.path.join(base, name))
+            if os.path.exists(candidate):
+                if candidate not in found:
+                    found.append(candidate)
+                    find_includes(candidate, found)
+                break
+
+deps = []
+for source in sources:
+    if source.endswith((".cpp", ".cc", ".c", ".h")):
+        deps.append(source)
+        find_includes(source, deps)
+
+if depfile is not None:
+    with open(depfile, "w") as f:
+        f.write("out.o: " + " \\\n ".join(deps) + "\n")
+
+if "-E" in args:
+    for dep in deps:
+        with open(dep, "r") as f:
+            sys.stdout.write(f.read())
+    sys.exit(0)
+
+time.sleep(float(os.environ.get("FAKE_CXX_DELAY", "0")) * max(1, len(deps)) / 10)
+
+digest = hashlib.md5()
+for dep in deps:
+    with open(dep, "rb") as f:
+        digest.update(f.read())
+digest.update(" ".join(args).encode("utf-8"))
+if output is not None:
+    with open(output, "wb") as f:
+        f.write(b"FAKEBIN" + digest.digest() * 64)
+    os.chmod(output, 0o755)
+'''
+
+APP_INFO = '''import sys
+sys.path.insert(0, {compile_dir!r})
+from compile import BuildTarget, CopyDir, TargetType
+
+PROJECT_NAME = "bench"
+PATHS = {{}}
+LIBS_EXTERNAL = []
+TARGETS = [
+{targets}
+]
+COPY_DIRS = [CopyDir("data", "data")]
+DEPLOY_FILES = []
+COMPILER = "g++-9" # the fake one, first on PATH
+
+def post_compile_custom(paths):
+    pass
+'''
+
+COMPILER_NAMES = ["g++-9", "g++", "clang", "clang++"]
+
+def write_data_file(path, size, seed):
+    block = (str(seed).encode("utf-8") + b"-km_compile-benchmark-") * 4096
+    block = block[:1024 * 1024]
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = block[:min(remaining, len(block))]
+            f.write(chunk)
+            remaining -= len(chunk)
+
+def generate_project(root, num_sources, num_targets, data_gb, data_file_mb=16):
+    for dir_name in ["compile", "src", "data", "fakebin"]:
+        os.makedirs(os.path.join(root, dir_name))
+
+    # Fake toolchain, found through PATH
+    for compiler_name in COMPILER_NAMES:
+        compiler_path = os.path.join(root, "fakebin", compiler_name)
+        with open(compiler_path, "w") as f:
+            f.write(FAKE_COMPILER.replace("{python}", sys.executable))
+        os.chmod(compiler_path, 0o755)
+
+    num_headers = max(1, num_sources // 10)
+    for i in range(num_headers):
+        with open(os.path.join(root, "src", "common_{}.h".format(i)), "w") as f:
+            f.write("#pragma once\n")
+            f.write("".join("inline int common_{}_{}() {{ return {}; }}\n".format(i, j, j)
+                for j in range(20)))
+
+    # Sources are dealt across targets, each target is a unity build of its share
+    target_sources = [[] for _ in range(num_targets)]
+    for i in range(num_sources):
+        source_name = "unit_{}.cpp".format(i)
+        with open(os.path.join(root, "src", source_name), "w") as f:
+            f.write("#include \"common_{}.h\"\n".format(i % num_headers))
+            f.write("".join("int unit_{}_{}() {{ return {}; }}\n".format(i, j, j) for j in range(50)))
+        target_sources[i % num_targets].append(source_name)
+
+    targets = []
+    for t in range(num_targets):
+        unity_name = "target_{}.cpp".format(t)
+        with open(os.path.join(root, "src", unity_name), "w") as f:
+            f.write("".join("#include \"{}\"\n".format(s) for s in target_sources[t]))
+            f.write("int main() { return 0; }\n")
+        targets.append("    BuildTarget(\"target_{}\", \"src/{}\", TargetType.EXECUTABLE),".format(
+            t, unity_name))
+
+    with open(os.path.join(root, "compile", "app_info.py"), "w") as f:
+        f.write(APP_INFO.format(compile_dir=os.path.dirname(COMPILE_SCRIPT),
+            targets="\n".join(targets)))
+
+    data_size = int(data_gb * 1024 * 1024 * 1024)
+    file_size = data_file_mb * 1024 * 1024
+    i = 0
+    while data_size > 0:
+        sub_dir = os.path.join(root, "data", "pack_{}".format(i // 64))
+        if not os.path.exists(sub_dir):
+            os.makedirs(sub_dir)
+        size = min(file_size, data_size)
+        write_data_file(os.path.join(sub_dir, "asset_{}.bin".format(i)), size, i)
+        data_size -= size
+        i += 1
+
+def get_env(root, compile_env):
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(root, "fakebin") + os.pathsep + env.get("PATH", "")
+    # Keep the user's compile cache out of the numbers
+    env["KM_COMPILE_CACHE_DIR"] = os.path.join(root, "compile-cache")
+    env.update(compile_env)
+    return env
+
+def time_command(root, args, compile_env={}):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, COMPILE_SCRIPT] + args, cwd=root,
+        env=get_env(root, compile_env), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    duration = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception("compile.py {} failed:\n{}".format(" ".join(args),
+            result.stdout.decode("utf-8", "replace")))
+    return duration
+
+# Times a snippet inside a fresh interpreter that has imported compile.py
+# from the project root, the same way a real build sees it
+IN_PROCESS_TEMPLATE = '''
+import json, os, shutil, sys, time
+sys.argv = ["compile.py"]
+sys.path.insert(0, {compile_dir!r})
+import compile
+compile.fill_paths_and_include_dirs("debug")
+for name in ["build", "build-logs"]:
+    if not os.path.exists(compile.paths[name]):
+        os.makedirs(compile.paths[name])
+{setup}
+start = time.perf_counter()
+{statement}
+print(json.dumps(time.perf_counter() - start))
+'''
+
+def time_in_process(root, setup, statement, compile_env={}):
+    code = IN_PROCESS_TEMPLATE.format(compile_dir=os.path.dirname(COMPILE_SCRIPT),
+        setup=setup, statement=statement)
+    result = subprocess.run([sys.executable, "-c", code], cwd=root,
+        env=get_env(root, compile_env), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = result.stdout.decode("utf-8", "replace").strip()
+    if result.returncode != 0:
+        raise Exception("Benchmark snippet failed:\n" + output)
+    return json.loads(output.splitlines()[-1])
+
+def get_benchmarks(root, num_jobs):
+    build_dir = os.path.join(root, "build")
+    copy_dst = os.path.join(root, "copy-bench")
+
+    def clean_build():
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+
+    def full_build():
+        clean_build()
+        return time_command(root, ["debug", "--no-cache", "--no-size-report", "-j", str(num_jobs)])
+
+    def full_build_serial():
+        clean_build()
+        return time_command(root, ["debug", "--no-cache", "--no-size-report", "-j", "1"])
+
+    def noop_ifchanged():
+        return time_command(root, ["debug", "--ifchanged", "--no-size-report", "-j", str(num_jobs)])
+
+    remove_manifest = "if os.path.exists(compile.paths['src-manifest']): os.remove(compile.paths['src-manifest'])"
+    return [
+        ("startup", lambda: time_command(root, ["--help"])),
+        ("compute_src_hashes (cold)", lambda: time_in_process(root, remove_manifest,
+            "compile.compute_src_hashes()")),
+        ("compute_src_hashes (warm)", lambda: time_in_process(root, "compile.compute_src_hashes()",
+            "compile.compute_src_hashes()")),
+        ("did_files_change", lambda: time_in_process(root, "compile.compute_src_hashes()",
+            "compile.did_files_change()")),
+        ("remake_dest_and_copy_dir", lambda: time_in_process(root, "",
+            "compile.remake_dest_and_copy_dir(compile.paths['data'], {!r})".format(copy_dst))),
+        ("sync_dir (no-op)", lambda: time_in_process(root,
+            "compile.sync_dir(compile.paths['data'], {!r})".format(copy_dst),
+            "compile.sync_dir(compile.paths['data'], {!r})".format(copy_dst))),
+        ("full build (parallel, -j {})".format(num_jobs), full_build),
+        ("full build (-j 1)", full_build_serial),
+        ("no-op --ifchanged", noop_ifchanged),
+    ]
+
+def get_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(COMPILE_SCRIPT),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        commit = result.stdout.decode("utf-8").strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", COMPILE_SCRIPT],
+            cwd=os.path.dirname(COMPILE_SCRIPT), stdout=subprocess.PIPE).stdout.strip()
+        return commit + ("-dirty" if dirty else "") if commit else None
+    except OSError:
+        return None
+
+def run_benchmarks(args):
+    root = tempfile.mkdtemp(prefix="km_compile_bench_")
+    try:
+        print("Generating project in {} ({} sources, {} targets, {} GB data)".format(
+            root, args.sources, args.targets, args.data_gb))
+        generate_project(root, args.sources, args.targets, args.data_gb)
+
+        results = {}
+        for name, func in get_benchmarks(root, args.jobs):
+            if args.filter is not None and args.filter not in name:
+                continue
+            func() # warm-up, and leaves the tree in the state the next run expects
+            times = [func() for _ in range(args.repeat)]
+            results[name] = {
+                "median": statistics.median(times),
+                "min": min(times),
+                "max": max(times),
+                "runs": times
+            }
+            print("{:<32} median {:8.3f}s  min {:8.3f}s".format(name, results[name]["median"],
+                results[name]["min"]))
+
+        return {
+            "commit": get_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {
+                "sources": args.sources,
+                "targets": args.targets,
+                "data_gb": args.data_gb,
+                "jobs": args.jobs,
+                "repeat": args.repeat
+            },
+            "results": results
+        }
+    finally:
+        if args.keep:
+            print("Kept project at " + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+def compare(old_path, new_path, threshold):
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+    if old.get("config") != new.get("config"):
+        print("Warning: the two runs used different configurations")
+
+    print("{:<32} {:>10} {:>10} {:>8}".format("benchmark", "old", "new", "change"))
+    regressed = False
+    for name, new_result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        old_median = old["results"][name]["median"]
+        new_median = new_result["median"]
+        change = (new_median - old_median) / old_median if old_median > 0 else 0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print("{:<32} {:9.3f}s {:9.3f}s {:+7.1f}%{}".format(name, old_median, new_median,
+            change * 100, flag))
+    return 1 if regressed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compile.py on a generated project")
+    parser.add_argument("--sources", type=int, default=200, help="number of source files")
+    parser.add_argument("--targets", type=int, default=4, help="number of build targets")
+    parser.add_argument("--data-gb", type=float, default=0.25, help="GB of COPY_DIRS data")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="job count for parallel builds")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="JSON results file (default bench_results/<commit>.json)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated project")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+        help="compare two results files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative slowdown reported as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+
+    report = run_benchmarks(args)
+    output_path = args.output
+    if output_path is None:
+        output_dir = os.path.join(os.getcwd(), "bench_results")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        output_path = os.path.join(output_dir, "{}.json".format(report["commit"] or "unknown"))
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + output_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
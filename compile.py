@@ -2,16 +2,43 @@
 # Must be run from the root directory
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
+import errno
+import fnmatch
 import hashlib
+import json
+import mmap
 import os
 import platform
 import queue
 import random
+import re
+import shlex
 import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import statistics
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
 import threading
+import time
+import zipfile
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
+try:
+    import lzma
+except ImportError:
+    lzma = None # Python built without liblzma
 
 class Platform(Enum):
     WINDOWS = "Windows"
@@ -20,11 +47,6 @@ class Platform(Enum):
 
 PLATFORM = ({ p.value: p for p in list(Platform) })[platform.system()]
 
-class CompileMode(Enum):
-    DEBUG    = "debug"
-    INTERNAL = "internal"
-    RELEASE  = "release"
-
 class TargetType(Enum):
     EXECUTABLE = "exe"
     LIB_DYNAMIC = "lib_dynamic"
@@ -57,13 +79,202 @@ class PlatformTargetOptions:
     def get_linker_flags(self):
         return " ".join([flag for flag in self.linker_flags])
 
+    # Argument lists for running the compiler without a shell. Entries may
+    # hold several flags ("-framework Cocoa"), so each one is split.
+    def get_compiler_flag_list(self):
+        return [d.to_compiler_flag() for d in self.defines] + [
+            arg for flag in self.compiler_flags for arg in shlex.split(flag)
+        ]
+
+    def get_linker_flag_list(self):
+        return [arg for flag in self.linker_flags for arg in shlex.split(flag)]
+
+# A compile mode's defines and flags, on top of the ones every build gets.
+# Modes extend a parent mode by name: defines override the parent's ones with
+# the same name, flags are added after the parent's. Projects add their own
+# modes with app_info.COMPILE_MODES.
+class CompileMode:
+    def __init__(self, name, parent=None, defines=[], platform_options={}, lib_config=None,
+        pgo=None, profile=None):
+        self.name = name
+        self.parent = parent
+        self.defines = defines
+        self.platform_options = platform_options # { Platform: PlatformTargetOptions }
+        self.lib_config = lib_config # "debug" or "release" external libs
+        self.pgo = pgo # build with a training run's profile, see PGO_TRAINING
+        self.profile = profile # run and report on executables after building, see build_profile
+        self.parent_mode = None # set by get_compile_modes
+
+    # This mode's ancestors, then the mode itself
+    def get_chain(self):
+        chain = []
+        mode = self
+        while mode is not None:
+            if mode in chain:
+                raise Exception("Compile mode {} extends itself".format(self.name))
+            chain.insert(0, mode)
+            mode = mode.parent_mode
+        return chain
+
+    def get_inherited(self, attr, default):
+        for mode in reversed(self.get_chain()):
+            if getattr(mode, attr) is not None:
+                return getattr(mode, attr)
+        return default
+
+    def get_lib_config(self):
+        return self.get_inherited("lib_config", "release")
+
+    def uses_pgo(self):
+        return self.get_inherited("pgo", False)
+
+    def uses_profile(self):
+        return self.get_inherited("profile", False)
+
+    def get_defines(self):
+        defines = {}
+        for mode in self.get_chain():
+            for define in mode.defines:
+                defines[define.name] = define
+        return list(defines.values())
+
+    def get_platform_options(self, platform):
+        options = []
+        for mode in self.get_chain():
+            # Compare values, app_info may have its own copy of the Platform enum
+            for key, platform_options in mode.platform_options.items():
+                if key.value == platform.value:
+                    options.append(platform_options)
+        return options
+
+    # Defines and flags are kept apart, the common defines come between them
+    def get_compiler_flags(self):
+        return " ".join(options.get_compiler_flags()
+            for options in self.get_platform_options(PLATFORM))
+
+    def get_linker_flags(self):
+        return " ".join(options.get_linker_flags()
+            for options in self.get_platform_options(PLATFORM))
+
+    def get_compiler_flag_list(self):
+        return [arg for options in self.get_platform_options(PLATFORM)
+            for arg in options.get_compiler_flag_list()]
+
+    def get_linker_flag_list(self):
+        return [arg for options in self.get_platform_options(PLATFORM)
+            for arg in options.get_linker_flag_list()]
+
+UNIX_DEBUG_OPTIONS = PlatformTargetOptions([], [
+    "-O0",                  # no optimization
+    "-Wno-unused-function"  # unused function
+], [])
+UNIX_OPTIMIZED_OPTIONS = PlatformTargetOptions([], [
+    "-O3" # level 3 optimizations
+], [])
+
+COMPILE_MODES = [
+    CompileMode("debug", lib_config="debug", defines=[
+        Define("GAME_INTERNAL", "1"),
+        Define("GAME_SLOW",     "1")
+    ], platform_options={
+        Platform.WINDOWS: PlatformTargetOptions([], [
+            "-MTd",    # static link of C runtime library (multithreaded debug version)
+            "-Od",     # no optimization
+            "-Oi",     # ...except for compiler intrinsics
+            "-wd4100", # unused function arguments
+            "-wd4189", # local variable is initialized but not referenced
+            "-wd4505", # unreferenced local function has been removed
+            "-wd4702", # unreachable code (early return for debugging)
+        ], []),
+        Platform.LINUX: UNIX_DEBUG_OPTIONS,
+        Platform.MAC: UNIX_DEBUG_OPTIONS
+    }),
+    CompileMode("internal", lib_config="release", defines=[
+        Define("GAME_INTERNAL", "1"),
+        Define("GAME_SLOW",     "0")
+    ], platform_options={
+        Platform.WINDOWS: PlatformTargetOptions([], [
+            "-MT", # static link of C runtime library (multithreaded release version)
+            "-O2"  # full optimization
+        ], []),
+        Platform.LINUX: UNIX_OPTIMIZED_OPTIONS,
+        Platform.MAC: UNIX_OPTIMIZED_OPTIONS
+    }),
+    CompileMode("release", parent="internal", defines=[
+        Define("GAME_INTERNAL", "0")
+    ]),
+    # Optimized with a training run's profile (GCC and clang only)
+    CompileMode("release-pgo", parent="release", pgo=True),
+    # Link-time optimization, with the LTO link spread over all cores
+    CompileMode("release-lto", parent="release", platform_options={
+        Platform.WINDOWS: PlatformTargetOptions([], ["-GL"], ["-LTCG"]),
+        Platform.LINUX: PlatformTargetOptions([], ["-flto=auto"], ["-flto=auto"]),
+        Platform.MAC: PlatformTargetOptions([], ["-flto=thin"], ["-flto=thin"])
+    }),
+    # Newer x86-64 CPUs only, for comparing against plain release:
+    # v2 adds SSE4.2 and POPCNT, v3 adds AVX2, BMI2 and FMA
+    CompileMode("release-v2", parent="release", platform_options={
+        Platform.LINUX: PlatformTargetOptions([], ["-march=x86-64-v2"], [])
+    }),
+    CompileMode("release-v3", parent="release", platform_options={
+        Platform.WINDOWS: PlatformTargetOptions([], ["-arch:AVX2"], []),
+        Platform.LINUX: PlatformTargetOptions([], ["-march=x86-64-v3"], [])
+    }),
+    # Instrumented for gprof: call counts and sampled time, Linux only
+    CompileMode("profile", parent="release", profile=True, platform_options={
+        Platform.LINUX: PlatformTargetOptions([], [
+            "-pg",
+            "-fno-omit-frame-pointer" # keeps call graph arcs through leaf functions
+        ], ["-pg"])
+    }),
+]
+
+# Built-in modes, then app_info's, which may replace built-in ones by name
+def get_compile_modes():
+    modes = { mode.name: mode for mode in COMPILE_MODES }
+    if app_info is not None:
+        for mode in getattr(app_info, "COMPILE_MODES", []):
+            modes[mode.name] = mode
+    for mode in modes.values():
+        mode.parent_mode = None
+        if mode.parent is not None:
+            if mode.parent not in modes:
+                raise Exception("Compile mode {} extends unknown mode {}".format(
+                    mode.name, mode.parent))
+            mode.parent_mode = modes[mode.parent]
+    for mode in modes.values():
+        mode.get_chain() # check for cycles
+    return modes
+
 class BuildTarget:
-    def __init__(self, name, source_file, type, defines=[], platform_options={}):
+    def __init__(self, name, source_file, type, defines=[], platform_options={},
+        depends=[], pch_header=None, sources=None, shards=None):
         self.name = name
         self.source_file = source_file
         self.type = type
         self.defines = defines
         self.platform_options = platform_options
+        self.depends = depends # names of targets that must be built first
+        self.pch_header = pch_header # header to precompile (Linux), relative to root
+        # Either a list of separately compiled sources, or a number of shards
+        # to split the unity source_file into. Both compile objects in parallel
+        # and link them in a separate step (Linux and macOS). Sharded units
+        # can't use static functions or declarations from other units, which
+        # may end up in another shard.
+        self.sources = sources
+        self.shards = shards
+
+    def is_sharded(self):
+        return self.sources is not None or (self.shards is not None and self.shards > 1)
+
+    def is_library(self):
+        return self.is_static_library() or self.is_dynamic_library()
+
+    def is_static_library(self):
+        return self.type.value == TargetType.LIB_STATIC.value
+
+    def is_dynamic_library(self):
+        return self.type.value == TargetType.LIB_DYNAMIC.value
 
     def get_output_name(self):
         if self.type == TargetType.EXECUTABLE:
@@ -73,8 +284,20 @@ class BuildTarget:
                 return self.name + "_linux"
             elif PLATFORM == Platform.MAC:
                 return self.name + "_macos"
-        else:
-            raise Exception("Unsupported target type: {}".format(self.type))
+        elif self.type == TargetType.LIB_STATIC:
+            if PLATFORM == Platform.WINDOWS:
+                return self.name + ".lib"
+            else:
+                return "lib" + self.name + ".a"
+        elif self.type == TargetType.LIB_DYNAMIC:
+            if PLATFORM == Platform.WINDOWS:
+                return self.name + ".dll"
+            elif PLATFORM == Platform.LINUX:
+                return "lib" + self.name + ".so"
+            elif PLATFORM == Platform.MAC:
+                return "lib" + self.name + ".dylib"
+
+        raise Exception("Unsupported target type: {}".format(self.type))
 
     def get_compiler_flags(self):
         compiler_flags = " ".join([d.to_compiler_flag() for d in self.defines])
@@ -96,18 +319,67 @@ class BuildTarget:
 
         return linker_flags
 
+    def get_compiler_flag_list(self):
+        compiler_flags = [d.to_compiler_flag() for d in self.defines]
+        if PLATFORM in self.platform_options:
+            compiler_flags += self.platform_options[PLATFORM].get_compiler_flag_list()
+
+        return compiler_flags
+
+    def get_linker_flag_list(self):
+        linker_flags = []
+        if PLATFORM in self.platform_options:
+            linker_flags += self.platform_options[PLATFORM].get_linker_flag_list()
+
+        return linker_flags
+
 class CopyDir:
     def __init__(self, src, dst):
         self.src = src
         self.dst = dst
 
+# Processes files under data/ matching any of the patterns (relative to data/,
+# forward slashes, e.g. "textures/*.png") with func(src_path, dst_path). func
+# must be a module-level function in app_info, it runs in a separate process.
+# Outputs are cached by input content, name and version: bump the version
+# whenever the processor changes.
+class AssetProcessor:
+    def __init__(self, patterns, func, version=1, output_extension=None, name=None):
+        self.patterns = [patterns] if isinstance(patterns, str) else patterns
+        self.func = func
+        self.version = version
+        self.output_extension = output_extension
+        self.name = name if name is not None else func.__name__
+
+    def matches(self, rel_path):
+        return any(fnmatch.fnmatch(rel_path, pattern) for pattern in self.patterns)
+
+    def get_output_path(self, rel_path):
+        if self.output_extension is None:
+            return rel_path
+        return os.path.splitext(rel_path)[0] + self.output_extension
+
 class LibExternal:
     def __init__(self, name, path, compiledNames = None, dllNames = None):
         self.name = name
         self.path = path
+        # { "debug": ..., "release": ... }, used on Windows. To link on other
+        # platforms too, key by Platform: { Platform.LINUX: { "debug": ... }, ... }
         self.compiledNames = compiledNames
         self.dllNames = dllNames
 
+    def get_compiled_names(self, platform):
+        if self.compiledNames is None:
+            return None
+        platform_keyed = [key for key in self.compiledNames if isinstance(key, Enum)]
+        if not platform_keyed:
+            return self.compiledNames if platform == Platform.WINDOWS else None
+        # Compare values, app_info may have its own copy of the Platform enum
+        for key in platform_keyed:
+            if key.value == platform.value:
+                return self.compiledNames[key]
+        return None
+
 # Important directory & file paths
 paths = {}
 paths["root"] = os.getcwd()
@@ -115,13 +387,22 @@ paths["root"] = os.getcwd()
 includeDirs = {}
 
 sys.path.insert(0, os.path.join(paths["root"], "compile"))
-import app_info
+if len(sys.argv) > 1 and sys.argv[1] == "worker":
+    app_info = None # compile workers only build what they're sent, no project needed
+else:
+    import app_info
 
 def normalize_path_slashes(path):
     return path.replace("/", os.sep)
 
-def fill_paths_and_include_dirs():
-    paths["build"]          = paths["root"]  + "/build"
+# Each compile mode builds into its own directory under build/, with its own
+# manifest, dependency graph and artifacts. Without a mode, "build" is the
+# top-level directory.
+def fill_paths_and_include_dirs(build_mode=None):
+    paths["build-root"]     = paths["root"]  + "/build"
+    paths["build"]          = paths["build-root"]
+    if build_mode is not None:
+        paths["build"]      = paths["build-root"] + "/" + build_mode
     paths["data"]           = paths["root"]  + "/data"
     paths["deploy"]         = paths["root"]  + "/deploy"
     paths["libs-external"]  = paths["root"]  + "/libs/external"
@@ -129,10 +410,44 @@ def fill_paths_and_include_dirs():
     paths["src"]            = paths["root"]  + "/src"
 
     paths["build-logs"]     = paths["build"] + "/logs"
+    paths["build-deps"]     = paths["build"] + "/deps"
+    paths["build-trace"]    = paths["build-logs"] + "/trace.json"
+    paths["build-summary"]  = paths["build-logs"] + "/build_summary.txt"
+    paths["build-pch"]      = paths["build"] + "/pch"
+    paths["build-obj"]      = paths["build"] + "/obj"
+    paths["build-shards"]   = paths["build"] + "/shards"
+
+    # Processed assets from data/, see AssetProcessor
+    paths["build-assets"]   = paths["build"] + "/" + getattr(app_info, "ASSETS_DIR", "assets")
+    paths["asset-manifest"] = paths["build"] + "/asset_manifest.json"
+    paths["asset-outputs"]  = paths["build"] + "/asset_outputs.json"
+
+    # Per-target dependencies, recorded from compiler depfiles
+    paths["dep-graph"]      = paths["build"] + "/dep_graph.json"
+    # Peak memory of each build job, for throttling
+    paths["job-resources"]  = paths["build"] + "/job_resources.json"
+    # Training profiles of release-pgo targets, one directory each
+    paths["pgo"]            = paths["build"] + "/pgo"
+
+    # Compile cache lives outside the build directory so "clean" keeps it
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    paths["compile-cache"]  = os.environ.get("KM_COMPILE_CACHE_DIR",
+        os.path.join(cache_home, "km_compile"))
+    # Asset processor outputs, kept next to (not in) the compile cache
+    paths["asset-cache"]    = paths["compile-cache"] + "-assets"
+    # Trained PGO profiles, per project, target and source revision
+    paths["pgo-cache"]      = paths["compile-cache"] + "-pgo"
+    # Detected compilers and linkers, for this machine
+    paths["toolchain-probe"] = paths["compile-cache"] + "/toolchains.json"
+
+    # Source manifest (stat data + digests) for if-changed compilation
+    paths["src-manifest"]   = paths["build"] + "/src_manifest.json"
 
-    # Source hashes for if-changed compilation
-    paths["src-hashes"]     = paths["build"] + "/src_hashes"
-    paths["src-hashes-old"] = paths["build"] + "/src_hashes_old"
+    # Every build's timings and sizes, for "history". Clean keeps it.
+    paths["build-history"]  = paths["build-root"] + "/logs/history.sqlite"
+
+    # Mode of the last successful build, for "run" and "deploy"
+    paths["last-build-mode"] = paths["build-root"] + "/last_mode"
 
     # Other project-specific paths
     for name, path in app_info.PATHS.items():
@@ -162,12 +477,183 @@ def remake_dest_and_copy_dir(src_path, dst_path):
         elif os.path.isdir(file_path):
             shutil.copytree(file_path, os.path.join(dst_path, file_name))
 
-def make_and_clear_dir(path):
+COPY_MODES = ["sync", "hardlink", "remake"]
+
+FICLONE = 0x40049409 # linux/fs.h, clone a whole file into another
+reflink_supported = fcntl is not None and PLATFORM == Platform.LINUX
+copy_file_range_supported = hasattr(os, "copy_file_range")
+
+class SyncStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.linked_files = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.removed = 0
+
+    def add_copied(self, size, linked):
+        with self.lock:
+            if linked:
+                self.linked_files += 1
+            else:
+                self.copied_files += 1
+                self.copied_bytes += size
+
+    def summary(self):
+        mb = 1024 * 1024
+        return "{} copied ({:.1f} MB), {} linked, {} skipped ({:.1f} MB), {} removed".format(
+            self.copied_files, self.copied_bytes / mb, self.linked_files,
+            self.skipped_files, self.skipped_bytes / mb, self.removed)
+
+def copy_file_contents(src_file, dst_file, size):
+    global reflink_supported, copy_file_range_supported
+
+    # Reflinks share the source extents (btrfs, xfs), no data is copied
+    if reflink_supported:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return True
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                reflink_supported = False
+            elif e.errno != errno.EXDEV:
+                raise
+
+    # In-kernel copy, no round trip through user space
+    if copy_file_range_supported:
+        try:
+            offset = 0
+            while offset < size:
+                num_copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(),
+                    size - offset, offset, offset)
+                if num_copied == 0:
+                    break
+                offset += num_copied
+            if offset == size:
+                return False
+            dst_file.truncate(0)
+        except OSError as e:
+            if e.errno in (errno.ENOSYS, errno.EOPNOTSUPP):
+                copy_file_range_supported = False
+            elif e.errno not in (errno.EXDEV, errno.EINVAL):
+                raise
+            dst_file.truncate(0)
+        dst_file.seek(0)
+
+    shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+    return False
+
+def sync_file(src_path, dst_path, size, copy_mode, stats):
+    tmp_path = dst_path + ".sync-tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+    if copy_mode == "hardlink":
+        try:
+            os.link(src_path, tmp_path)
+            os.replace(tmp_path, dst_path)
+            stats.add_copied(size, True)
+            return
+        except OSError:
+            pass # different filesystem, copy instead
+
+    with open(src_path, "rb") as src_file, open(tmp_path, "wb") as dst_file:
+        linked = copy_file_contents(src_file, dst_file, size)
+    shutil.copystat(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    stats.add_copied(size, linked)
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def sync_dir(src_path, dst_path, copy_mode="sync", num_threads=None):
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    stats = SyncStats()
+    copies = []
+    dirs = [""]
+    while dirs:
+        rel_dir = dirs.pop()
+        src_dir = os.path.join(src_path, rel_dir)
+        dst_dir = os.path.join(dst_path, rel_dir)
+        if os.path.lexists(dst_dir) and not os.path.isdir(dst_dir):
+            os.remove(dst_dir)
+            stats.removed += 1
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+
+        src_entries = { entry.name: entry for entry in os.scandir(src_dir) }
+        dst_entries = { entry.name: entry for entry in os.scandir(dst_dir) }
+
+        # Delete whatever is no longer in the source
+        for name, dst_entry in dst_entries.items():
+            src_entry = src_entries.get(name)
+            if src_entry is None or src_entry.is_dir() != dst_entry.is_dir(follow_symlinks=False):
+                remove_path(dst_entry.path)
+                stats.removed += 1
+
+        for name, src_entry in src_entries.items():
+            rel_path = os.path.join(rel_dir, name)
+            if src_entry.is_dir():
+                dirs.append(rel_path)
+                continue
+
+            src_stat = src_entry.stat()
+            dst_file_path = os.path.join(dst_path, rel_path)
+            try:
+                dst_stat = os.stat(dst_file_path)
+                unchanged = (src_stat.st_ino == dst_stat.st_ino and src_stat.st_dev == dst_stat.st_dev) \
+                    or (src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns)
+            except FileNotFoundError:
+                unchanged = False
+
+            if unchanged:
+                stats.skipped_files += 1
+                stats.skipped_bytes += src_stat.st_size
+            else:
+                copies.append((src_entry.path, dst_file_path, src_stat.st_size))
+
+    # Biggest files first, so one large asset doesn't finish last on its own
+    copies.sort(key=lambda copy: copy[2], reverse=True)
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        futures = [
+            executor.submit(sync_file, src_file_path, dst_file_path, size, copy_mode, stats)
+            for src_file_path, dst_file_path, size in copies
+        ]
+        for future in futures:
+            future.result()
+
+    return stats
+
+def copy_dirs_to_build(copy_mode, copy_dirs=None):
+    if copy_dirs is None:
+        copy_dirs = app_info.COPY_DIRS
+    for copy_dir in copy_dirs:
+        dir_src_path = os.path.join(paths["root"], copy_dir.src)
+        dir_dst_path = os.path.join(paths["build"], copy_dir.dst)
+        with tracer.span(copy_dir.dst, "copy-dirs", { "mode": copy_mode }) as span:
+            if copy_mode == "remake":
+                remake_dest_and_copy_dir(dir_src_path, dir_dst_path)
+            else:
+                stats = sync_dir(dir_src_path, dir_dst_path, copy_mode)
+                span.args = { "mode": copy_mode, "copied bytes": stats.copied_bytes,
+                    "skipped bytes": stats.skipped_bytes }
+                print("Synced {}: {}".format(copy_dir.dst, stats.summary()))
+
+def make_and_clear_dir(path, keep=[]):
     if not os.path.exists(path):
         os.makedirs(path)
 
     for file_name in os.listdir(path):
         file_path = os.path.join(path, file_name)
+        if file_path in keep:
+            continue
         try:
             if os.path.isfile(file_path):
                 os.remove(file_path)
@@ -176,486 +662,4932 @@ def make_and_clear_dir(path):
         except Exception as e:
             print("Failed to clean {}: {}".format(file_path, str(e)))
 
-def get_common_defines(compile_mode):
-    defines = []
-    if PLATFORM == Platform.WINDOWS:
-        defines.append(Define("GAME_WIN32", "1"))
-        defines.append(Define("_CRT_SECURE_NO_WARNINGS"))
-    elif PLATFORM == Platform.LINUX:
-        defines.append(Define("GAME_LINUX", "1"))
-    elif PLATFORM == Platform.MAC:
-        defines.append(Define("GAME_MACOS", "1"))
+# Console output from concurrent build jobs is written one full line at a time
+print_lock = threading.Lock()
+prefix_output = False
 
-    if compile_mode == CompileMode.DEBUG:
-        defines.append(Define("GAME_INTERNAL", "1"))
-        defines.append(Define("GAME_SLOW",     "1"))
-    elif compile_mode == CompileMode.INTERNAL:
-        defines.append(Define("GAME_INTERNAL", "1"))
-        defines.append(Define("GAME_SLOW",     "0"))
-    elif compile_mode == CompileMode.RELEASE:
-        defines.append(Define("GAME_INTERNAL", "0"))
-        defines.append(Define("GAME_SLOW",     "0"))
+running_processes = {} # process -> label
+running_processes_lock = threading.Lock()
+build_cancelled = threading.Event()
 
-    return defines
+def print_job_line(label, line):
+    with print_lock:
+        if prefix_output and label is not None:
+            print("[{}] {}".format(label, line), flush=True)
+        else:
+            print(line, flush=True)
 
-def win_compile(target, compile_mode):
-    compiler_flags = ""
+class ProcessResult:
+    def __init__(self, exit_code, wall_time=0.0, cpu_time=0.0, peak_rss=0, log_path=None,
+        worker=None):
+        self.exit_code = exit_code
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss # bytes
+        self.log_path = log_path
+        self.worker = worker # address of the compile worker that ran it, if any
+        self.timed_out = False
 
-    # Add defines/macros
-    compiler_flags = " ".join([
-        compiler_flags
-    ] + [d.to_compiler_flag() for d in get_common_defines(compile_mode)])
+    def summary(self):
+        return "{}, {:.2f}s wall, {:.2f}s CPU, {:.0f} MB peak RSS".format(
+            "timed out" if self.timed_out else "exit code {}".format(self.exit_code),
+            self.wall_time, self.cpu_time, self.peak_rss / (1024 * 1024))
 
-    # Add general compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-nologo",        # disable the "Microsoft C/C++ Optimizing Compiler" message
-        "-Gm-",           # disable incremental build things
-        "-GR-",           # disable type information
-        "-EHa-",          # disable exception handling
-        "-EHsc",          # handle stdlib errors
-        "-std:c++latest", # use latest C++ standard (aggregate initialization...)
-        "-Z7"             # minimal "old school" debug information
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-MTd", # static link of C runtime library (multithreaded debug version)
-            "-Od",  # no optimization
-            "-Oi",  # ...except for compiler intrinsics
-        ])
-    elif compile_mode == CompileMode.INTERNAL or compile_mode == CompileMode.RELEASE:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-MT", # static link of C runtime library (multithreaded release version)
-            "-O2"  # full optimization
-        ])
+    def to_trace_args(self):
+        args = {
+            "exit code": self.exit_code,
+            "cpu time": round(self.cpu_time, 3),
+            "peak rss MB": round(self.peak_rss / (1024 * 1024), 1)
+        }
+        if self.worker is not None:
+            args["worker"] = self.worker
+        return args
 
-    # Add compiler warning flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-WX", # treat warnings as errors
-        "-W4", # level 4 warnings
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-wd4100", # unused function arguments
-            "-wd4189", # local variable is initialized but not referenced
-            "-wd4505", # unreferenced local function has been removed
-            "-wd4702", # unreachable code (early return for debugging)
-        ])
+def command_to_string(command):
+    if isinstance(command, str):
+        return command
+    return " ".join(shlex.quote(arg) for arg in command)
 
-    # Add include paths
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-I\"" + paths["src"] + "\"",
-        "-I\"" + paths["libs-internal"] + "\""
-    ] + [ "-I\"" + path + "\"" for path in includeDirs.values() ])
+opened_logs = set()
+opened_logs_lock = threading.Lock()
 
-    # Add all custom defines + compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        target.get_compiler_flags()
-    ])
+def get_log_path(label):
+    name = label.replace("/", "_").replace("\\", "_").replace(":", "_")
+    return os.path.join(paths["build-logs"], name + ".log")
 
-    """
-    # TODO hmm... is this a Hack
-    if target.name == "nopasanada":
-        compiler_warning_flags = " ".join([
-            compiler_warning_flags,
-            "/wd4267", # conversion from X to Y, possible loss of data
-            "/wd4456", # declaration of X hides previous local declaration
-        ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_warning_flags = " ".join([
-            compiler_warning_flags,
-            "/wd4189", # local variable is initialized but not referenced
-            "/wd4702", # unreachable code (early return for debugging)
-        ])
-    """
+def open_job_log(log_path):
+    if not os.path.exists(os.path.dirname(log_path)):
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    # Start each job's log fresh once per build, then append its later commands
+    with opened_logs_lock:
+        mode = "a" if log_path in opened_logs else "w"
+        opened_logs.add(log_path)
+    return open(log_path, mode)
 
-    linker_flags = ""
+RSS_SAMPLE_INTERVALS = (0.005, 0.05) # first, then doubling up to the second
 
-    # Add general linker flags
-    linker_flags = " ".join([
-        "-incremental:no",  # disable incremental linking
-        "-opt:ref"          # get rid of extraneous linkages
-    ])
+def read_peak_rss(pid="self"):
+    try:
+        with open("/proc/{}/status".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
 
-    # Add libraries
-    linker_flags = " ".join([
-        linker_flags,
-        "kernel32.lib"
-    ])
+# High-water RSS of a process and its running children, since their exec
+def get_process_tree_peak_rss(pid):
+    try:
+        with open("/proc/{}/task/{}/children".format(pid, pid), "r") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        children = []
+    return read_peak_rss(pid) + sum(get_process_tree_peak_rss(child) for child in children)
 
-    indStr = ""
-    if compile_mode == CompileMode.DEBUG:
-        indStr = "debug"
-    elif compile_mode == CompileMode.INTERNAL or compile_mode == CompileMode.RELEASE:
-        indStr = "release"
-    else:
-        # TODO shouldn't have to check this everywhere
-        raise Exception("Unknown compile mode {}".format(compile_mode))
+# Peak RSS of a process and its children, sampled from /proc. wait4's
+# ru_maxrss can't be used on its own on Linux: a child forked from this
+# process keeps the Python interpreter's high-water mark through exec.
+class PeakRssSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = get_process_tree_peak_rss(pid) # Popen returns after exec
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
 
-    for lib in app_info.LIBS_EXTERNAL:
-        if lib.compiledNames is not None:
-            linker_flags += " -LIBPATH:\"" + os.path.join(paths["libs-external"], lib.path, "win32", indStr) + "\""
-            linker_flags += " " + lib.compiledNames[indStr]
+    def sample(self):
+        interval = RSS_SAMPLE_INTERVALS[0]
+        while not self.done.wait(interval):
+            self.peak = max(self.peak, get_process_tree_peak_rss(self.pid))
+            interval = min(interval * 2, RSS_SAMPLE_INTERVALS[1])
 
-    # Add all custom linker flags
-    linker_flags = " ".join([
-        linker_flags,
-        target.get_linker_flags()
-    ])
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self.peak
 
-    # Clear old PDB files
-    # TODO with multiple compile targets, idk about this
-    for file_name in os.listdir(paths["build"]):
-        if ".pdb" in file_name:
-            try:
-                os.remove(os.path.join(paths["build"], file_name))
-            except:
-                print("Couldn't remove " + file_name)
+def start_rss_sampler(process):
+    if PLATFORM != Platform.LINUX or not hasattr(os, "waitid"):
+        return None
+    return PeakRssSampler(process.pid)
 
-    exe_name = target.get_output_name()
-    map_name = target.name + "_win32.map"
-    pdb_name = target.name + "_game" + str(random.randrange(99999)) + ".pdb"
-    src_name = os.path.join(paths["root"], target.source_file)
+def wait_for_process(process, rss_sampler=None):
+    if not hasattr(os, "wait4"):
+        return process.wait(), 0.0, 0
 
-    compile_command = " ".join([
-        "cl", compiler_flags, "-Fe" + exe_name, "-Fm" + map_name, "\"" + src_name + "\"",
-        "-link", linker_flags, "-PDB:" + pdb_name
-    ])
+    if rss_sampler is not None:
+        # Wait without reaping, so the pid can't be reused while sampling
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        rss_sampler.stop()
+    _, status, rusage = os.wait4(process.pid, 0)
+    if hasattr(os, "waitstatus_to_exitcode"):
+        exit_code = os.waitstatus_to_exitcode(status)
+    elif os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    process.returncode = exit_code # already reaped, keep Popen from waiting again
 
-    load_compiler = "call \"" + paths["win32-vcvarsall"] + "\" x64"
+    # ru_maxrss is in KB on Linux, bytes on macOS. It covers the compiler
+    # driver's waited-for children too (cc1plus, ld), but starts at this
+    # process's own peak (see PeakRssSampler). Past that, it's the child's.
+    peak_rss = rusage.ru_maxrss if PLATFORM == Platform.MAC else rusage.ru_maxrss * 1024
+    if rss_sampler is not None:
+        if peak_rss <= read_peak_rss():
+            peak_rss = 0
+        peak_rss = max(peak_rss, rss_sampler.peak)
+    return exit_code, rusage.ru_utime + rusage.ru_stime, peak_rss
 
-    subprocess.call(" & ".join([
-        "pushd \"" + paths["build"] + "\"",
-        load_compiler,
-        compile_command,
-        "popd"
-    ]), shell=True)
+def kill_process_tree(process):
+    try:
+        if PLATFORM == Platform.WINDOWS:
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass # already gone
 
-    for lib in app_info.LIBS_EXTERNAL:
-        if lib.dllNames is not None:
-            dll_path_src = os.path.join(paths["libs-external"], lib.path, "win32", indStr, lib.dllNames[indStr])
-            dll_path_dst = os.path.join(paths["build"], lib.dllNames[indStr])
-            shutil.copyfile(dll_path_src, dll_path_dst)
+# Runs a command without a shell when given an argv list (a string goes
+# through the shell, which Windows needs for vcvarsall). Output is streamed
+# line by line to the console and to the job's log under build/logs. With a
+# timeout, the process and anything it started are killed when it runs out.
+def run_process(command, cwd, label=None, line_filter=None, env=None, pass_fds=(),
+    timeout=None):
+    if build_cancelled.is_set():
+        return ProcessResult(-1)
 
-    app_info.post_compile_custom(paths)
+    log_path = get_log_path(label) if label is not None else None
+    log_file = open_job_log(log_path) if log_path is not None else None
+    if log_file is not None:
+        log_file.write("$ {}\n".format(command_to_string(command)))
+        log_file.flush()
 
-def win_run(target):
-    os.system(" & ".join([
-        "pushd " + paths["build"],
-        target.name + "_win32.exe",
-        "popd"
-    ]))
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(command, cwd=cwd, shell=isinstance(command, str), env=env,
+            pass_fds=pass_fds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, errors="replace",
+            start_new_session=timeout is not None and PLATFORM != Platform.WINDOWS)
+    except OSError as e:
+        print_job_line(label, "Failed to run {}: {}".format(
+            command if isinstance(command, str) else command[0], str(e)))
+        if log_file is not None:
+            log_file.close()
+        return ProcessResult(127, log_path=log_path)
 
-def win_deploy(target):
-    deploy_bundle_name = target.name
-    deploy_bundle_path = os.path.join(paths["deploy"], deploy_bundle_name)
-    remake_dest_and_copy_dir(paths["build"], deploy_bundle_path)
-    for fileName in os.listdir(deploy_bundle_path):
-        if fileName not in app_info.DEPLOY_FILES:
-            filePath = os.path.join(deploy_bundle_path, fileName)
-            if os.path.isfile(filePath):
-                os.remove(filePath)
-            elif os.path.isdir(filePath):
-                shutil.rmtree(filePath)
+    rss_sampler = start_rss_sampler(process)
+    with running_processes_lock:
+        running_processes[process] = label
+    timer = None
+    if timeout is not None:
+        timed_out = threading.Event()
+        def on_timeout():
+            timed_out.set()
+            kill_process_tree(process)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
 
-    deployZipPath = os.path.join(paths["deploy"], "0. Unnamed")
-    shutil.make_archive(deployZipPath, "zip", root_dir=paths["deploy"], base_dir=deploy_bundle_name)
+    try:
+        for line in process.stdout:
+            if log_file is not None:
+                log_file.write(line)
+            line = line.rstrip("\n")
+            if line_filter is None or line_filter(line):
+                print_job_line(label, line)
+        process.stdout.close()
+        exit_code, cpu_time, peak_rss = wait_for_process(process, rss_sampler)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with running_processes_lock:
+            running_processes.pop(process, None)
 
-def linux_compile(target, compile_mode):
-    compiler_flags = ""
+    result = ProcessResult(exit_code, time.perf_counter() - start, cpu_time, peak_rss, log_path)
+    result.timed_out = timer is not None and timed_out.is_set()
+    if resource_history is not None and label is not None:
+        resource_history.record(label, peak_rss)
+    if log_file is not None:
+        log_file.write("# {}\n".format(result.summary()))
+        log_file.close()
+    return result
 
-    # Add defines/macros
-    compiler_flags = " ".join([
-        compiler_flags
-    ] + [d.to_compiler_flag() for d in get_common_defines(compile_mode)])
+def cancel_running_commands():
+    build_cancelled.set()
+    with running_processes_lock:
+        for process in running_processes:
+            try:
+                process.terminate()
+            except OSError:
+                pass
 
-    # Add general compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-std=c++17",     # use C++17 standard
-        "-ggdb3",         # generate level 3 (max) GDB debug info.
-        "-fno-rtti",      # disable run-time type info
-        "-fno-exceptions" # disable C++ exceptions (ew)
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-O0", # no optimization
-        ])
-    elif compile_mode == CompileMode.INTERNAL or compile_mode == CompileMode.RELEASE:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-O3", # level 3 optimizations
-        ])
+class TraceSpan:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = dict(args) if args is not None else {}
+        self.start = None
+        self.tid = None
 
-    # Add compiler warning flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-Werror",  # treat warnings as errors
-        "-Wall",    # enable all warnings
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.tid = self.tracer.get_tid()
+        return self
 
-        "-Wno-char-subscripts", # using char as an array subscript
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-Wno-unused-function"  # unused function
-        ])
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add_event(self.name, self.category, self.start,
+            time.perf_counter() - self.start, self.tid, self.args)
+        return False
 
-    # Add include paths
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-I'" + paths["src"] + "'",
-        "-I'" + paths["libs-internal"] + "'"
-    ] + [ "-I'" + path + "'" for path in includeDirs.values() ])
+class BuildTracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.events = []
+        self.thread_ids = {}
+        self.metadata = {} # build settings, for the trace and the summary
+        self.written = False
 
-    # Add all custom defines + compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        target.get_compiler_flags()
-    ])
+    def get_tid(self):
+        with self.lock:
+            ident = threading.get_ident()
+            if ident not in self.thread_ids:
+                self.thread_ids[ident] = len(self.thread_ids) + 1
+            return self.thread_ids[ident]
 
-    linker_flags = ""
+    def span(self, name, category, args=None):
+        return TraceSpan(self, name, category, args)
+
+    def add_event(self, name, category, start, duration, tid, args=None):
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": 1, "tid": tid,
+            "ts": int((start - self.start) * 1000000),
+            "dur": int(duration * 1000000)
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, trace_path, summary_path):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+            thread_names = [
+                { "name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                    "args": { "name": "main" if tid == 1 else "worker {}".format(tid - 1) } }
+                for tid in self.thread_ids.values()
+            ]
+        write_file_atomic(trace_path, json.dumps({
+            "traceEvents": thread_names + events,
+            "displayTimeUnit": "ms",
+            "metadata": self.metadata
+        }).encode("utf-8"))
+        self.written = True
+
+        total_time = time.perf_counter() - self.start
+        category_times = {}
+        for event in events:
+            category_times[event["cat"]] = category_times.get(event["cat"], 0) + event["dur"]
+        lines = ["Build time: {:.2f}s".format(total_time)]
+        lines += ["{}: {}".format(name.capitalize(), value) for name, value in self.metadata.items()]
+        lines += ["", "Time per stage (summed over jobs):"]
+        for category, duration in sorted(category_times.items(), key=lambda c: c[1], reverse=True):
+            lines.append("  {:<24} {:9.2f}s".format(category, duration / 1000000))
+        lines += ["", "Slowest steps:"]
+        top_level = [e for e in events if not e["cat"].startswith("compiler")]
+        for event in sorted(top_level, key=lambda e: e["dur"], reverse=True)[:20]:
+            lines.append("  {:9.2f}s  {:<14} {}".format(
+                event["dur"] / 1000000, event["cat"], event["name"]))
+        with open(summary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+tracer = BuildTracer()
+
+# Collects g++ -ftime-report output (keeping it off the console) or clang
+# -ftime-trace files, and adds them to the build trace
+class CompilerTimeReport:
+    def __init__(self):
+        self.in_report = False
+        self.phases = [] # (name, wall seconds)
+
+    def filter_line(self, line):
+        stripped = line.strip()
+        if stripped.startswith("Time variable"):
+            self.in_report = True
+            return False
+        if not self.in_report:
+            return True
+        if stripped.startswith("TOTAL"):
+            self.in_report = False
+            return False
+
+        # " phase parsing   :   0.51 ( 49%)   0.12 ( 55%)   0.64 ( 50%)  38M ( 56%)"
+        name, _, values = stripped.partition(":")
+        numbers = [v for v in values.replace("(", " ").replace(")", " ").split() if not v.endswith("%")]
+        if len(numbers) >= 3:
+            try:
+                self.phases.append((name.strip(" |"), float(numbers[2])))
+            except ValueError:
+                pass
+        return False
+
+    def add_to_trace(self, span, output_path=None):
+        offset = span.start
+        for name, wall_time in self.phases:
+            if name.startswith("phase "):
+                # Phases run one after the other, so lay them out in order
+                tracer.add_event(name[len("phase "):], "compiler-phase", offset, wall_time, span.tid,
+                    { "target": span.name })
+                offset += wall_time
+        details = sorted([p for p in self.phases if not p[0].startswith("phase ")],
+            key=lambda p: p[1], reverse=True)
+        if details:
+            span.args = dict(span.args or {})
+            span.args["slowest compiler passes"] = {
+                name: round(wall_time, 3) for name, wall_time in details[:10]
+            }
+
+        # clang writes its -ftime-trace next to the output
+        if output_path is not None:
+            trace_file = os.path.splitext(output_path)[0] + ".json"
+            if os.path.exists(trace_file):
+                try:
+                    with open(trace_file, "r") as f:
+                        clang_events = json.load(f).get("traceEvents", [])
+                except ValueError:
+                    clang_events = []
+                for event in clang_events:
+                    if event.get("ph") == "X" and "dur" in event:
+                        tracer.add_event(event["name"], "compiler-trace",
+                            span.start + event["ts"] / 1000000, event["dur"] / 1000000, span.tid,
+                            event.get("args"))
+
+compiler_time_report = False
+
+def get_time_report_flag(compiler):
+    if not compiler_time_report:
+        return None
+    return "-ftime-trace" if "clang" in compiler else "-ftime-report"
+
+class BuildJob:
+    def __init__(self, name, func, depends=[]):
+        self.name = name
+        self.func = func # returns an exit code, 0 on success
+        self.depends = depends
+        self.exit_code = None
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+WATCH_IGNORE_SUFFIXES = ("~", ".swp", ".swx", ".tmp")
+
+def is_watch_ignored(path):
+    name = os.path.basename(path)
+    return name.endswith(WATCH_IGNORE_SUFFIXES) or name.startswith(".#") or name == "4913"
+
+class InotifyWatcher:
+    name = "inotify"
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, roots):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self.watches = {} # watch descriptor -> directory
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, root):
+        import ctypes
+        added_files = set()
+        for dir_path, _, files in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, dir_path.encode("utf-8"), InotifyWatcher.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "Out of inotify watches (fs.inotify.max_user_watches)")
+                continue
+            self.watches[wd] = dir_path
+            added_files.update(os.path.join(dir_path, f) for f in files)
+        return added_files
+
+    def wait(self, timeout):
+        import select
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, _, name_len = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16:offset + 16 + name_len].rstrip(b"\0").decode("utf-8", "replace")
+                offset += 16 + name_len
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped, treat everything as changed
+                    changed.update(self.roots)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                dir_path = self.watches.get(wd)
+                if dir_path is None:
+                    continue
+                path = os.path.join(dir_path, name) if name else dir_path
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.add_tree(path))
+                changed.add(path)
+        return changed
+
+class PollingWatcher:
+    name = "polling"
+
+    def __init__(self, roots, interval=0.5):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for file_path, stat in SourceManifest.walk_files(root):
+                snapshot[file_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return snapshot
+
+    def wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snapshot = self.scan()
+            changed = set(
+                path for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)
+            )
+            self.snapshot = snapshot
+            if changed:
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return set()
+            sleep_time = self.interval
+            if deadline is not None:
+                sleep_time = min(sleep_time, max(0, deadline - time.time()))
+            time.sleep(sleep_time)
+
+def create_watcher(roots):
+    if PLATFORM == Platform.LINUX:
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print("inotify unavailable ({}), falling back to polling".format(str(e)))
+    return PollingWatcher(roots)
+
+# Peak RSS of each job's commands, kept between builds so the scheduler
+# knows how much memory a job is likely to need before starting it.
+# Version 1 peaks counted this process's RSS too, they're dropped.
+RESOURCE_HISTORY_VERSION = 2
+
+class ResourceHistory:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.peak_rss = {}
+        self.updated = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == RESOURCE_HISTORY_VERSION:
+                    self.peak_rss = data.get("peak_rss", {})
+            except ValueError:
+                pass
+
+    def record(self, name, peak_rss):
+        with self.lock:
+            self.updated[name] = max(self.updated.get(name, 0), peak_rss)
+
+    def get_estimate(self, name):
+        with self.lock:
+            if name in self.peak_rss:
+                return self.peak_rss[name]
+            # Never built: assume a typical job
+            known = sorted(self.peak_rss.values())
+            return known[len(known) // 2] if known else 0
+
+    def save(self):
+        with self.lock:
+            self.peak_rss.update(self.updated)
+            self.updated = {}
+            data = json.dumps({ "version": RESOURCE_HISTORY_VERSION, "peak_rss": self.peak_rss },
+                indent=2, sort_keys=True)
+        write_file_atomic(self.path, data.encode("utf-8"))
+
+resource_history = None
+
+MEMORY_RESERVE_FRACTION = 0.05 # of total memory, left for everything else
+THROTTLE_POLL_INTERVAL = 0.25
+
+def read_meminfo():
+    meminfo = {}
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                meminfo[name] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return meminfo
+
+def get_process_tree_rss(pid):
+    # The compiler driver is small, cc1plus and ld are its children
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        with open("/proc/{}/task/{}/children".format(pid, pid), "r") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError, IndexError):
+        return 0
+    return rss + sum(get_process_tree_rss(child) for child in children)
+
+def get_running_rss():
+    rss = {}
+    with running_processes_lock:
+        running = list(running_processes.items())
+    for process, label in running:
+        rss[label] = rss.get(label, 0) + get_process_tree_rss(process.pid)
+    return rss
+
+# Decides whether another job can start. Memory: what running jobs may still
+# grow by (their recorded peak minus what they use now) plus the new job's
+# peak must fit in MemAvailable. Load: like make -l, nothing new starts while
+# the 1-minute load average is at max_load.
+class JobThrottle:
+    def __init__(self, history, max_load=None, memory_reserve=None):
+        self.history = history
+        self.max_load = max_load
+        meminfo = read_meminfo()
+        self.memory_enabled = "MemAvailable" in meminfo
+        if memory_reserve is None:
+            memory_reserve = int(meminfo.get("MemTotal", 0) * MEMORY_RESERVE_FRACTION)
+        self.memory_reserve = memory_reserve
+
+    def check(self, job_name, running_names):
+        if self.max_load and hasattr(os, "getloadavg"):
+            load = os.getloadavg()[0]
+            if load >= self.max_load:
+                return "load", "load average {:.1f} >= {:.1f}".format(load, self.max_load)
+
+        if self.memory_enabled and self.history is not None:
+            available = read_meminfo().get("MemAvailable", 0) - self.memory_reserve
+            running_rss = get_running_rss()
+            growth = sum(max(0, self.history.get_estimate(name) - running_rss.get(name, 0))
+                for name in running_names)
+            needed = self.history.get_estimate(job_name)
+            if needed + growth > available:
+                return "memory", "{} needs ~{:.0f} MB, {:.0f} MB available after running jobs".format(
+                    job_name, needed / (1024 * 1024), max(0, available - growth) / (1024 * 1024))
+        return None
+
+# Client side of the GNU make jobserver. Every job after the first needs a
+# token (one byte) read from make's pipe or fifo, given back when it's done.
+class Jobserver:
+    def __init__(self, read_fd, write_fd, description, pass_fds=()):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.description = description
+        self.pass_fds = pass_fds # what child processes need to reach it too
+        self.max_jobs = None # make's -j, if it says
+
+    def try_acquire(self):
+        try:
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return None
+        return token if token else None
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+def open_nonblocking_fd(fd, mode):
+    # A new open file description, so non-blocking reads don't change the
+    # one make and the other clients share
+    return os.open("/proc/self/fd/{}".format(fd), mode | os.O_NONBLOCK)
+
+def get_jobserver():
+    makeflags = os.environ.get("MAKEFLAGS", "")
+    auth = None
+    max_jobs = None
+    for flag in makeflags.split():
+        for prefix in ["--jobserver-auth=", "--jobserver-fds="]:
+            if flag.startswith(prefix):
+                auth = flag[len(prefix):]
+        if flag.startswith("-j") and flag[2:].isdigit():
+            max_jobs = int(flag[2:])
+    if auth is None or PLATFORM == Platform.WINDOWS:
+        return None
+
+    try:
+        if auth.startswith("fifo:"):
+            fifo_path = auth[len("fifo:"):]
+            read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(fifo_path, os.O_WRONLY)
+            server = Jobserver(read_fd, write_fd, fifo_path)
+        else:
+            read_fd, write_fd = [int(fd) for fd in auth.split(",")]
+            if read_fd < 0 or write_fd < 0:
+                return None
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+            server = Jobserver(open_nonblocking_fd(read_fd, os.O_RDONLY), write_fd,
+                "fds {},{}".format(read_fd, write_fd), (read_fd, write_fd))
+        server.max_jobs = max_jobs
+        return server
+    except (OSError, ValueError):
+        print("Warning: make's jobserver isn't reachable (is the recipe missing a '+'?), "
+            "ignoring it")
+        return None
+
+jobserver = None
+
+class BuildScheduler:
+    def __init__(self, num_jobs=1, fail_fast=False, throttle=None, jobserver=None):
+        self.num_jobs = max(1, num_jobs)
+        self.fail_fast = fail_fast
+        self.throttle = throttle
+        self.jobserver = jobserver
+        self.tokens = [] # jobserver tokens held, one per running job after the first
+        self.jobs = {}
+
+    def add_job(self, name, func, depends=[]):
+        if name in self.jobs:
+            raise Exception("Duplicate build job: {}".format(name))
+        self.jobs[name] = BuildJob(name, func, depends)
+        return self.jobs[name]
+
+    def check_dependencies(self):
+        for job in self.jobs.values():
+            for dep in job.depends:
+                if dep not in self.jobs:
+                    raise Exception("Build job {} depends on unknown job {}".format(job.name, dep))
+
+        # Depth-first search for cycles
+        visiting = set()
+        visited = set()
+        def visit(name, chain):
+            if name in visiting:
+                raise Exception("Dependency cycle: {}".format(" -> ".join(chain + [name])))
+            if name in visited:
+                return
+            visiting.add(name)
+            for dep in self.jobs[name].depends:
+                visit(dep, chain + [name])
+            visiting.remove(name)
+            visited.add(name)
+        for name in self.jobs:
+            visit(name, [])
+
+    def run_job(self, job, done_queue):
+        exit_code = 1
+        try:
+            exit_code = job.func()
+            if exit_code is None:
+                exit_code = 0
+        except Exception as e:
+            print_job_line(job.name, "Build job failed: {}".format(str(e)))
+        finally:
+            # Always report back, even if printing failed (closed stdout), or
+            # the scheduler waits forever
+            done_queue.put((job, exit_code))
+
+    def run(self):
+        self.check_dependencies()
+        build_cancelled.clear()
+
+        global prefix_output
+        prefix_output = self.num_jobs > 1 and len(self.jobs) > 1
+
+        done_queue = queue.Queue()
+        pending = list(self.jobs.values())
+        running = set()
+        first_failure = 0
+        self.waits = {} # reason -> seconds spent throttled
+        last_reason = None
+        try:
+            while pending or running:
+                # Jobs whose dependencies failed or were skipped never run
+                for job in list(pending):
+                    failed_deps = [
+                        dep for dep in job.depends
+                        if self.jobs[dep].exit_code is not None and self.jobs[dep].exit_code != 0
+                    ]
+                    if failed_deps or build_cancelled.is_set():
+                        job.exit_code = -1
+                        pending.remove(job)
+                        if failed_deps:
+                            print_job_line(job.name, "Skipped, dependency failed: {}".format(
+                                ", ".join(failed_deps)))
+
+                throttled = None
+                for job in list(pending):
+                    if len(running) >= self.num_jobs:
+                        break
+                    if not all(self.jobs[dep].exit_code == 0 for dep in job.depends):
+                        continue
+                    # The first job always runs (on make's implicit token), so a
+                    # throttled build still makes progress
+                    if running:
+                        if self.throttle is not None:
+                            throttled = self.throttle.check(job.name, running)
+                            if throttled is not None:
+                                break
+                        if self.jobserver is not None and len(self.tokens) < len(running):
+                            token = self.jobserver.try_acquire()
+                            if token is None:
+                                throttled = ("jobserver", "waiting for a token from make")
+                                break
+                            self.tokens.append(token)
+                    pending.remove(job)
+                    running.add(job.name)
+                    threading.Thread(target=self.run_job, args=(job, done_queue),
+                        daemon=True).start()
+
+                if not running:
+                    continue
+
+                if throttled is None:
+                    job, exit_code = done_queue.get()
+                else:
+                    reason, message = throttled
+                    if reason != last_reason:
+                        print_job_line(None, "Throttling: " + message)
+                        last_reason = reason
+                    wait_start = time.perf_counter()
+                    try:
+                        job, exit_code = done_queue.get(timeout=THROTTLE_POLL_INTERVAL)
+                    except queue.Empty:
+                        job = None
+                    self.waits[reason] = self.waits.get(reason, 0.0) \
+                        + time.perf_counter() - wait_start
+                    if job is None:
+                        continue
+
+                running.discard(job.name)
+                while len(self.tokens) > max(0, len(running) - 1):
+                    self.jobserver.release(self.tokens.pop())
+                job.exit_code = exit_code
+                if exit_code != 0:
+                    if build_cancelled.is_set() and exit_code < 0:
+                        print_job_line(job.name, "Cancelled")
+                        continue
+                    print_job_line(job.name, "Failed with exit code {}".format(exit_code))
+                    if first_failure == 0:
+                        first_failure = exit_code
+                    if self.fail_fast:
+                        cancel_running_commands()
+        finally:
+            while self.tokens:
+                self.jobserver.release(self.tokens.pop())
+
+        if self.waits:
+            print("Throttled for " + ", ".join("{:.1f}s on {}".format(duration, reason)
+                for reason, duration in sorted(self.waits.items())))
+        if first_failure == 0 and any(job.exit_code != 0 for job in self.jobs.values()):
+            first_failure = 1
+        return first_failure
+
+compiler_versions = {}
+compiler_versions_lock = threading.Lock()
+
+def get_compiler_version(compiler):
+    with compiler_versions_lock:
+        if compiler not in compiler_versions:
+            try:
+                result = subprocess.run([compiler, "--version"],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                compiler_versions[compiler] = result.stdout.decode("utf-8", "replace")
+            except OSError:
+                compiler_versions[compiler] = None
+        return compiler_versions[compiler]
+
+def write_file_atomic(path, data):
+    tmp_path = "{}.tmp{}.{}".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class CompileCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stats_path = os.path.join(self.path, "stats.json")
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Running total from the size found by the last eviction, so stores
+        # only walk the cache once it's likely over max_size
+        self.size = self.load_stats().get("size", 0)
+
+    def get_key(self, compiler, compiler_flags, compile_command, src_name, compile_mode,
+        link_inputs=[]):
+        version = get_compiler_version(compiler)
+        if version is None:
+            return None
+
+        key = hashlib.sha256()
+        key.update(version.encode("utf-8"))
+        key.update(compile_mode.name.encode("utf-8"))
+        key.update(command_to_string(compile_command).encode("utf-8"))
+
+        # Libraries linked into the output and PGO profiles, by content
+        for link_input in link_inputs:
+            try:
+                key.update(hash_file(link_input, "sha256").encode("utf-8"))
+            except OSError:
+                return None
+
+        # Hash the preprocessed translation unit, so header edits change the key
+        preprocess_command = [compiler] + compiler_flags + ["-E", src_name]
+        try:
+            process = subprocess.Popen(preprocess_command, cwd=paths["build"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):
+            key.update(chunk)
+        if process.wait() != 0:
+            return None
+
+        return key.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    # Extra outputs (.dwo files) are stored next to the entry, by extension
+    def restore(self, key, output_path, extra_outputs=[]):
+        entry_path = self.get_entry_path(key)
+        restores = [(entry_path, output_path)] + [
+            (entry_path + os.path.splitext(extra)[1], extra) for extra in extra_outputs
+        ]
+        try:
+            for src_path, dst_path in restores:
+                os.utime(src_path) # mark as recently used
+                shutil.copy2(src_path, dst_path + ".restore")
+        except OSError:
+            # Missing, or just evicted by another build sharing the cache
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        for _, dst_path in restores:
+            os.replace(dst_path + ".restore", dst_path)
+        return True
+
+    def store(self, key, output_path, extra_outputs=[], evict=True):
+        if not all(os.path.exists(extra) for extra in extra_outputs):
+            return
+        entry_path = self.get_entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+
+        stores = [(output_path, entry_path)] + [
+            (extra, entry_path + os.path.splitext(extra)[1]) for extra in extra_outputs
+        ]
+        # Extra outputs first, so a complete entry exists once the main one does
+        stored_size = 0
+        for src_path, dst_path in reversed(stores):
+            tmp_path = "{}.tmp{}.{}".format(dst_path, os.getpid(), threading.get_ident())
+            shutil.copy2(src_path, tmp_path)
+            stored_size += os.path.getsize(tmp_path)
+            os.replace(tmp_path, dst_path)
+            os.utime(dst_path)
+        with self.lock:
+            self.size += stored_size
+            over_limit = self.size > self.max_size
+        if evict and over_limit:
+            self.evict()
+
+    def get_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.path):
+            if root == self.path:
+                continue
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        return entries
+
+    # Walks the whole cache, so it's done at the end of a build, or when the
+    # running total says the cache has grown past max_size
+    def evict(self):
+        with self.evict_lock:
+            entries = sorted(self.get_entries())
+            total_size = sum(size for _, size, _ in entries)
+            # Least recently used entries go first
+            for _, size, file_path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(file_path)
+                    total_size -= size
+                except OSError:
+                    pass
+            with self.lock:
+                self.size = total_size
+
+    def load_stats(self):
+        stats = { "hits": 0, "misses": 0 }
+        if os.path.exists(self.stats_path):
+            try:
+                with open(self.stats_path, "r") as f:
+                    stats.update(json.load(f))
+            except ValueError:
+                pass
+        return stats
+
+    def save_stats(self):
+        # Adds this build's counters to the totals and starts counting again
+        with self.lock:
+            stats = self.load_stats()
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+            stats["size"] = self.size
+            write_file_atomic(self.stats_path, json.dumps(stats).encode("utf-8"))
+            stats["build_hits"] = self.hits
+            stats["build_misses"] = self.misses
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+    def print_stats(self):
+        self.evict()
+        stats = self.save_stats()
+        print("Compile cache: {} hits, {} misses this build ({} hits, {} misses total), {:.1f} / {:.1f} MB".format(
+            stats["build_hits"], stats["build_misses"], stats["hits"], stats["misses"],
+            stats["size"] / (1024 * 1024), self.max_size / (1024 * 1024)))
+
+compile_cache = None
+
+# Object compiles (distribute=True) may be sent to a compile worker. Anything
+# else, like a combined compile and link, always runs here.
+def run_compile(compiler, compiler_flags, compile_command, src_name, output_name, label,
+    line_filter=None, distribute=False):
+    if distribute and worker_pool is not None:
+        result = worker_pool.compile(compiler, compiler_flags, src_name, output_name, label,
+            line_filter)
+        if result is not None:
+            return result
+    return run_process(compile_command, paths["build"], label, line_filter)
+
+def run_cached_compile(compiler, compiler_flags, compile_command, src_name, output_name,
+    compile_mode, label, line_filter=None, distribute=False, link_inputs=[]):
+    if compile_cache is None:
+        return run_compile(compiler, compiler_flags, compile_command, src_name, output_name,
+            label, line_filter, distribute), False
+
+    key = compile_cache.get_key(compiler, compiler_flags, compile_command, src_name, compile_mode,
+        link_inputs)
+    if key is None:
+        # Let the real compile report whatever went wrong
+        return run_process(compile_command, paths["build"], label, line_filter), False
+
+    output_path = os.path.join(paths["build"], output_name)
+    extra_outputs = get_split_dwarf_outputs(compiler_flags, output_path)
+    # Callers print the status line, so a restored object gets just one
+    if compile_cache.restore(key, output_path, extra_outputs):
+        return ProcessResult(0), True
+
+    # Don't let a stale .dwo be stored with an object built without one (on a worker)
+    for extra in extra_outputs:
+        if os.path.exists(extra):
+            os.remove(extra)
+    result = run_compile(compiler, compiler_flags, compile_command, src_name, output_name, label,
+        line_filter, distribute)
+    if result.exit_code == 0 and os.path.exists(output_path):
+        compile_cache.store(key, output_path, extra_outputs)
+    return result, False
+
+# Compile workers (distcc style): the driver preprocesses each object locally,
+# a worker compiles the preprocessed source and sends the object back, and
+# the link stays local. Messages are a 4-byte header length, a JSON header
+# and "size" bytes of payload.
+WORKER_PROTOCOL_VERSION = 1
+WORKER_DEFAULT_PORT = 3633
+WORKER_CONNECT_TIMEOUT = 5.0
+WORKER_TIMEOUT = 600.0
+WORKER_RETRY_DELAY = 30.0 # seconds before a failed worker is tried again
+WORKER_MAX_HEADER_SIZE = 1024 * 1024
+
+# Only matter to the preprocessor, which already ran on the driver
+PREPROCESSOR_FLAGS = ["-MD", "-MMD", "-MP", "-Winvalid-pch", "-E", "-c"]
+PREPROCESSOR_FLAGS_WITH_VALUE = ["-include", "-iquote", "-isystem", "-idirafter", "-MF", "-MT",
+    "-MQ", "-x", "-o"]
+PREPROCESSOR_FLAG_PREFIXES = ["-D", "-U", "-I"]
+# Write files next to the (temporary) output, they'd be lost on the worker
+LOCAL_ONLY_FLAGS = ["-ftime-trace", "-gsplit-dwarf"]
+# Workers only take code generation flags...
+WORKER_ALLOWED_FLAGS = ["-pg", "-w", "-pedantic"]
+WORKER_ALLOWED_FLAG_PREFIXES = ["-O", "-f", "-m", "-W", "-g", "-std=", "-D", "-U"]
+# ...and not the ones among them that load code, pass options on to other
+# programs, or read and write files of their own
+WORKER_BLOCKED_FLAG_PREFIXES = ["-fplugin", "-Wa,", "-Wl,", "-Wp,", "-fauto-profile",
+    "-fprofile-use", "-fprofile-sample-use", "-fprofile-instr-use", "-fprofile-dir",
+    "-fprofile-remapping-file", "-fprofile-list", "-fdump-", "-fcrash-diagnostics-dir"]
+# Map one path prefix to another in the output, they don't touch files
+WORKER_PATH_MAP_FLAG_PREFIXES = ["-fdebug-prefix-map=", "-ffile-prefix-map=",
+    "-fmacro-prefix-map=", "-fprofile-prefix-map="]
+
+def check_worker_flag(flag):
+    if flag not in WORKER_ALLOWED_FLAGS \
+    and not any(flag.startswith(prefix) for prefix in WORKER_ALLOWED_FLAG_PREFIXES):
+        return "Flag not allowed on compile workers: " + flag
+    if any(flag.startswith(prefix) for prefix in WORKER_BLOCKED_FLAG_PREFIXES):
+        return "Flag not allowed on compile workers: " + flag
+    # Anything else with a path in it (-fprofile-generate=/dir, -fsanitize-ignorelist=...)
+    if flag.startswith("-f") and "=" in flag \
+    and not any(flag.startswith(prefix) for prefix in WORKER_PATH_MAP_FLAG_PREFIXES):
+        value = flag.split("=", 1)[1]
+        if "/" in value or "\\" in value or value.startswith((".", "~")):
+            return "Flag with a path not allowed on compile workers: " + flag
+    return None
+
+def send_message(sock, header, payload=b""):
+    header = dict(header)
+    header["size"] = len(payload)
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(data)) + data)
+    if payload:
+        sock.sendall(payload)
+
+def recv_exact(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def recv_message(sock):
+    header_size, = struct.unpack("!I", recv_exact(sock, 4))
+    if header_size > WORKER_MAX_HEADER_SIZE:
+        raise ValueError("Message header too large: {} bytes".format(header_size))
+    header = json.loads(recv_exact(sock, header_size).decode("utf-8"))
+    return header, recv_exact(sock, header.get("size", 0))
+
+def get_remote_compile_flags(compiler_flags):
+    flags = []
+    skip_next = False
+    for flag in compiler_flags:
+        if skip_next:
+            skip_next = False
+        elif flag in PREPROCESSOR_FLAGS or flag in LOCAL_ONLY_FLAGS:
+            pass
+        elif flag in PREPROCESSOR_FLAGS_WITH_VALUE:
+            skip_next = True
+        elif any(flag.startswith(prefix) for prefix in PREPROCESSOR_FLAG_PREFIXES):
+            # "-I dir" has its value in the next argument, "-Idir" doesn't
+            skip_next = flag in PREPROCESSOR_FLAG_PREFIXES
+        else:
+            flags.append(flag)
+    return flags
+
+class CompileWorker:
+    def __init__(self, host, port, max_jobs=None):
+        self.host = host
+        self.port = port
+        self.address = "{}:{}".format(host, port)
+        self.cap = max_jobs # from --workers, None to use what the worker reports
+        self.max_jobs = max_jobs if max_jobs is not None else 1
+        self.active = 0
+        self.failed_until = 0.0
+        self.compatible = {} # compiler -> same version as ours
+        self.compiled = 0
+        self.failures = 0
+        self.sent_bytes = 0
+        self.compile_time = 0.0
+
+    def request(self, header, payload=b""):
+        with socket.create_connection((self.host, self.port), WORKER_CONNECT_TIMEOUT) as sock:
+            sock.settimeout(WORKER_TIMEOUT)
+            send_message(sock, header, payload)
+            response, response_payload = recv_message(sock)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response, response_payload
+
+def parse_worker_address(spec):
+    address, _, max_jobs = spec.partition("/")
+    host, _, port = address.rpartition(":")
+    if not host:
+        host, port = address, str(WORKER_DEFAULT_PORT)
+    if not port.isdigit() or (max_jobs and not max_jobs.isdigit()):
+        raise Exception("Invalid worker \"{}\", expected host[:port][/max jobs]".format(spec))
+    return CompileWorker(host, int(port), int(max_jobs) if max_jobs else None)
+
+class WorkerPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.local_fallbacks = 0
+
+    def probe(self):
+        for worker in self.workers:
+            try:
+                response, _ = worker.request({ "type": "hello" })
+                if response.get("protocol") != WORKER_PROTOCOL_VERSION:
+                    raise ValueError("protocol version {}, expected {}".format(
+                        response.get("protocol"), WORKER_PROTOCOL_VERSION))
+                if worker.cap is None:
+                    worker.max_jobs = response.get("jobs", 1)
+                print("Compile worker {}: up to {} jobs".format(worker.address, worker.max_jobs))
+            except (OSError, ValueError) as e:
+                self.mark_failed(worker, e)
+
+    def mark_failed(self, worker, error):
+        with self.lock:
+            worker.failures += 1
+            worker.failed_until = time.time() + WORKER_RETRY_DELAY
+        print_job_line(None, "Compile worker {} failed: {}".format(worker.address, str(error)))
+
+    # Least loaded worker that has a free slot and can use this compiler
+    def acquire(self, compiler):
+        with self.lock:
+            now = time.time()
+            candidates = [worker for worker in self.workers
+                if worker.active < worker.max_jobs and worker.failed_until <= now
+                and worker.compatible.get(compiler, True)]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda worker: worker.active / worker.max_jobs)
+            worker.active += 1
+            return worker
+
+    def release(self, worker):
+        with self.lock:
+            worker.active -= 1
+
+    def check_compiler(self, worker, compiler):
+        if compiler not in worker.compatible:
+            response, _ = worker.request({ "type": "version", "compiler": compiler })
+            compatible = response.get("version") == get_compiler_version(compiler)
+            if not compatible:
+                print_job_line(None, "Compile worker {} has a different {}, not using it".format(
+                    worker.address, compiler))
+            with self.lock:
+                worker.compatible[compiler] = compatible
+        return worker.compatible[compiler]
+
+    # Returns None when no worker could take the compile, so it runs locally
+    def compile(self, compiler, compiler_flags, src_name, output_name, label, line_filter=None):
+        output_path = os.path.join(paths["build"], output_name)
+        remote_flags = get_remote_compile_flags(compiler_flags)
+        if any(check_worker_flag(flag) is not None for flag in remote_flags):
+            # Workers would refuse it (profile paths, target flags with files)
+            with self.lock:
+                self.local_fallbacks += 1
+            return None
+        while True:
+            worker = self.acquire(compiler)
+            if worker is None:
+                with self.lock:
+                    self.local_fallbacks += 1
+                return None
+            try:
+                if self.check_compiler(worker, compiler):
+                    break
+            except (OSError, ValueError) as e:
+                self.mark_failed(worker, e)
+            self.release(worker)
+
+        try:
+            # Preprocess here, with the project's headers. This also writes the depfile.
+            suffix = ".i" if src_name.endswith(".c") else ".ii"
+            preprocessed_path = output_path + suffix
+            result = run_process([compiler] + compiler_flags + ["-E", src_name,
+                "-o", preprocessed_path], paths["build"], label, line_filter)
+            if result.exit_code != 0:
+                return result
+            with open(preprocessed_path, "rb") as f:
+                source = f.read()
+            os.remove(preprocessed_path)
+
+            start = time.perf_counter()
+            try:
+                response, obj = worker.request({
+                    "type": "compile",
+                    "compiler": compiler,
+                    "flags": remote_flags,
+                    "suffix": suffix
+                }, source)
+            except (OSError, ValueError) as e:
+                self.mark_failed(worker, e)
+                with self.lock:
+                    self.local_fallbacks += 1
+                print_job_line(label, "Compiling locally instead")
+                return None
+
+            log_path = get_log_path(label)
+            with open_job_log(log_path) as log_file:
+                log_file.write("$ [{}] {}\n".format(worker.address,
+                    command_to_string([compiler] + remote_flags + ["-c", "-"])))
+                for line in response["output"].splitlines():
+                    log_file.write(line + "\n")
+                    if line_filter is None or line_filter(line):
+                        print_job_line(label, line)
+                result = ProcessResult(response["exit_code"], time.perf_counter() - start,
+                    response["cpu_time"], response["peak_rss"], log_path, worker.address)
+                log_file.write("# {}\n".format(result.summary()))
+
+            if result.exit_code == 0:
+                write_file_atomic(output_path, obj)
+            with self.lock:
+                worker.compiled += 1
+                worker.sent_bytes += len(source)
+                worker.compile_time += result.wall_time
+            return result
+        finally:
+            self.release(worker)
+
+    def print_stats(self):
+        with self.lock:
+            for worker in self.workers:
+                print("Compile worker {}: {} objects, {:.1f} MB sent, {:.2f}s, {} failures".format(
+                    worker.address, worker.compiled, worker.sent_bytes / (1024 * 1024),
+                    worker.compile_time, worker.failures))
+                worker.compiled = 0
+                worker.sent_bytes = 0
+                worker.compile_time = 0.0
+                worker.failures = 0
+            if self.local_fallbacks > 0:
+                print("{} objects compiled locally, no worker was free or could take them".format(
+                    self.local_fallbacks))
+            self.local_fallbacks = 0
+
+worker_pool = None
+
+# Compilers worker mode runs, by resolved path: the ones found on PATH and
+# the ones given with --worker-compilers
+def get_worker_compilers(extra_compilers=[]):
+    compilers = set()
+    for name in GCC_NAMES + CLANG_NAMES + extra_compilers:
+        path = shutil.which(name)
+        if path is not None:
+            compilers.add(os.path.realpath(path))
+    return compilers
+
+# Path of a requested compiler on this worker, None if it isn't one of them.
+# The requested name is kept, compilers print it in --version.
+def resolve_worker_compiler(compiler, compilers):
+    path = shutil.which(compiler) if compiler else None
+    if path is None or os.path.realpath(path) not in compilers:
+        return None
+    return path
+
+def check_worker_request(header):
+    for flag in header.get("flags", []):
+        error = check_worker_flag(flag)
+        if error is not None:
+            return error
+    if header.get("suffix", ".ii") not in [".i", ".ii"]:
+        return "Unsupported source suffix: " + header["suffix"]
+    return None
+
+def worker_compile(compiler, header, source):
+    with tempfile.TemporaryDirectory(prefix="km_compile_worker_") as tmp_dir:
+        src_path = os.path.join(tmp_dir, "unit" + header.get("suffix", ".ii"))
+        obj_path = os.path.join(tmp_dir, "unit.o")
+        with open(src_path, "wb") as f:
+            f.write(source)
+
+        command = [compiler] + header.get("flags", []) + ["-c", src_path, "-o", obj_path]
+        start = time.perf_counter()
+        try:
+            process = subprocess.Popen(command, cwd=tmp_dir,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            return { "error": "Failed to run {}: {}".format(command[0], str(e)) }, b""
+        rss_sampler = start_rss_sampler(process)
+        output = process.stdout.read()
+        process.stdout.close()
+        exit_code, cpu_time, peak_rss = wait_for_process(process, rss_sampler)
+
+        obj = b""
+        if exit_code == 0:
+            try:
+                with open(obj_path, "rb") as f:
+                    obj = f.read()
+            except OSError as e:
+                return { "error": "{} exited with 0 but wrote no object: {}".format(
+                    command[0], str(e)) }, b""
+        return {
+            "exit_code": exit_code,
+            "output": output.decode("utf-8", "replace"),
+            "wall_time": time.perf_counter() - start,
+            "cpu_time": cpu_time,
+            "peak_rss": peak_rss
+        }, obj
+
+class CompileWorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(WORKER_TIMEOUT)
+        try:
+            header, payload = recv_message(self.request)
+            request_type = header.get("type")
+            if request_type == "hello":
+                send_message(self.request, {
+                    "protocol": WORKER_PROTOCOL_VERSION,
+                    "jobs": self.server.max_jobs,
+                    "platform": PLATFORM.value
+                })
+                return
+
+            compiler = resolve_worker_compiler(header.get("compiler"), self.server.compilers)
+            if request_type == "version":
+                # No version for compilers this worker doesn't run, so it isn't used for them
+                send_message(self.request, {
+                    "version": get_compiler_version(compiler) if compiler is not None else None
+                })
+                return
+
+            error = check_worker_request(header)
+            if error is None and compiler is None:
+                error = "Compiler not available on this worker: {}".format(header.get("compiler"))
+            if error is not None:
+                send_message(self.request, { "error": error })
+            elif request_type == "compile":
+                with self.server.slots:
+                    response, obj = worker_compile(compiler, header, payload)
+                print_job_line(None, "{}: {} KB -> exit code {} in {:.2f}s".format(
+                    self.client_address[0], len(payload) // 1024, response.get("exit_code"),
+                    response.get("wall_time", 0.0)))
+                send_message(self.request, response, obj)
+            else:
+                send_message(self.request, { "error": "Unknown request: {}".format(request_type) })
+        except (OSError, ValueError) as e:
+            print_job_line(None, "{}: {}".format(self.client_address[0], str(e)))
+
+class CompileWorkerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, max_jobs, compilers):
+        super().__init__(address, CompileWorkerHandler)
+        self.max_jobs = max_jobs
+        self.compilers = compilers
+        self.slots = threading.Semaphore(max_jobs)
+
+def run_worker(bind, port, max_jobs, extra_compilers=[]):
+    if PLATFORM == Platform.WINDOWS:
+        raise Exception("Compile workers aren't supported on Windows")
+    compilers = get_worker_compilers(extra_compilers)
+    if not compilers:
+        raise Exception("No compilers found for the worker to run")
+    server = CompileWorkerServer((bind, port), max_jobs, compilers)
+    print("Compile worker listening on {}:{}, up to {} jobs".format(bind, port, max_jobs))
+    print("Compilers: " + ", ".join(sorted(compilers)))
+    if bind not in ["127.0.0.1", "localhost", "::1"]:
+        print("Warning: anyone who can reach this port can run the compiler on this machine")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+def parse_depfile(depfile_path):
+    with open(depfile_path, "r") as f:
+        contents = f.read().replace("\\\n", " ")
+
+    deps = []
+    for line in contents.splitlines():
+        if ":" not in line:
+            continue
+        # Skip the rule target, then split on whitespace that isn't escaped
+        _, _, line_deps = line.partition(": ")
+        dep = ""
+        i = 0
+        while i < len(line_deps):
+            c = line_deps[i]
+            if c == "\\" and i + 1 < len(line_deps) and line_deps[i + 1] == " ":
+                dep += " "
+                i += 1
+            elif c.isspace():
+                if dep:
+                    deps.append(dep)
+                dep = ""
+            else:
+                dep += c
+            i += 1
+        if dep:
+            deps.append(dep)
+
+    return [os.path.normpath(dep) for dep in deps]
+
+def hash_string(string):
+    return hashlib.md5(string.encode("utf-8")).hexdigest()
+
+class DependencyGraph:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.targets = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.targets = json.load(f)
+            except ValueError:
+                print("Dependency graph {} is corrupt, rebuilding everything".format(self.path))
+
+    def get_rebuild_reasons(self, name, compiler, command, output_path):
+        with self.lock:
+            entry = self.targets.get(name)
+        if entry is None:
+            return ["no previous build recorded"]
+
+        reasons = []
+        if not os.path.exists(output_path):
+            reasons.append("output {} is missing".format(os.path.basename(output_path)))
+        if entry["command"] != hash_string(command_to_string(command)):
+            reasons.append("compiler or linker flags changed")
+        if entry["toolchain"] != hash_string(get_compiler_version(compiler) or ""):
+            reasons.append("toolchain changed")
+        if entry.get("algorithm") != hash_algorithm:
+            reasons.append("hash algorithm changed")
+            return reasons
+
+        for dep, digest in entry["inputs"].items():
+            if not os.path.exists(dep):
+                reasons.append("{} was removed".format(dep))
+            elif get_source_manifest().get_digest(dep) != digest:
+                reasons.append("{} changed".format(dep))
+
+        return reasons
+
+    def record(self, name, compiler, command, depfile_path, extra_inputs=[]):
+        inputs = {}
+        deps = parse_depfile(depfile_path) if depfile_path is not None else []
+        for dep in deps + extra_inputs:
+            if os.path.isfile(dep):
+                inputs[dep] = get_source_manifest().get_digest(dep)
+
+        with self.lock:
+            self.targets[name] = {
+                "command": hash_string(command_to_string(command)),
+                "toolchain": hash_string(get_compiler_version(compiler) or ""),
+                "algorithm": hash_algorithm,
+                "inputs": inputs
+            }
+            write_file_atomic(self.path, json.dumps(self.targets, indent=1).encode("utf-8"))
+
+    def get_nodes_using(self, file_paths):
+        file_paths = set(file_paths)
+        with self.lock:
+            return [
+                name for name, entry in self.targets.items()
+                if not file_paths.isdisjoint(entry["inputs"])
+            ]
+
+    def get_nodes_using_dirs(self, dir_paths):
+        dir_paths = tuple(os.path.join(dir_path, "") for dir_path in dir_paths)
+        with self.lock:
+            return [
+                name for name, entry in self.targets.items()
+                if any(dep.startswith(dir_paths) for dep in entry["inputs"])
+            ]
+
+    def has_node(self, name):
+        with self.lock:
+            return name in self.targets
+
+    def forget(self, name):
+        with self.lock:
+            if name in self.targets:
+                del self.targets[name]
+                write_file_atomic(self.path, json.dumps(self.targets, indent=1).encode("utf-8"))
+
+dependency_graph = None
+
+def unix_compile_and_link(target, compile_mode, compiler, compiler_flags, linker_flags,
+    if_changed, pch=None):
+    exe_name = target.get_output_name()
+    exe_path = os.path.join(paths["build"], exe_name)
+    src_name = os.path.join(paths["root"], target.source_file)
+    depfile_path = os.path.join(paths["build-deps"], target.name + ".d")
+
+    # Have the compiler list every file it reads. The cache's preprocessing
+    # pass writes the same depfile, so cache hits still record dependencies.
+    compiler_flags = compiler_flags + ["-MD", "-MF", depfile_path]
+
+    time_report_flag = get_time_report_flag(compiler)
+    if time_report_flag is not None:
+        compiler_flags = compiler_flags + [time_report_flag]
+
+    compile_command = [compiler] + compiler_flags + [src_name, "-o", exe_name] + linker_flags
+
+    if if_changed:
+        reasons = dependency_graph.get_rebuild_reasons(target.name, compiler, compile_command,
+            exe_path)
+        if not reasons:
+            print_job_line(target.name, "No changes, nothing to compile")
+            return 0
+        print_job_line(target.name, "Rebuilding: " + "; ".join(reasons))
+
+    link_inputs = get_link_inputs(target, compile_mode) + get_pgo_profile_files(target,
+        compile_mode)
+    time_report = CompilerTimeReport()
+    with tracer.span(target.name, "compile+link", { "mode": compile_mode.name }) as span:
+        result, restored = run_cached_compile(compiler, compiler_flags, compile_command,
+            src_name, exe_name, compile_mode, target.name, time_report.filter_line,
+            link_inputs=link_inputs)
+        span.args.update(result.to_trace_args())
+        span.args["cached"] = restored
+        if time_report_flag is not None:
+            time_report.add_to_trace(span, exe_path)
+    exit_code = result.exit_code
+    if restored:
+        print_job_line(target.name, "Restored {} from compile cache".format(exe_name))
+    elif pch is not None and exit_code == 0:
+        pch.report_saving(target.name)
+
+    # Compiles that use a .gch leave its headers out of the depfile
+    extra_inputs = [pch.gch_path] if pch is not None else []
+    if exit_code == 0 and os.path.exists(depfile_path):
+        dependency_graph.record(target.name, compiler, compile_command, depfile_path,
+            extra_inputs + link_inputs)
+    else:
+        dependency_graph.forget(target.name)
+    return exit_code
+
+UNITY_SOURCE_EXTENSIONS = (".cpp", ".cc", ".cxx", ".c")
+
+class SourceShard:
+    def __init__(self, target_name, name, src_path, include_dir=None):
+        self.name = name
+        self.src_path = src_path
+        self.include_dir = include_dir # for quoted includes of generated shards
+        self.job_name = target_name + "/" + name
+        self.obj_path = os.path.join(paths["build-obj"], target_name, name + ".o")
+        self.depfile_path = os.path.join(paths["build-deps"], target_name, name + ".d")
+
+def parse_unity_include(line):
+    stripped = line.strip()
+    if not stripped.startswith("#"):
+        return None
+    stripped = stripped[1:].strip()
+    if not stripped.startswith("include"):
+        return None
+    included = stripped[len("include"):].strip()
+    if len(included) < 2 or included[0] != "\"" or "\"" not in included[1:]:
+        return None
+    included = included[1:included.index("\"", 1)]
+    if not included.endswith(UNITY_SOURCE_EXTENSIONS):
+        return None
+    return included
+
+# Whether the next line starts inside a /* */ comment, skipping // comments
+# and string literals
+def update_block_comment_state(line, in_comment):
+    i = 0
+    quote = None
+    while i < len(line):
+        pair = line[i:i + 2]
+        if in_comment:
+            if pair == "*/":
+                in_comment = False
+                i += 1
+        elif quote is not None:
+            if line[i] == "\\":
+                i += 1
+            elif line[i] == quote:
+                quote = None
+        elif pair == "//":
+            break
+        elif pair == "/*":
+            in_comment = True
+            i += 1
+        elif line[i] in "\"'":
+            quote = line[i]
+        i += 1
+    return in_comment
+
+def write_file_if_changed(path, contents):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == contents:
+                return
+    with open(path, "w") as f:
+        f.write(contents)
+
+def split_unity_file(target, num_shards):
+    unity_path = os.path.join(paths["root"], target.source_file)
+    unity_dir = os.path.dirname(unity_path)
+    with open(unity_path, "r") as f:
+        lines = f.read().splitlines()
+
+    units = [] # (line index, absolute path)
+    directives = set() # preprocessor lines, with continuations
+    in_comment = False
+    continued = False
+    for i, line in enumerate(lines):
+        if continued or (not in_comment and line.strip().startswith("#")):
+            directives.add(i)
+            continued = line.endswith("\\")
+            included = parse_unity_include(line)
+            if included is not None:
+                units.append((i, os.path.normpath(os.path.join(unity_dir, included))))
+        in_comment = update_block_comment_state(line, in_comment)
+    num_shards = min(num_shards, len(units))
+    if num_shards <= 1:
+        return None
+
+    # By a hash of the unit's path, so adding or removing a unit doesn't move
+    # the others to a different shard and force those to recompile
+    unit_shards = {
+        i: int(hash_string(os.path.relpath(unit_path, paths["root"])), 16) % num_shards
+        for i, unit_path in units
+    }
+
+    # Each shard keeps every preprocessor line, so defines and includes between
+    # units still apply in the same order. Other code in the unity file (main(),
+    # globals) is compiled once, in the shard of the unit before it.
+    shard_dir = os.path.join(paths["build-shards"], target.name)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    unit_paths = dict(units)
+    shards = []
+    for shard_index in range(num_shards):
+        # Code before the first unit goes in shard 0, other shards need a unit
+        if shard_index != 0 and shard_index not in unit_shards.values():
+            continue
+        # Diagnostics point at the unity file, with its line numbers
+        shard_lines = ["#line 1 \"{}\"".format(unity_path.replace("\\", "\\\\"))]
+        code_shard = 0
+        for i, line in enumerate(lines):
+            if i in unit_paths:
+                code_shard = unit_shards[i]
+                if code_shard == shard_index:
+                    shard_lines.append("#include \"{}\"".format(unit_paths[i]))
+                else:
+                    shard_lines.append("")
+            elif i in directives or code_shard == shard_index:
+                shard_lines.append(line)
+            else:
+                shard_lines.append("") # keeps line numbers in diagnostics
+        name = "shard_{}".format(shard_index)
+        shard_path = os.path.join(shard_dir, name + ".cpp")
+        write_file_if_changed(shard_path, "\n".join(shard_lines) + "\n")
+        shards.append(SourceShard(target.name, name, shard_path, unity_dir))
+
+    if len(shards) <= 1:
+        return None
+    return shards
+
+def get_target_shards(target, num_shards_override=None):
+    if target.sources is not None:
+        shards = []
+        names = set()
+        for source in target.sources:
+            name = os.path.splitext(os.path.basename(source))[0]
+            while name in names:
+                name += "_"
+            names.add(name)
+            shards.append(SourceShard(target.name, name, os.path.join(paths["root"], source)))
+        return shards
+
+    num_shards = num_shards_override if num_shards_override is not None else target.shards
+    if num_shards is None or num_shards <= 1:
+        return None
+    return split_unity_file(target, num_shards)
+
+# Compilers and linkers are probed once and cached until PATH or one of the
+# found programs changes
+TOOLCHAIN_PROBE_VERSION = 1
+GCC_NAMES = ["g++"] + ["g++-{}".format(v) for v in range(15, 7, -1)]
+CLANG_NAMES = ["clang++"] + ["clang++-{}".format(v) for v in range(20, 9, -1)] + ["clang"]
+LINKERS = ["bfd", "gold", "lld", "mold"]
+FAST_LINKERS = ["mold", "lld", "gold"] # fastest first
+LINKER_PROGRAMS = { "bfd": "ld.bfd", "gold": "ld.gold", "lld": "ld.lld", "mold": "mold" }
+
+class Toolchain:
+    def __init__(self, compiler, family, version, linker=None, fast_iteration=False):
+        self.compiler = compiler
+        self.family = family # "gcc" or "clang"
+        self.version = version
+        self.linker = linker # None for the compiler's default
+        self.fast_iteration = fast_iteration
+
+    def get_debug_flags(self):
+        if self.fast_iteration:
+            # Lighter debug info (no macros), kept out of the objects the linker reads
+            return ["-g", "-gsplit-dwarf"]
+        return ["-ggdb3"] # generate level 3 (max) GDB debug info
+
+    def get_linker_flags(self):
+        linker_flags = []
+        if self.linker is not None:
+            linker_flags.append("-fuse-ld=" + self.linker)
+        if self.fast_iteration and self.linker in FAST_LINKERS:
+            linker_flags.append("-Wl,--gdb-index") # so gdb doesn't index the .dwo files on load
+        return linker_flags
+
+    def describe(self):
+        return "{} ({} {}), {} linker{}".format(self.compiler, self.family, self.version,
+            self.linker if self.linker is not None else "default",
+            ", fast iteration" if self.fast_iteration else "")
+
+    def to_json(self):
+        return {
+            "compiler": self.compiler,
+            "family": self.family,
+            "version": self.version,
+            "linker": self.linker,
+            "fast iteration": self.fast_iteration,
+            "debug flags": self.get_debug_flags(),
+            "linker flags": self.get_linker_flags()
+        }
+
+toolchain = None
+
+def parse_version(version_output):
+    first_line = version_output.splitlines()[0] if version_output else ""
+    for word in first_line.replace("(", " ").replace(")", " ").split():
+        parts = word.split("-")[0].split(".")
+        if len(parts) >= 2 and all(part.isdigit() for part in parts):
+            return word.split("-")[0]
+    return "0"
+
+def version_key(version):
+    return tuple(int(part) for part in version.split("."))
+
+def get_toolchain_fingerprint():
+    fingerprint = hashlib.sha256(os.environ.get("PATH", "").encode("utf-8"))
+    for name in GCC_NAMES + CLANG_NAMES + list(LINKER_PROGRAMS.values()):
+        path = shutil.which(name)
+        if path is not None:
+            fingerprint.update("{}={}:{}".format(name, path, os.stat(path).st_mtime).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+def probe_compiler(name):
+    path = shutil.which(name)
+    if path is None:
+        return None
+    try:
+        result = subprocess.run([name, "--version"], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    output = result.stdout.decode("utf-8", "replace")
+    return {
+        "name": name,
+        "path": os.path.realpath(path),
+        "family": "clang" if "clang" in output else "gcc",
+        "version": parse_version(output)
+    }
+
+def probe_linkers(compiler):
+    supported = []
+    with tempfile.TemporaryDirectory(prefix="km_compile_probe_") as tmp_dir:
+        src_path = os.path.join(tmp_dir, "probe.cpp")
+        with open(src_path, "w") as f:
+            f.write("int main() { return 0; }\n")
+        for linker in LINKERS:
+            if shutil.which(LINKER_PROGRAMS[linker]) is None:
+                continue
+            try:
+                result = subprocess.run([compiler, "-fuse-ld=" + linker, src_path,
+                    "-o", os.path.join(tmp_dir, "probe_" + linker)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+            except (OSError, subprocess.TimeoutExpired):
+                continue
+            if result.returncode == 0:
+                supported.append(linker)
+    return supported
+
+class ToolchainProbe:
+    def __init__(self, path, force=False):
+        self.path = path
+        self.fingerprint = get_toolchain_fingerprint()
+        self.data = None
+        if not force and os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == TOOLCHAIN_PROBE_VERSION \
+                    and data.get("fingerprint") == self.fingerprint:
+                    self.data = data
+            except ValueError:
+                pass
+
+        if self.data is None:
+            start = time.time()
+            compilers = [probe_compiler(name) for name in GCC_NAMES + CLANG_NAMES]
+            self.data = {
+                "version": TOOLCHAIN_PROBE_VERSION,
+                "fingerprint": self.fingerprint,
+                "compilers": [compiler for compiler in compilers if compiler is not None],
+                "linkers": {}
+            }
+            print("Probed toolchains in {:.2f}s: {}".format(time.time() - start,
+                ", ".join("{} {}".format(c["name"], c["version"]) for c in self.data["compilers"])
+                or "no compilers found"))
+            self.save()
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        write_file_atomic(self.path, json.dumps(self.data, indent=2).encode("utf-8"))
+
+    def get_compilers(self):
+        return self.data["compilers"]
+
+    def get_linkers(self, compiler):
+        if compiler not in self.data["linkers"]:
+            self.data["linkers"][compiler] = probe_linkers(compiler)
+            self.save()
+        return self.data["linkers"][compiler]
+
+# compiler_request is a program name or a family ("gcc", "clang"), linker
+# one of LINKERS or "auto" (fastest when iterating fast, otherwise default)
+def select_toolchain(compiler_request=None, linker_request="auto", fast_iteration=False,
+    force_probe=False):
+    probe = ToolchainProbe(paths["toolchain-probe"], force_probe)
+    compilers = probe.get_compilers()
+    if compiler_request in ["gcc", "clang"]:
+        candidates = [c for c in compilers if c["family"] == compiler_request]
+    elif compiler_request is not None:
+        candidates = [c for c in compilers if c["name"] == compiler_request]
+        if not candidates:
+            compiler = probe_compiler(compiler_request)
+            candidates = [compiler] if compiler is not None else []
+    else:
+        # Same family as before probing existed: g++ on Linux, clang on macOS
+        default_family = "clang" if PLATFORM == Platform.MAC else "gcc"
+        candidates = [c for c in compilers if c["family"] == default_family] or compilers
+    if not candidates:
+        raise Exception("No usable C++ compiler found{}".format(
+            " for \"{}\"".format(compiler_request) if compiler_request is not None else ""))
+    compiler = max(candidates, key=lambda c: version_key(c["version"]))
+
+    linker = None
+    if linker_request == "auto":
+        if fast_iteration and PLATFORM == Platform.LINUX:
+            fast_linkers = [l for l in FAST_LINKERS if l in probe.get_linkers(compiler["name"])]
+            linker = fast_linkers[0] if fast_linkers else None
+    elif linker_request is not None:
+        if linker_request not in probe.get_linkers(compiler["name"]):
+            raise Exception("{} can't link with {} (is {} installed?)".format(compiler["name"],
+                linker_request, LINKER_PROGRAMS[linker_request]))
+        linker = linker_request
+
+    return Toolchain(compiler["name"], compiler["family"], compiler["version"], linker,
+        fast_iteration)
+
+# Split DWARF compiles write a .dwo next to each object
+def get_split_dwarf_outputs(compiler_flags, output_path):
+    if "-gsplit-dwarf" not in compiler_flags:
+        return []
+    return [os.path.splitext(output_path)[0] + ".dwo"]
+
+def get_target(name):
+    for target in app_info.TARGETS:
+        if target.name == name:
+            return target
+    return None
+
+# Library targets linked into a target, each one before the libraries it
+# depends on (static linking needs that order). Shared libraries already
+# contain their own dependencies.
+def get_linked_libraries(target):
+    libraries = []
+    def add_dependencies(target):
+        for name in target.depends:
+            dependency = get_target(name)
+            if dependency is None or not dependency.is_library():
+                continue
+            if dependency in libraries:
+                libraries.remove(dependency)
+            libraries.append(dependency)
+            if dependency.is_static_library():
+                add_dependencies(dependency)
+    add_dependencies(target)
+    return libraries
+
+EXTERNAL_LIB_PLATFORM_DIRS = {
+    Platform.WINDOWS: "win32",
+    Platform.LINUX: "linux",
+    Platform.MAC: "macos"
+}
+
+def get_lib_config_name(compile_mode):
+    return compile_mode.get_lib_config()
+
+def is_shared_library_name(name):
+    return name.endswith(".so") or ".so." in name or name.endswith(".dylib")
+
+# (directory, name) of each external lib compiled for this platform, from
+# libs/external/<path>/<platform>/<debug|release>
+def get_external_libs(compile_mode):
+    external_libs = []
+    for lib in app_info.LIBS_EXTERNAL:
+        names = lib.get_compiled_names(PLATFORM)
+        if names is None:
+            continue
+        lib_dir = os.path.join(paths["libs-external"], lib.path,
+            EXTERNAL_LIB_PLATFORM_DIRS[PLATFORM], get_lib_config_name(compile_mode))
+        external_libs.append((lib_dir, names[get_lib_config_name(compile_mode)]))
+    return external_libs
+
+def is_library_file_name(name):
+    return name.endswith(".a") or is_shared_library_name(name)
+
+def get_library_linker_flags(target, compile_mode):
+    if target.is_static_library():
+        return [] # archived, not linked
+
+    linker_flags = []
+    needs_rpath = False
+    for library in get_linked_libraries(target):
+        linker_flags.append(os.path.join(paths["build"], library.get_output_name()))
+        needs_rpath = needs_rpath or library.is_dynamic_library()
+
+    for lib_dir, name in get_external_libs(compile_mode):
+        if is_library_file_name(name):
+            linker_flags.append(os.path.join(lib_dir, name))
+            needs_rpath = needs_rpath or is_shared_library_name(name)
+        else:
+            # Plain names are looked up by the linker, as "-lname"
+            linker_flags += ["-L" + lib_dir, name if name.startswith("-l") else "-l" + name]
+
+    # Shared libraries are copied next to the executable, so look for them there
+    if needs_rpath:
+        linker_flags.append("-Wl,-rpath,@loader_path" if PLATFORM == Platform.MAC
+            else "-Wl,-rpath,$ORIGIN")
+    return linker_flags
+
+# Library files a target links against, so the cache and dependency graph
+# notice when one of them is rebuilt
+def get_link_inputs(target, compile_mode):
+    if target.is_static_library():
+        return []
+    link_inputs = [os.path.join(paths["build"], library.get_output_name())
+        for library in get_linked_libraries(target)]
+    link_inputs += [os.path.join(lib_dir, name) for lib_dir, name in get_external_libs(compile_mode)
+        if is_library_file_name(name)]
+    return link_inputs
+
+def copy_external_libs_to_build(compile_mode):
+    for lib_dir, name in get_external_libs(compile_mode):
+        if not is_shared_library_name(name):
+            continue
+        src_path = os.path.join(lib_dir, name)
+        dst_path = os.path.join(paths["build"], name)
+        src_stat = os.stat(src_path)
+        if os.path.exists(dst_path):
+            dst_stat = os.stat(dst_path)
+            if dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime >= src_stat.st_mtime:
+                continue
+        shutil.copy2(src_path, dst_path)
+
+def get_unix_build_flags(target, compile_mode):
+    if PLATFORM == Platform.LINUX:
+        return linux_get_build_flags(target, compile_mode)
+    elif PLATFORM == Platform.MAC:
+        return mac_get_build_flags(target, compile_mode)
+    else:
+        raise Exception("Unsupported platform for object builds: " + PLATFORM.value)
+
+shard_timings = {}
+shard_timings_lock = threading.Lock()
+
+def compile_shard(target, compile_mode, shard, if_changed):
+    compiler, compiler_flags, _ = get_unix_build_flags(target, compile_mode)
+    pch = None
+    if target.pch_header is not None and PLATFORM == Platform.LINUX:
+        compiler_flags, pch = build_precompiled_header(target, compiler, compiler_flags)
+
+    for path in [shard.obj_path, shard.depfile_path]:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    compiler_flags = compiler_flags + ["-MD", "-MF", shard.depfile_path]
+    if shard.include_dir is not None:
+        compiler_flags = compiler_flags + ["-iquote", shard.include_dir]
+    time_report_flag = get_time_report_flag(compiler)
+    if time_report_flag is not None:
+        compiler_flags = compiler_flags + [time_report_flag]
+
+    compile_command = [compiler] + compiler_flags + ["-c", shard.src_path, "-o", shard.obj_path]
+
+    node_name = "obj:" + shard.job_name
+    if if_changed:
+        reasons = dependency_graph.get_rebuild_reasons(node_name, compiler, compile_command,
+            shard.obj_path)
+        if not reasons:
+            return 0
+        print_job_line(shard.job_name, "Rebuilding: " + "; ".join(reasons))
+
+    # Workers don't have the profile, compile those locally
+    profile_files = get_pgo_profile_files(target, compile_mode)
+    start = time.time()
+    time_report = CompilerTimeReport()
+    with tracer.span(shard.job_name, "compile", { "mode": compile_mode.name }) as span:
+        result, restored = run_cached_compile(compiler, compiler_flags, compile_command,
+            shard.src_path, shard.obj_path, compile_mode, shard.job_name, time_report.filter_line,
+            distribute=not profile_files, link_inputs=profile_files)
+        span.args.update(result.to_trace_args())
+        span.args["cached"] = restored
+        if time_report_flag is not None:
+            time_report.add_to_trace(span, shard.obj_path)
+    duration = time.time() - start
+    exit_code = result.exit_code
+    if pch is not None and exit_code == 0 and not restored and result.worker is None:
+        pch.report_saving(shard.job_name)
+
+    extra_inputs = [pch.gch_path] if pch is not None else []
+    if exit_code == 0 and os.path.exists(shard.depfile_path):
+        dependency_graph.record(node_name, compiler, compile_command, shard.depfile_path,
+            extra_inputs + profile_files)
+        with shard_timings_lock:
+            shard_timings.setdefault(target.name, []).append((shard.name, duration, restored))
+        where = ""
+        if restored:
+            where = " (cached)"
+        elif result.worker is not None:
+            where = " on " + result.worker
+        print_job_line(shard.job_name, "Compiled {} in {:.2f}s{}".format(
+            os.path.basename(shard.src_path), duration, where))
+    else:
+        dependency_graph.forget(node_name)
+    return exit_code
+
+def write_shard_timings(target):
+    with shard_timings_lock:
+        timings = shard_timings.pop(target.name, [])
+    if not timings:
+        return
+    if not os.path.exists(paths["build-logs"]):
+        os.makedirs(paths["build-logs"])
+
+    log_path = os.path.join(paths["build-logs"], target.name + "_shards.log")
+    with open(log_path, "w") as f:
+        for name, duration, restored in sorted(timings, key=lambda t: t[1], reverse=True):
+            f.write("{:<24} {:8.2f}s{}\n".format(name, duration, " (cached)" if restored else ""))
+        f.write("{:<24} {:8.2f}s\n".format("total", sum(t[1] for t in timings)))
+        f.write("{:<24} {:8.2f}s\n".format("slowest", max(t[1] for t in timings)))
+
+def link_shards(target, compile_mode, shards, if_changed):
+    compiler, _, linker_flags = get_unix_build_flags(target, compile_mode)
+    output_name = target.get_output_name()
+    output_path = os.path.join(paths["build"], output_name)
+    obj_paths = [shard.obj_path for shard in shards]
+
+    if target.is_static_library():
+        # ar only adds and replaces members, so write a fresh archive and swap it in
+        archive_path = output_path + ".tmp"
+        link_command = ["ar", "rcs", archive_path] + obj_paths
+    elif target.is_dynamic_library():
+        link_command = [compiler, "-shared"] + obj_paths + ["-o", output_path] + linker_flags
+        if PLATFORM == Platform.MAC:
+            link_command += ["-Wl,-install_name,@rpath/" + output_name]
+    else:
+        link_command = [compiler] + obj_paths + ["-o", output_path] + linker_flags
+    link_inputs = get_link_inputs(target, compile_mode)
+
+    node_name = "link:" + target.name
+    write_shard_timings(target)
+    if if_changed:
+        reasons = dependency_graph.get_rebuild_reasons(node_name, compiler, link_command,
+            output_path)
+        if not reasons:
+            print_job_line(target.name, "No changes, nothing to link")
+            return 0
+
+    start = time.time()
+    with tracer.span(target.name, "link") as span:
+        if target.is_static_library() and os.path.exists(archive_path):
+            os.remove(archive_path)
+        result = run_process(link_command, paths["build"], target.name)
+        span.args = result.to_trace_args()
+    exit_code = result.exit_code
+    if exit_code == 0 and target.is_static_library():
+        os.replace(archive_path, output_path)
+    if exit_code == 0:
+        dependency_graph.record(node_name, compiler, link_command, None, obj_paths + link_inputs)
+        print_job_line(target.name, "{} {} objects into {} in {:.2f}s".format(
+            "Archived" if target.is_static_library() else "Linked", len(shards), output_name,
+            time.time() - start))
+    else:
+        dependency_graph.forget(node_name)
+    return exit_code
+
+pch_locks = {}
+pch_locks_lock = threading.Lock()
+pch_time_saved = 0.0
+pch_unpaid_keys = set() # headers precompiled this build, not reused yet
+
+def get_pch_lock(key):
+    with pch_locks_lock:
+        if key not in pch_locks:
+            pch_locks[key] = threading.Lock()
+        return pch_locks[key]
+
+class PrecompiledHeader:
+    def __init__(self, key, header, gch_path, build_time):
+        self.key = key
+        self.header = header
+        self.gch_path = gch_path
+        self.build_time = build_time
+
+    def report_saving(self, label):
+        global pch_time_saved
+        # Every compile that uses the .gch skips parsing the header set again,
+        # except the first one after precompiling, which paid for it
+        with pch_locks_lock:
+            if self.key in pch_unpaid_keys:
+                pch_unpaid_keys.remove(self.key)
+                return
+            pch_time_saved += self.build_time
+        print_job_line(label, "Used precompiled {} (saved ~{:.2f}s)".format(
+            self.header, self.build_time))
+
+def build_precompiled_header(target, compiler, compiler_flags):
+    header_path = os.path.join(paths["root"], target.pch_header)
+    key = hash_string(command_to_string([compiler] + compiler_flags + [header_path]))
+    pch_dir = os.path.join(paths["build-pch"], key)
+    # A one-line wrapper keeps the header's own relative includes working,
+    # and g++ falls back to it if the .gch can't be used
+    wrapper_path = os.path.join(pch_dir, os.path.basename(header_path))
+    gch_path = wrapper_path + ".gch"
+    depfile_path = gch_path + ".d"
+    info_path = os.path.join(pch_dir, "info.json")
+    label = target.name
+
+    pch_command = [compiler] + compiler_flags + [
+        "-x", "c++-header", wrapper_path, "-o", gch_path, "-MD", "-MF", depfile_path
+    ]
+
+    with get_pch_lock(key):
+        reasons = dependency_graph.get_rebuild_reasons("pch:" + key, compiler, pch_command,
+            gch_path)
+        if reasons:
+            print_job_line(label, "Precompiling {}: {}".format(target.pch_header, "; ".join(reasons)))
+            if not os.path.exists(pch_dir):
+                os.makedirs(pch_dir)
+            with open(wrapper_path, "w") as f:
+                f.write("#include \"{}\"\n".format(header_path))
+
+            start = time.time()
+            with tracer.span(target.pch_header, "precompile-header"):
+                exit_code = run_process(pch_command, paths["build"], label).exit_code
+            if exit_code != 0 or not os.path.exists(depfile_path):
+                dependency_graph.forget("pch:" + key)
+                print_job_line(label, "Precompiling {} failed, compiling without it".format(
+                    target.pch_header))
+                return compiler_flags, None
+            build_time = time.time() - start
+            with pch_locks_lock:
+                pch_unpaid_keys.add(key)
+            # Before the node, so a recorded .gch always has its info
+            write_file_atomic(info_path, json.dumps({ "build_time": build_time }).encode("utf-8"))
+            dependency_graph.record("pch:" + key, compiler, pch_command, depfile_path)
+        else:
+            # Only used to report savings, it's fine to lose it
+            try:
+                with open(info_path, "r") as f:
+                    build_time = float(json.load(f)["build_time"])
+            except (OSError, ValueError, KeyError, TypeError):
+                build_time = 0
+
+    compiler_flags = compiler_flags + [
+        "-Winvalid-pch", # say so if the .gch is rejected
+        "-include", wrapper_path
+    ]
+    return compiler_flags, PrecompiledHeader(key, target.pch_header, gch_path, build_time)
+
+def get_common_defines(compile_mode):
+    defines = []
+    if PLATFORM == Platform.WINDOWS:
+        defines.append(Define("GAME_WIN32", "1"))
+        defines.append(Define("_CRT_SECURE_NO_WARNINGS"))
+    elif PLATFORM == Platform.LINUX:
+        defines.append(Define("GAME_LINUX", "1"))
+    elif PLATFORM == Platform.MAC:
+        defines.append(Define("GAME_MACOS", "1"))
+
+    defines += compile_mode.get_defines()
+
+    return defines
+
+def win_compile(target, compile_mode):
+    compiler_flags = ""
+
+    # Add defines/macros
+    compiler_flags = " ".join([
+        compiler_flags
+    ] + [d.to_compiler_flag() for d in get_common_defines(compile_mode)])
+
+    # Add general compiler flags
+    compiler_flags = " ".join([
+        compiler_flags,
+        "-nologo",        # disable the "Microsoft C/C++ Optimizing Compiler" message
+        "-Gm-",           # disable incremental build things
+        "-GR-",           # disable type information
+        "-EHa-",          # disable exception handling
+        "-EHsc",          # handle stdlib errors
+        "-std:c++latest", # use latest C++ standard (aggregate initialization...)
+        "-Z7"             # minimal "old school" debug information
+    ])
+
+    # Add compiler warning flags
+    compiler_flags = " ".join([
+        compiler_flags,
+        "-WX", # treat warnings as errors
+        "-W4", # level 4 warnings
+    ])
+
+    # Add the compile mode's flags (runtime library, optimization, warnings)
+    compiler_flags = " ".join([
+        compiler_flags,
+        compile_mode.get_compiler_flags()
+    ])
+
+    # Add include paths
+    compiler_flags = " ".join([
+        compiler_flags,
+        "-I\"" + paths["src"] + "\"",
+        "-I\"" + paths["libs-internal"] + "\""
+    ] + [ "-I\"" + path + "\"" for path in includeDirs.values() ])
+
+    # Add all custom defines + compiler flags
+    compiler_flags = " ".join([
+        compiler_flags,
+        target.get_compiler_flags()
+    ])
+
+    """
+    # TODO hmm... is this a Hack
+    if target.name == "nopasanada":
+        compiler_warning_flags = " ".join([
+            compiler_warning_flags,
+            "/wd4267", # conversion from X to Y, possible loss of data
+            "/wd4456", # declaration of X hides previous local declaration
+        ])
+    if compile_mode == CompileMode.DEBUG:
+        compiler_warning_flags = " ".join([
+            compiler_warning_flags,
+            "/wd4189", # local variable is initialized but not referenced
+            "/wd4702", # unreachable code (early return for debugging)
+        ])
+    """
+
+    linker_flags = ""
+
+    # Add general linker flags
+    linker_flags = " ".join([
+        "-incremental:no",  # disable incremental linking
+        "-opt:ref"          # get rid of extraneous linkages
+    ])
+
+    linker_flags = " ".join([
+        linker_flags,
+        compile_mode.get_linker_flags()
+    ])
+
+    # Add libraries
+    linker_flags = " ".join([
+        linker_flags,
+        "kernel32.lib"
+    ])
+
+    indStr = get_lib_config_name(compile_mode)
+
+    for lib in app_info.LIBS_EXTERNAL:
+        if lib.compiledNames is not None:
+            linker_flags += " -LIBPATH:\"" + os.path.join(paths["libs-external"], lib.path, "win32", indStr) + "\""
+            linker_flags += " " + lib.compiledNames[indStr]
+
+    # Add all custom linker flags
+    linker_flags = " ".join([
+        linker_flags,
+        target.get_linker_flags()
+    ])
+
+    # Clear old PDB files for this target only, other targets may be linking
+    pdb_prefix = target.name + "_game"
+    for file_name in os.listdir(paths["build"]):
+        if file_name.startswith(pdb_prefix) and ".pdb" in file_name:
+            try:
+                os.remove(os.path.join(paths["build"], file_name))
+            except:
+                print("Couldn't remove " + file_name)
+
+    exe_name = target.get_output_name()
+    map_name = target.name + "_win32.map"
+    pdb_name = pdb_prefix + str(random.randrange(99999)) + ".pdb"
+    src_name = os.path.join(paths["root"], target.source_file)
+
+    compile_command = " ".join([
+        "cl", compiler_flags, "-Fe" + exe_name, "-Fm" + map_name, "\"" + src_name + "\"",
+        "-link", linker_flags, "-PDB:" + pdb_name
+    ])
+
+    load_compiler = "call \"" + paths["win32-vcvarsall"] + "\" x64"
+
+    with tracer.span(target.name, "compile+link", { "mode": compile_mode.name }):
+        exit_code = run_process(" & ".join([
+            load_compiler,
+            compile_command
+        ]), paths["build"], target.name).exit_code
+    if exit_code != 0:
+        return exit_code
+
+    for lib in app_info.LIBS_EXTERNAL:
+        if lib.dllNames is not None:
+            dll_path_src = os.path.join(paths["libs-external"], lib.path, "win32", indStr, lib.dllNames[indStr])
+            dll_path_dst = os.path.join(paths["build"], lib.dllNames[indStr])
+            shutil.copyfile(dll_path_src, dll_path_dst)
+
+    with tracer.span(target.name, "post-compile-custom"):
+        app_info.post_compile_custom(paths)
+    return 0
+
+def win_run(target, run_args=[]):
+    return os.system(" & ".join([
+        "pushd " + paths["build"],
+        subprocess.list2cmdline([target.get_output_name()] + run_args),
+        "popd"
+    ]))
+
+def win_deploy(target):
+    with tracer.span(target.name, "deploy"):
+        win_deploy_bundle(target)
+
+def win_deploy_bundle(target):
+    deploy_bundle_name = target.name
+    deploy_bundle_path = os.path.join(paths["deploy"], deploy_bundle_name)
+    remake_dest_and_copy_dir(paths["build"], deploy_bundle_path)
+    for fileName in os.listdir(deploy_bundle_path):
+        if fileName not in app_info.DEPLOY_FILES:
+            filePath = os.path.join(deploy_bundle_path, fileName)
+            if os.path.isfile(filePath):
+                os.remove(filePath)
+            elif os.path.isdir(filePath):
+                shutil.rmtree(filePath)
+
+    deployZipPath = os.path.join(paths["deploy"], "0. Unnamed")
+    shutil.make_archive(deployZipPath, "zip", root_dir=paths["deploy"], base_dir=deploy_bundle_name)
+
+DEPLOY_FORMATS = ["tar.gz", "tar.xz", "zip"]
+DEPLOY_DEFAULT_LEVELS = { "tar.gz": 6, "tar.xz": 6, "zip": 6 }
+DEPLOY_READ_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_WINDOW_SIZE = 32 * 1024
+XZ_BLOCK_SIZE = 16 * 1024 * 1024
+
+deploy_format = "tar.gz"
+deploy_level = None
+build_mode = None
+
+def compress_gzip_block(data, zdict, level, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends each block on a byte boundary, so the blocks join up
+    # into one deflate stream
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def compress_xz_block(data, level):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+# File-like writer that compresses blocks on a thread pool and writes them in
+# order. gzip blocks are primed with the previous block's last 32 KB, like
+# pigz, and form a single gzip member. xz blocks are separate streams, which
+# xz readers concatenate.
+class ParallelCompressWriter:
+    def __init__(self, out_file, compression, level, num_threads=None):
+        self.out_file = out_file
+        self.compression = compression
+        self.level = level
+        self.block_size = GZIP_BLOCK_SIZE if compression == "gz" else XZ_BLOCK_SIZE
+        self.num_threads = num_threads if num_threads is not None else (os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        self.pending = []
+        self.buffer = bytearray()
+        self.previous_tail = b""
+        self.crc = 0
+        self.size = 0
+        if compression == "gz":
+            self.out_file.write(struct.pack("<4sIBB", b"\x1f\x8b\x08\x00", int(time.time()), 0, 3))
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if self.compression == "gz":
+            self.crc = zlib.crc32(data, self.crc)
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit(block, False)
+        return len(data)
+
+    def submit(self, block, last):
+        if self.compression == "gz":
+            future = self.executor.submit(compress_gzip_block, block, self.previous_tail,
+                self.level, last)
+            self.previous_tail = block[-GZIP_WINDOW_SIZE:]
+        else:
+            future = self.executor.submit(compress_xz_block, block, self.level)
+        self.pending.append(future)
+        # Bound memory use, don't let reading run too far ahead of compressing
+        while len(self.pending) > self.num_threads * 2:
+            self.out_file.write(self.pending.pop(0).result())
+
+    def close(self):
+        self.submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        for future in self.pending:
+            self.out_file.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+        if self.compression == "gz":
+            self.out_file.write(struct.pack("<II", self.crc, self.size & 0xffffffff))
+
+def get_deploy_files():
+    file_paths = []
+    for name in app_info.DEPLOY_FILES:
+        path = os.path.join(paths["build"], name)
+        if not os.path.exists(path):
+            raise Exception("Deploy file not found in build directory: " + name)
+        file_paths.append(path)
+        if os.path.isdir(path):
+            for root, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                file_paths += [os.path.join(root, name) for name in sorted(dir_names + file_names)]
+    return file_paths
+
+def write_deploy_tar(out_file, file_paths, base_dir):
+    num_bytes = 0
+    with tarfile.open(fileobj=out_file, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for file_path in file_paths:
+            arcname = os.path.join(base_dir, os.path.relpath(file_path, paths["build"]))
+            tarinfo = tar.gettarinfo(file_path, arcname)
+            if tarinfo.isreg():
+                with open(file_path, "rb") as f:
+                    tar.addfile(tarinfo, f)
+                num_bytes += tarinfo.size
+            else:
+                tar.addfile(tarinfo)
+    return num_bytes
+
+def write_deploy_zip(out_file, file_paths, base_dir, level):
+    num_bytes = 0
+    with zipfile.ZipFile(out_file, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as archive:
+        for file_path in file_paths:
+            arcname = os.path.join(base_dir, os.path.relpath(file_path, paths["build"]))
+            if os.path.isdir(file_path):
+                archive.write(file_path, arcname)
+                continue
+            info = zipfile.ZipInfo.from_file(file_path, arcname)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(file_path, "rb") as src, archive.open(info, "w", force_zip64=True) as dst:
+                for chunk in iter(lambda: src.read(DEPLOY_READ_SIZE), b""):
+                    dst.write(chunk)
+            num_bytes += info.file_size
+    return num_bytes
+
+# Streams DEPLOY_FILES from the build directory straight into
+# deploy/<target>.<format>, without a staging copy
+def unix_deploy(target):
+    level = deploy_level if deploy_level is not None else DEPLOY_DEFAULT_LEVELS[deploy_format]
+    if deploy_format == "tar.xz" and lzma is None:
+        raise Exception("tar.xz deploys need Python's lzma module")
+
+    archive_path = os.path.join(paths["deploy"],
+        "{}-{}.{}".format(target.name, build_mode, deploy_format))
+    tmp_path = archive_path + ".tmp"
+    file_paths = get_deploy_files()
+
+    start = time.perf_counter()
+    with tracer.span(target.name, "deploy", { "format": deploy_format, "level": level }) as span:
+        with open(tmp_path, "wb") as out_file:
+            if deploy_format == "zip":
+                num_bytes = write_deploy_zip(out_file, file_paths, target.name, level)
+            else:
+                writer = ParallelCompressWriter(out_file, deploy_format.split(".")[1], level)
+                num_bytes = write_deploy_tar(writer, file_paths, target.name)
+                writer.close()
+        os.replace(tmp_path, archive_path)
+        archive_size = os.path.getsize(archive_path)
+        span.args.update({ "input MB": round(num_bytes / (1024 * 1024), 1),
+            "archive MB": round(archive_size / (1024 * 1024), 1) })
+
+    duration = time.perf_counter() - start
+    print_job_line("deploy-" + target.name,
+        "Deployed {}: {} entries, {:.1f} MB -> {:.1f} MB ({:.0f}%) in {:.2f}s, {:.0f} MB/s".format(
+            os.path.relpath(archive_path, paths["root"]), len(file_paths),
+            num_bytes / (1024 * 1024), archive_size / (1024 * 1024),
+            100 * archive_size / max(num_bytes, 1), duration,
+            num_bytes / (1024 * 1024) / max(duration, 1e-6)))
+    return 0
+
+# Binary size reports: where the bytes of each linked output go, by symbol,
+# source file and library, compared with the previous build's report. ELF
+# binaries are read directly, Windows builds from the linker's .map file.
+SIZE_REPORT_VERSION = 1
+SIZE_REPORT_TOP = 25
+
+ELF_SHT_SYMTAB = 2
+ELF_SHT_NOBITS = 8
+ELF_SHT_DYNSYM = 11
+ELF_SHF_ALLOC = 0x2
+ELF_STT_OBJECT = 1
+ELF_STT_FUNC = 2
+ELF_STT_FILE = 4
+ELF_STT_TLS = 6
+ELF_SHN_LORESERVE = 0xff00
+ELF_SHN_XINDEX = 0xffff
+
+class ElfSection:
+    def __init__(self, name_offset, type, flags, addr, offset, size, link):
+        self.name = None
+        self.name_offset = name_offset
+        self.type = type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+        self.link = link
+
+class ElfSymbol:
+    def __init__(self, name, value, size, kind, is_local, section_index, file_name):
+        self.name = name
+        self.value = value
+        self.size = size
+        self.kind = kind # "function" or "data"
+        self.is_local = is_local
+        self.section_index = section_index
+        self.file_name = file_name # from the preceding STT_FILE symbol, locals only
+
+def read_c_string(data, offset):
+    end = data.find(b"\0", offset)
+    return data[offset:end if end >= 0 else len(data)].decode("utf-8", "replace")
+
+# Sections and sized function/data symbols (.symtab, or .dynsym if stripped)
+def read_elf(data):
+    if data[:4] != b"\x7fELF":
+        raise Exception("not an ELF file")
+    is_64 = data[4] == 2
+    endian = "<" if data[5] == 1 else ">"
+    if is_64:
+        shoff = struct.unpack_from(endian + "Q", data, 0x28)[0]
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3a)
+        section_format = endian + "IIQQQQIIQQ"
+        symbol_format = endian + "IBBHQQ"
+    else:
+        shoff = struct.unpack_from(endian + "I", data, 0x20)[0]
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2e)
+        section_format = endian + "IIIIIIIIII"
+        symbol_format = endian + "IIIBBH"
+
+    def read_section(index):
+        fields = struct.unpack_from(section_format, data, shoff + index * shentsize)
+        return ElfSection(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5],
+            fields[6])
+
+    # Over 0xff00 sections, the real counts live in section 0
+    if shoff and (shnum == 0 or shstrndx == ELF_SHN_XINDEX):
+        first = read_section(0)
+        shnum = shnum or first.size
+        shstrndx = first.link if shstrndx == ELF_SHN_XINDEX else shstrndx
+    sections = [read_section(i) for i in range(shnum)]
+    if shstrndx < len(sections):
+        names_offset = sections[shstrndx].offset
+        for section in sections:
+            section.name = read_c_string(data, names_offset + section.name_offset)
+
+    symtabs = [s for s in sections if s.type == ELF_SHT_SYMTAB] \
+        or [s for s in sections if s.type == ELF_SHT_DYNSYM]
+    symbols = []
+    for symtab in symtabs:
+        strtab = sections[symtab.link]
+        entry_size = struct.calcsize(symbol_format)
+        file_name = None
+        for offset in range(symtab.offset, symtab.offset + symtab.size, entry_size):
+            if is_64:
+                name, info, _, shndx, value, size = struct.unpack_from(symbol_format, data, offset)
+            else:
+                name, value, size, info, _, shndx = struct.unpack_from(symbol_format, data, offset)
+            sym_type = info & 0xf
+            if sym_type == ELF_STT_FILE:
+                file_name = read_c_string(data, strtab.offset + name)
+                continue
+            if sym_type not in [ELF_STT_FUNC, ELF_STT_OBJECT, ELF_STT_TLS] or size == 0 \
+            or shndx == 0 or shndx >= ELF_SHN_LORESERVE:
+                continue
+            is_local = (info >> 4) == 0
+            symbols.append(ElfSymbol(read_c_string(data, strtab.offset + name), value, size,
+                "function" if sym_type == ELF_STT_FUNC else "data", is_local, shndx,
+                file_name if is_local else None))
+    return sections, symbols
+
+# (member name, contents) of each object in a static library
+def read_archive_members(data):
+    if not data.startswith(b"!<arch>\n"):
+        return
+    offset = 8
+    long_names = b""
+    while offset + 60 <= len(data):
+        header = data[offset:offset + 60]
+        name = header[:16].decode("utf-8", "replace").rstrip()
+        size = int(header[48:58])
+        body = data[offset + 60:offset + 60 + size]
+        offset += 60 + size + (size % 2)
+        if name == "//":
+            long_names = body # GNU long member names
+        elif name in ["/", "/SYM64/", "__.SYMDEF", "__.SYMDEF SORTED"]:
+            continue # symbol index
+        elif name.startswith("#1/"):
+            # BSD long member names precede the contents
+            name_size = int(name[3:])
+            yield body[:name_size].rstrip(b"\0").decode("utf-8", "replace"), body[name_size:]
+        else:
+            if name.startswith("/") and name[1:].isdigit():
+                start = int(name[1:])
+                name = long_names[start:long_names.index(b"/\n", start)].decode("utf-8", "replace")
+            yield name.rstrip("/"), body
+
+def get_library_symbols(library_paths):
+    symbol_libraries = {} # mangled name -> library
+    for library_path in library_paths:
+        if not library_path.endswith(".a") or not os.path.exists(library_path):
+            continue
+        library_name = os.path.basename(library_path)
+        with open(library_path, "rb") as f:
+            data = f.read()
+        for _, member in read_archive_members(data):
+            try:
+                _, symbols = read_elf(member)
+            except Exception:
+                continue # not an object, or not ELF
+            for symbol in symbols:
+                if not symbol.is_local:
+                    symbol_libraries.setdefault(symbol.name, library_name)
+    return symbol_libraries
+
+# Runs a binutils-style filter (c++filt, addr2line) over lines, one output
+# line per input line. Returns None if the tool isn't there or fails.
+def run_line_filter(command, lines):
+    if not lines:
+        return []
+    try:
+        result = subprocess.run(command, input="\n".join(lines) + "\n",
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    output = result.stdout.splitlines()
+    if result.returncode != 0 or len(output) != len(lines):
+        return None
+    return output
+
+def get_size_report_path(target):
+    return os.path.join(paths["build-logs"], "size_{}.json".format(target.name))
+
+def get_source_file_name(file_path):
+    if file_path is None or file_path.startswith("??"):
+        return None
+    file_path = os.path.normpath(file_path)
+    if file_path.startswith(paths["root"] + os.sep):
+        return os.path.relpath(file_path, paths["root"])
+    return file_path
+
+def get_elf_size_entries(binary_path, library_paths):
+    with open(binary_path, "rb") as f:
+        data = f.read()
+    sections, elf_symbols = read_elf(data)
+    section_sizes = {}
+    for section in sections:
+        if section.flags & ELF_SHF_ALLOC and section.size > 0:
+            # .bss and .tbss take memory, not file space
+            section_sizes[section.name] = section_sizes.get(section.name, 0) + section.size
+
+    # Aliases (constructor variants, ICF) share one body, count it once
+    seen = set()
+    symbols = []
+    for symbol in sorted(elf_symbols, key=lambda s: (s.is_local, s.name)):
+        key = (symbol.section_index, symbol.value, symbol.size)
+        if key not in seen:
+            seen.add(key)
+            symbols.append(symbol)
+
+    # Source files from the debug info, where there is some
+    file_names = [symbol.file_name for symbol in symbols]
+    if any(section.name == ".debug_line" for section in sections):
+        code_symbols = [i for i, symbol in enumerate(symbols) if symbol.kind == "function"]
+        locations = run_line_filter(["addr2line", "-e", binary_path],
+            ["{:x}".format(symbols[i].value) for i in code_symbols])
+        if locations is not None:
+            for i, location in zip(code_symbols, locations):
+                file_path = location.rsplit(":", 1)[0]
+                if not file_path.startswith("??"):
+                    file_names[i] = file_path
+
+    names = [symbol.name for symbol in symbols]
+    demangled = run_line_filter(["c++filt"], names)
+    if demangled is not None:
+        names = demangled
+    symbol_libraries = get_library_symbols(library_paths)
+    entries = [
+        (name, symbol.size, symbol.kind, get_source_file_name(file_name),
+            symbol_libraries.get(symbol.name))
+        for symbol, name, file_name in zip(symbols, names, file_names)
+    ]
+    return section_sizes, entries
+
+def demangle_msvc_names(names):
+    # undname ships with Visual Studio, names stay decorated without it
+    if not names or shutil.which("undname") is None:
+        return names
+    demangled = {}
+    for i in range(0, len(names), 200):
+        batch = names[i:i + 200]
+        try:
+            result = subprocess.run(["undname"] + batch, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+        except OSError:
+            return names
+        # Undecoration of :- "?f@@YAXXZ"
+        # is :- "void __cdecl f(void)"
+        mangled = None
+        for line in result.stdout.splitlines():
+            if line.startswith("Undecoration of :- "):
+                mangled = line[len("Undecoration of :- "):].strip("\"")
+            elif line.startswith("is :- ") and mangled is not None:
+                demangled[mangled] = line[len("is :- "):].strip("\"")
+                mangled = None
+    return [demangled.get(name, name) for name in names]
+
+# MSVC map files list section groups and public symbols with addresses but
+# no sizes. A symbol's size is taken to be the gap to the next one.
+def get_msvc_map_size_entries(map_path):
+    group_pattern = re.compile(r"^\s*([0-9a-fA-F]{4}):([0-9a-fA-F]{8})\s+([0-9a-fA-F]{8})H\s+(\S+)\s+(\w+)\s*$")
+    symbol_pattern = re.compile(
+        r"^\s*([0-9a-fA-F]{4}):([0-9a-fA-F]{8})\s+(\S+)\s+[0-9a-fA-F]{8,16}\s+(f\s+)?(i\s+)?(\S+)\s*$")
+    section_sizes = {}
+    section_ends = {}
+    publics = []
+    with open(map_path, "r", errors="replace") as f:
+        for line in f:
+            match = group_pattern.match(line)
+            if match is not None:
+                section, start, length, name = int(match.group(1), 16), int(match.group(2), 16), \
+                    int(match.group(3), 16), match.group(4)
+                group_name = name.split("$")[0]
+                section_sizes[group_name] = section_sizes.get(group_name, 0) + length
+                section_ends[section] = max(section_ends.get(section, 0), start + length)
+                continue
+            match = symbol_pattern.match(line)
+            if match is not None and int(match.group(1), 16) != 0:
+                publics.append((int(match.group(1), 16), int(match.group(2), 16), match.group(3),
+                    match.group(4) is not None, match.group(6)))
+
+    publics.sort()
+    entries = []
+    names = demangle_msvc_names([public[2] for public in publics])
+    for i, (section, offset, _, is_function, lib_object) in enumerate(publics):
+        if i + 1 < len(publics) and publics[i + 1][0] == section:
+            end = publics[i + 1][1]
+        else:
+            end = section_ends.get(section, offset)
+        if end <= offset:
+            continue
+        library, _, object_name = lib_object.rpartition(":")
+        entries.append((names[i], end - offset, "function" if is_function else "data",
+            object_name, library + ".lib" if library else None))
+    return section_sizes, entries
+
+def make_size_report(target, binary_path, section_sizes, entries):
+    symbols = {}
+    files = {}
+    libraries = {}
+    kinds = {}
+    for name, size, kind, file_name, library in entries:
+        # Same-named statics from different files are kept apart
+        key = name
+        if key in symbols and file_name is not None:
+            key = "{} [{}]".format(name, file_name)
+        if key in symbols:
+            symbols[key]["size"] += size
+        else:
+            symbols[key] = { "size": size, "kind": kind, "file": file_name, "library": library }
+        files[file_name or "?"] = files.get(file_name or "?", 0) + size
+        owner = library or target.get_output_name()
+        libraries[owner] = libraries.get(owner, 0) + size
+        kinds[kind] = kinds.get(kind, 0) + size
+    return {
+        "version": SIZE_REPORT_VERSION,
+        "target": target.name,
+        "binary": os.path.basename(binary_path),
+        "file_size": os.path.getsize(binary_path),
+        "sections": section_sizes,
+        "kinds": kinds,
+        "files": files,
+        "libraries": libraries,
+        "symbols": symbols
+    }
+
+def format_bytes(size):
+    if abs(size) < 1024:
+        return "{} B".format(size)
+    return format_size(size) if size > 0 else "-" + format_size(-size)
+
+def format_size_delta(delta):
+    return "" if delta == 0 else ("+" if delta > 0 else "") + format_bytes(delta)
+
+def get_size_changes(new, old):
+    changes = []
+    for name in set(new) | set(old):
+        delta = new.get(name, 0) - old.get(name, 0)
+        if delta != 0:
+            changes.append((delta, name))
+    return sorted(changes, key=lambda c: abs(c[0]), reverse=True)
+
+def write_size_report_text(report, old_report, text_path):
+    old_symbol_sizes = {}
+    if old_report is not None:
+        old_symbol_sizes = { name: s["size"] for name, s in old_report["symbols"].items() }
+    def section(title, sizes, old_sizes, limit=SIZE_REPORT_TOP):
+        lines = ["", title]
+        for name, size in sorted(sizes.items(), key=lambda s: s[1], reverse=True)[:limit]:
+            delta = size - old_sizes.get(name, 0) if old_report is not None else 0
+            lines.append("  {:>10} {:>10}  {}".format(format_bytes(size), format_size_delta(delta),
+                name))
+        return lines
+
+    old = old_report if old_report is not None else {}
+    lines = ["{} ({}): {}{}".format(report["target"], report["binary"],
+        format_bytes(report["file_size"]),
+        " ({} since the previous build)".format(format_size_delta(
+            report["file_size"] - old["file_size"]) or "no change") if old_report else "")]
+    lines += section("Sections:", report["sections"], old.get("sections", {}))
+    lines += section("By kind:", report["kinds"], old.get("kinds", {}))
+    lines += section("By library:", report["libraries"], old.get("libraries", {}))
+    lines += section("By source file:", report["files"], old.get("files", {}))
+    for kind, title in [("function", "Largest functions:"), ("data", "Largest data:")]:
+        lines += section(title, {
+            name: s["size"] for name, s in report["symbols"].items() if s["kind"] == kind
+        }, old_symbol_sizes)
+    if old_report is not None:
+        changes = get_size_changes(
+            { name: s["size"] for name, s in report["symbols"].items() }, old_symbol_sizes)
+        lines += ["", "Symbol changes since the previous build ({}):".format(len(changes))]
+        for delta, name in changes[:SIZE_REPORT_TOP]:
+            status = ""
+            if name not in old_symbol_sizes:
+                status = " (new)"
+            elif name not in report["symbols"]:
+                status = " (removed)"
+            lines.append("  {:>10}  {}{}".format(format_size_delta(delta), name, status))
+    with open(text_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+# Size reports are informational, a binary that can't be analyzed (not ELF,
+# stripped, unexpected layout) doesn't fail the build
+def report_binary_size(target, compile_mode, threshold=None):
+    try:
+        return write_binary_size_report(target, compile_mode, threshold)
+    except Exception as e:
+        print_job_line("size-" + target.name, "Warning: no size report for {}: {}".format(
+            target.get_output_name(), str(e)))
+        return 0
+
+def write_binary_size_report(target, compile_mode, threshold=None):
+    label = "size-" + target.name
+    binary_path = os.path.join(paths["build"], target.get_output_name())
+    report_path = get_size_report_path(target)
+    if not os.path.exists(binary_path):
+        return 0
+    if os.path.exists(report_path) and os.path.getmtime(report_path) >= os.path.getmtime(binary_path):
+        return 0 # not relinked since the last report
+
+    with tracer.span(target.name, "size-report") as span:
+        if PLATFORM == Platform.WINDOWS:
+            map_path = os.path.join(paths["build"], target.name + "_win32.map")
+            if not os.path.exists(map_path):
+                print_job_line(label, "No map file, skipping the size report")
+                return 0
+            section_sizes, entries = get_msvc_map_size_entries(map_path)
+        else:
+            section_sizes, entries = get_elf_size_entries(binary_path,
+                get_link_inputs(target, compile_mode))
+        report = make_size_report(target, binary_path, section_sizes, entries)
+
+        old_report = None
+        if os.path.exists(report_path):
+            try:
+                with open(report_path, "r") as f:
+                    old_report = json.load(f)
+                if old_report.get("version") != SIZE_REPORT_VERSION:
+                    old_report = None
+            except ValueError:
+                pass
+        text_path = os.path.splitext(report_path)[0] + ".txt"
+        write_size_report_text(report, old_report, text_path)
+        write_file_atomic(report_path, json.dumps(report).encode("utf-8"))
+        span.args = { "file size": report["file_size"], "symbols": len(entries) }
+
+    line = "{}: {}, {} code, {} data".format(report["binary"], format_bytes(report["file_size"]),
+        format_bytes(report["kinds"].get("function", 0)), format_bytes(report["kinds"].get("data", 0)))
+    if old_report is not None:
+        delta = report["file_size"] - old_report["file_size"]
+        line += " ({})".format(format_size_delta(delta) or "no change")
+        changes = get_size_changes(
+            { name: s["size"] for name, s in report["symbols"].items() },
+            { name: s["size"] for name, s in old_report["symbols"].items() })
+        if changes:
+            line += ", most changed: " + ", ".join("{} {}".format(format_size_delta(delta),
+                name if len(name) <= 60 else name[:57] + "...") for delta, name in changes[:3])
+        if threshold is not None and old_report["file_size"] > 0 \
+        and delta > old_report["file_size"] * threshold:
+            line += "\nWarning: {} grew {:.1f}% since the previous build".format(report["binary"],
+                100.0 * delta / old_report["file_size"])
+    print_job_line(label, line)
+    print_job_line(label, "Size report written to " + os.path.relpath(text_path, paths["root"]))
+    return 0
+
+# Profile-guided optimization (release-pgo). Targets in app_info.PGO_TRAINING
+# ({ name: [args] or [[args], [args], ...] }) are built instrumented into the
+# release-pgo directory, run once per set of arguments, then rebuilt in place
+# with the profile, so GCC finds each object's .gcda under the same name.
+# Profiles are cached per target and source revision, and reused until more
+# than PGO_MAX_DRIFT of the sources they were trained on have changed.
+PGO_MAX_DRIFT = 0.25
+PGO_CACHE_KEEP = 5 # profiles kept per target
+
+pgo_phase = None # "generate" or "use", while building release-pgo
+
+def get_pgo_training():
+    training = {}
+    for name, run_args in getattr(app_info, "PGO_TRAINING", {}).items():
+        target = get_target(name)
+        if target is None or target.type.value != TargetType.EXECUTABLE.value:
+            raise Exception("PGO_TRAINING: {} isn't an executable target".format(name))
+        if run_args and all(isinstance(args, (list, tuple)) for args in run_args):
+            training[name] = [list(args) for args in run_args]
+        else:
+            training[name] = [list(run_args)]
+    return training
+
+def get_pgo_dir(target):
+    return os.path.join(paths["pgo"], target.name)
+
+def get_pgo_profdata_path(target):
+    return os.path.join(get_pgo_dir(target), "merged.profdata")
+
+def get_pgo_flags(target, compile_mode):
+    if not compile_mode.uses_pgo() or pgo_phase is None \
+    or target.name not in getattr(app_info, "PGO_TRAINING", {}):
+        return [], []
+    if pgo_phase == "generate":
+        flags = ["-fprofile-generate=" + get_pgo_dir(target)]
+        if toolchain.family == "gcc":
+            flags.append("-fprofile-update=atomic") # counters from several threads
+        return flags, flags
+
+    # A profile within PGO_MAX_DRIFT can miss edited functions. The compiler
+    # warns about those, but it mustn't fail the build (GCC makes
+    # coverage-mismatch an error by default, and the base flags have -Werror).
+    if toolchain.family == "clang":
+        return ["-fprofile-use=" + get_pgo_profdata_path(target),
+            "-Wno-error=profile-instr-out-of-date", "-Wno-error=profile-instr-unprofiled"], []
+    flags = ["-fprofile-use=" + get_pgo_dir(target), "-Wno-error=coverage-mismatch",
+        "-Wno-error=missing-profile"]
+    if version_key(toolchain.version) >= (10,):
+        flags.append("-fprofile-partial-training") # untrained code stays optimized for speed
+    return flags, []
+
+def list_pgo_profile(target, extension):
+    profile_dir = get_pgo_dir(target)
+    if not os.path.isdir(profile_dir):
+        return []
+    return sorted(os.path.join(profile_dir, name) for name in os.listdir(profile_dir)
+        if name.endswith(extension))
+
+# Objects built with a profile depend on it, for the compile cache and --ifchanged
+def get_pgo_profile_files(target, compile_mode):
+    if not compile_mode.uses_pgo() or pgo_phase != "use" \
+    or target.name not in getattr(app_info, "PGO_TRAINING", {}):
+        return []
+    if toolchain.family == "clang":
+        return [get_pgo_profdata_path(target)]
+    return list_pgo_profile(target, ".gcda")
+
+def get_pgo_cache_dir(target):
+    return os.path.join(paths["pgo-cache"], app_info.PROJECT_NAME, target.name)
+
+def get_pgo_toolchain_id():
+    return "{} {}".format(toolchain.family, toolchain.version)
+
+# Project files the target was compiled from, with their digests
+def get_pgo_inputs(target):
+    inputs = {}
+    with dependency_graph.lock:
+        for name, entry in dependency_graph.targets.items():
+            if name in [target.name, "link:" + target.name] or name.startswith(
+                "obj:" + target.name + "/"):
+                for file_path, digest in entry["inputs"].items():
+                    if file_path.startswith(paths["root"] + os.sep) \
+                    and not file_path.startswith(paths["build-root"] + os.sep):
+                        inputs[os.path.relpath(file_path, paths["root"])] = digest
+    return inputs
+
+def get_pgo_drift(inputs):
+    if not inputs:
+        return 1.0
+    manifest = get_source_manifest()
+    changed = 0
+    for rel_path, digest in inputs.items():
+        file_path = os.path.join(paths["root"], rel_path)
+        if not os.path.isfile(file_path) or manifest.get_digest(file_path) != digest:
+            changed += 1
+    return changed / len(inputs)
+
+def get_cached_pgo_profiles(target):
+    cache_dir = get_pgo_cache_dir(target)
+    profiles = []
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            meta_path = os.path.join(cache_dir, name, "meta.json")
+            try:
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            profiles.append((meta, os.path.join(cache_dir, name)))
+    return sorted(profiles, key=lambda profile: profile[0]["created"], reverse=True)
+
+def describe_pgo_profile(meta):
+    age = time.time() - meta["created"]
+    if age < 3600:
+        age = "{:.0f} min".format(age / 60)
+    elif age < 48 * 3600:
+        age = "{:.0f}h".format(age / 3600)
+    else:
+        age = "{:.0f} days".format(age / (24 * 3600))
+    return "revision {}, trained {} ago".format(meta["revision"] or "unknown", age)
+
+# Puts the best cached profile for the target in place. Returns whether it
+# did, and what it found.
+def restore_pgo_profile(target, revision, max_drift):
+    # Profile formats change between compiler versions, and GCC names .gcda
+    # files after the object paths of the checkout they were trained in
+    usable = [
+        (meta, entry_dir) for meta, entry_dir in get_cached_pgo_profiles(target)
+        if meta["toolchain"] == get_pgo_toolchain_id() and meta["build_dir"] == paths["build"]
+    ]
+    if not usable:
+        return False, "no profile for this toolchain yet"
+    same_revision = [profile for profile in usable if profile[0]["revision"] == revision]
+    meta, entry_dir = (same_revision or usable)[0]
+
+    drift = get_pgo_drift(meta["inputs"])
+    if drift > max_drift:
+        return False, "profile is STALE ({}): {:.0f}% of its sources changed, over {:.0f}%".format(
+            describe_pgo_profile(meta), drift * 100, max_drift * 100)
+
+    profile_dir = get_pgo_dir(target)
+    if os.path.exists(profile_dir):
+        shutil.rmtree(profile_dir)
+    shutil.copytree(entry_dir, profile_dir)
+    os.remove(os.path.join(profile_dir, "meta.json"))
+    message = "using profile from {}".format(describe_pgo_profile(meta))
+    if drift > 0:
+        message += ", {:.0f}% of its sources changed since".format(drift * 100)
+    return True, message
+
+def store_pgo_profile(target, revision):
+    cache_dir = get_pgo_cache_dir(target)
+    entry_dir = os.path.join(cache_dir, revision or "unknown")
+    tmp_dir = entry_dir + ".tmp{}".format(os.getpid())
+    profile_dir = get_pgo_dir(target)
+    if toolchain.family == "clang":
+        os.makedirs(tmp_dir)
+        shutil.copy2(get_pgo_profdata_path(target), tmp_dir)
+    else:
+        shutil.copytree(profile_dir, tmp_dir)
+    write_file_atomic(os.path.join(tmp_dir, "meta.json"), json.dumps({
+        "target": target.name,
+        "revision": revision,
+        "created": time.time(),
+        "toolchain": get_pgo_toolchain_id(),
+        "build_dir": paths["build"],
+        "inputs": get_pgo_inputs(target)
+    }, indent=1).encode("utf-8"))
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.replace(tmp_dir, entry_dir)
+
+    for _, old_dir in get_cached_pgo_profiles(target)[PGO_CACHE_KEEP:]:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def find_llvm_profdata():
+    if PLATFORM == Platform.MAC and shutil.which("xcrun") is not None:
+        return ["xcrun", "llvm-profdata"]
+    major = toolchain.version.split(".")[0]
+    for name in ["llvm-profdata-" + major, "llvm-profdata"]:
+        if shutil.which(name) is not None:
+            return [name]
+    raise Exception("clang PGO builds need llvm-profdata to merge profiles")
+
+def train_pgo_profile(target, training_runs, timeout=None):
+    label = "pgo-train/" + target.name
+    binary_path = os.path.join(paths["build"], target.get_output_name())
+    start = time.perf_counter()
+    for run_args in training_runs:
+        with tracer.span(target.name, "pgo-train", { "args": command_to_string(run_args) }):
+            # Output only goes to the log, training runs can be chatty
+            result = run_process([binary_path] + run_args, paths["build"], label,
+                lambda line: False, timeout=timeout)
+        if result.exit_code != 0:
+            raise Exception("{} training run {} failed ({}), see {}".format(target.name,
+                command_to_string(run_args), result.summary(), result.log_path))
+
+    if toolchain.family == "clang":
+        raw_profiles = list_pgo_profile(target, ".profraw")
+        if not raw_profiles:
+            raise Exception("{} training wrote no profile".format(target.name))
+        result = run_process(find_llvm_profdata() + ["merge", "-o",
+            get_pgo_profdata_path(target)] + raw_profiles, paths["build"], label)
+        if result.exit_code != 0:
+            raise Exception("Merging {}'s profiles failed".format(target.name))
+        for raw_profile in raw_profiles:
+            os.remove(raw_profile)
+    elif not list_pgo_profile(target, ".gcda"):
+        raise Exception("{} training wrote no profile".format(target.name))
+    print_job_line(label, "Trained in {:.2f}s ({} runs)".format(time.perf_counter() - start,
+        len(training_runs)))
+
+def get_library_closure(targets):
+    closure = list(targets)
+    for target in targets:
+        for library in get_linked_libraries(target):
+            if library not in closure:
+                closure.append(library)
+    return closure
+
+def build_pgo(compile_mode, args, if_changed):
+    global pgo_phase
+    training = get_pgo_training()
+    if not training:
+        print("{}: no PGO_TRAINING in app_info, building without profiles".format(
+            compile_mode.name))
+    revision = get_source_revision()
+    max_drift = getattr(app_info, "PGO_MAX_DRIFT", PGO_MAX_DRIFT)
+
+    to_train = []
+    for name in training:
+        target = get_target(name)
+        if args.pgo_train:
+            message = "retraining (--pgo-train)"
+            restored = False
+        else:
+            restored, message = restore_pgo_profile(target, revision, max_drift)
+        print("PGO {}: {}".format(name, message))
+        if not restored:
+            to_train.append(target)
+
+    if to_train:
+        for target in to_train:
+            profile_dir = get_pgo_dir(target)
+            if os.path.exists(profile_dir):
+                shutil.rmtree(profile_dir)
+            os.makedirs(profile_dir)
+
+        # The instrumented build isn't kept, don't deploy or report on it
+        instrument_args = argparse.Namespace(**vars(args))
+        instrument_args.deploy = False
+        instrument_args.no_size_report = True
+        pgo_phase = "generate"
+        print("Building instrumented {}".format(", ".join(target.name for target in to_train)))
+        exit_code = build(compile_mode, instrument_args, if_changed, get_library_closure(to_train))
+        if exit_code != 0:
+            return exit_code
+        for target in to_train:
+            train_pgo_profile(target, training[target.name], args.timeout)
+            store_pgo_profile(target, revision)
+
+    pgo_phase = "use"
+    return build(compile_mode, args, if_changed)
+
+# Profile builds (gprof). Each run of an instrumented executable writes its
+# own gmon.out, which is turned into a flat profile and call graph, as text
+# and JSON, in build/profile/logs/profiles/<target>/<run id>.*, and compared
+# with the previous run of the same target and arguments.
+PROFILE_KEEP = 20 # reports kept per target
+PROFILE_TOP = 15 # functions printed from each profile and comparison
+
+def get_profile_dir(target):
+    return os.path.join(paths["build-logs"], "profiles", target.name)
+
+def parse_profile_number(text):
+    return float(text) if "." in text else int(text)
+
+# A call graph line's numbers (self, children, called), then name and index
+def parse_call_graph_line(line):
+    match = re.match(r"^((?:\s*[\d.]+(?:[/+]\d+)?)*)\s+(.+?)(?:\s+\[(\d+)\])?$", line)
+    if match is None:
+        return None
+    numbers = match.group(1).split()
+    entry = { "name": match.group(2) }
+    if match.group(3) is not None:
+        entry["index"] = int(match.group(3))
+    if len(numbers) >= 2:
+        entry["self_seconds"] = float(numbers[0])
+        entry["children_seconds"] = float(numbers[1])
+    if len(numbers) in [1, 3]:
+        entry["called"] = numbers[-1]
+    return entry
+
+# gprof -b output: the flat profile, then the call graph, then an index
+def parse_gprof_report(text):
+    report = { "sample_seconds": None, "flat": [], "call_graph": [] }
+    section = None
+    node = None
+    for line in text.splitlines():
+        if line.startswith("Flat profile"):
+            section = "flat"
+            continue
+        elif line.strip() == "Call graph":
+            section = "graph"
+            continue
+        elif line.startswith("Index by function name"):
+            break
+
+        if section == "flat":
+            match = re.match(r"^Each sample counts as ([\d.]+) seconds", line)
+            if match is not None:
+                report["sample_seconds"] = float(match.group(1))
+                continue
+            match = re.match(r"^\s*([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+"
+                r"(?:(\d+)\s+([\d.]+)\s+([\d.]+)\s+)?(\S.*)$", line)
+            if match is not None:
+                report["flat"].append({
+                    "name": match.group(7),
+                    "percent": float(match.group(1)),
+                    "cumulative_seconds": float(match.group(2)),
+                    "self_seconds": float(match.group(3)),
+                    "calls": int(match.group(4)) if match.group(4) is not None else None,
+                    "self_ms_per_call": float(match.group(5)) if match.group(5) else None,
+                    "total_ms_per_call": float(match.group(6)) if match.group(6) else None
+                })
+        elif section == "graph":
+            if line.startswith("-----"):
+                node = None
+                continue
+            match = re.match(r"^\[(\d+)\]\s+([\d.]+)\s+(.*)$", line)
+            if match is not None:
+                entry = parse_call_graph_line("   " + match.group(3))
+                node = {
+                    "index": int(match.group(1)),
+                    "name": entry["name"],
+                    "percent": float(match.group(2)),
+                    "self_seconds": entry.get("self_seconds"),
+                    "children_seconds": entry.get("children_seconds"),
+                    "called": entry.get("called"),
+                    "callers": node["callers"] if node is not None else [],
+                    "callees": []
+                }
+                report["call_graph"].append(node)
+                continue
+            if not line.strip() or line.lstrip().startswith(("<spontaneous>", "index ",
+                "granularity:")):
+                continue
+            entry = parse_call_graph_line(line)
+            if entry is None:
+                continue
+            # Lines before an entry's own line are its callers, after it its callees
+            if node is None or "index" not in node:
+                if node is None:
+                    node = { "callers": [] }
+                node["callers"].append(entry)
+            else:
+                node["callees"].append(entry)
+
+    report["total_seconds"] = round(sum(entry["self_seconds"] for entry in report["flat"]), 3)
+    return report
+
+def list_profile_runs(target):
+    profile_dir = get_profile_dir(target)
+    if not os.path.isdir(profile_dir):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(profile_dir)
+        if name.endswith(".json"))
+
+def load_profile_run(target, run_id):
+    with open(os.path.join(get_profile_dir(target), run_id + ".json"), "r") as f:
+        return json.load(f)
+
+# Change in self time and calls of each function, biggest first
+def compare_profiles(profile, baseline):
+    before = { entry["name"]: entry for entry in baseline["flat"] }
+    after = { entry["name"]: entry for entry in profile["flat"] }
+    changes = []
+    for name in set(before) | set(after):
+        old = before.get(name, {})
+        new = after.get(name, {})
+        self_delta = new.get("self_seconds", 0.0) - old.get("self_seconds", 0.0)
+        calls_delta = (new.get("calls") or 0) - (old.get("calls") or 0)
+        if abs(self_delta) > 1e-9 or calls_delta != 0:
+            changes.append({
+                "name": name,
+                "self_seconds": new.get("self_seconds", 0.0),
+                "self_seconds_delta": round(self_delta, 3),
+                "calls": new.get("calls"),
+                "calls_delta": calls_delta
+            })
+    return sorted(changes, key=lambda change: (abs(change["self_seconds_delta"]),
+        abs(change["calls_delta"])), reverse=True)
+
+def format_profile_comparison(profile, baseline, changes):
+    lines = ["Compared with {} ({:.2f}s sampled, now {:.2f}s, {:+.2f}s):".format(
+        baseline["run_id"], baseline["total_seconds"], profile["total_seconds"],
+        profile["total_seconds"] - baseline["total_seconds"])]
+    if not changes:
+        lines.append("  no differences")
+    else:
+        lines.append("  {:>10} {:>10} {:>12}  {}".format("self +/-", "self", "calls +/-",
+            "function"))
+    for change in changes[:PROFILE_TOP]:
+        lines.append("  {:>+9.2f}s {:>9.2f}s {:>+12}  {}".format(change["self_seconds_delta"],
+            change["self_seconds"], change["calls_delta"], change["name"]))
+    return lines
+
+def write_profile_report(target_run, gmon_path, compile_mode, baseline_id=None):
+    target = target_run.target
+    binary_path = os.path.join(paths["build"], target.get_output_name())
+    result = subprocess.run(["gprof", "-b", binary_path, gmon_path], cwd=paths["build"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception("gprof failed for {}: {}".format(target_run.name,
+            result.stderr.decode("utf-8", errors="replace").strip()))
+    text = result.stdout.decode("utf-8", errors="replace")
+
+    previous_runs = list_profile_runs(target)
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    suffix = 1
+    while run_id in previous_runs:
+        suffix += 1
+        run_id = time.strftime("%Y%m%d-%H%M%S") + "-{}".format(suffix)
+    profile = parse_gprof_report(text)
+    profile.update({
+        "run_id": run_id,
+        "target": target.name,
+        "args": target_run.run_args,
+        "mode": compile_mode.name,
+        "revision": get_source_revision(),
+        "created": time.time(),
+        "exit_code": target_run.result.exit_code,
+        "wall_time": round(target_run.result.wall_time, 3)
+    })
+
+    # The last run with the same arguments, unless asked for a specific one
+    baseline = None
+    if baseline_id is not None:
+        if baseline_id not in previous_runs:
+            raise Exception("{} has no profile run {}, it has: {}".format(target.name,
+                baseline_id, ", ".join(previous_runs) or "none"))
+        baseline = load_profile_run(target, baseline_id)
+    else:
+        for previous_id in reversed(previous_runs):
+            previous = load_profile_run(target, previous_id)
+            if previous["args"] == target_run.run_args:
+                baseline = previous
+                break
+    comparison = []
+    if baseline is not None:
+        changes = compare_profiles(profile, baseline)
+        profile["baseline"] = { "run_id": baseline["run_id"], "changes": changes }
+        comparison = format_profile_comparison(profile, baseline, changes)
+
+    profile_dir = get_profile_dir(target)
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    text_path = os.path.join(profile_dir, run_id + ".txt")
+    header = "{} {} ({}), run {}\n\n".format(target.name, command_to_string(target_run.run_args),
+        compile_mode.name, run_id)
+    write_file_atomic(text_path, (header + text + ("\n" + "\n".join(comparison) + "\n"
+        if comparison else "")).encode("utf-8"))
+    write_file_atomic(os.path.join(profile_dir, run_id + ".json"),
+        json.dumps(profile, indent=1).encode("utf-8"))
+    for old_id in list_profile_runs(target)[:-PROFILE_KEEP]:
+        for extension in [".txt", ".json"]:
+            os.remove(os.path.join(profile_dir, old_id + extension))
+
+    label = "profile/" + target_run.name
+    print_job_line(label, "{:.2f}s sampled, top functions by self time:".format(
+        profile["total_seconds"]))
+    for entry in profile["flat"][:PROFILE_TOP]:
+        print_job_line(label, "  {:>6.2f}% {:>8.2f}s {:>10}  {}".format(entry["percent"],
+            entry["self_seconds"], entry["calls"] if entry["calls"] is not None else "",
+            entry["name"]))
+    for line in comparison:
+        print_job_line(label, line)
+    print_job_line(label, "Profile written to " + os.path.relpath(text_path, paths["root"]))
+
+# Builds instrumented, runs PROFILE_RUNS (or TEST_RUNS, or --targets and
+# --run-args), then collects a report for each run
+def build_profile(compile_mode, args, if_changed):
+    if shutil.which("gprof") is None:
+        raise Exception("{} builds need gprof (binutils)".format(compile_mode.name))
+    exit_code = build(compile_mode, args, if_changed)
+    if exit_code != 0:
+        return exit_code
+
+    runs = get_target_runs("profile", args.targets.split(",") if args.targets is not None
+        else None, args.run_args)
+    gmon_dir = os.path.join(paths["build"], "gmon")
+    make_and_clear_dir(gmon_dir)
+    for target_run in runs:
+        # Every run writes <prefix>.<pid>, so runs don't overwrite each other
+        target_run.env = dict(os.environ)
+        target_run.env["GMON_OUT_PREFIX"] = os.path.join(gmon_dir,
+            target_run.name.replace("#", "_"))
+    exit_code = run_targets(runs, args.jobs, args.timeout, args.fail_fast)
+
+    print("")
+    for target_run in runs:
+        prefix = os.path.basename(target_run.env["GMON_OUT_PREFIX"]) + "."
+        gmon_files = [(int(name[len(prefix):]), name) for name in os.listdir(gmon_dir)
+            if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        if not gmon_files:
+            # gmon.out is written on exit(), not when killed or crashing
+            print_job_line("profile/" + target_run.name, "No profile written")
+            continue
+        # Child processes write their own, profile the one that was started
+        gmon_path = os.path.join(gmon_dir, min(gmon_files)[1])
+        write_profile_report(target_run, gmon_path, compile_mode, args.profile_baseline)
+    shutil.rmtree(gmon_dir, ignore_errors=True)
+    return exit_code
+
+def linux_get_build_flags(target, compile_mode):
+    compiler_flags = []
+
+    # Add defines/macros
+    compiler_flags += [d.to_compiler_flag() for d in get_common_defines(compile_mode)]
+
+    # Add general compiler flags
+    compiler_flags += [
+        "-std=c++17",     # use C++17 standard
+        "-fno-rtti",      # disable run-time type info
+        "-fno-exceptions" # disable C++ exceptions (ew)
+    ]
+    compiler_flags += toolchain.get_debug_flags()
+
+    # Add compiler warning flags
+    compiler_flags += [
+        "-Werror",  # treat warnings as errors
+        "-Wall",    # enable all warnings
+
+        "-Wno-char-subscripts", # using char as an array subscript
+    ]
+
+    # Add the compile mode's flags (optimization, warnings, code generation)
+    compiler_flags += compile_mode.get_compiler_flag_list()
+
+    # Add include paths
+    compiler_flags += [
+        "-I" + paths["src"],
+        "-I" + paths["libs-internal"]
+    ] + [ "-I" + path for path in includeDirs.values() ]
+
+    # Library objects may end up in a shared library
+    if target.is_library():
+        compiler_flags += [
+            "-fPIC"
+        ]
+
+    # Add all custom defines + compiler flags
+    compiler_flags += target.get_compiler_flag_list()
+
+    pgo_compiler_flags, pgo_linker_flags = get_pgo_flags(target, compile_mode)
+    compiler_flags += pgo_compiler_flags
+
+    linker_flags = []
 
     # Add general linker flags
-    linker_flags = " ".join([
+    linker_flags += [
         "-fvisibility=hidden"
-    ])
+    ]
+    linker_flags += compile_mode.get_linker_flag_list()
+    linker_flags += pgo_linker_flags
+    linker_flags += toolchain.get_linker_flags()
 
-    # Add libraries
-    linker_flags = " ".join([
-        linker_flags,
+    # Add library targets and compiled external libs, then system libraries
+    linker_flags += get_library_linker_flags(target, compile_mode)
+    linker_flags += [
         "-lm",
         "-lpthread"
-    ])
-
-    # TODO compiled libs aren't added on linux
+    ]
 
     # Add all custom linker flags
-    linker_flags = " ".join([
-        linker_flags,
-        target.get_linker_flags()
-    ])
+    linker_flags += target.get_linker_flag_list()
 
-    exe_name = target.get_output_name()
-    src_name = os.path.join(paths["root"], target.source_file)
+    return toolchain.compiler, compiler_flags, linker_flags
 
-    compile_command = " ".join([
-        "g++-9", compiler_flags, "'" + src_name + "'", "-o " + exe_name, linker_flags
-    ])
+def linux_compile(target, compile_mode, if_changed=False):
+    compiler, compiler_flags, linker_flags = linux_get_build_flags(target, compile_mode)
+    pch = None
+    if target.pch_header is not None:
+        compiler_flags, pch = build_precompiled_header(target, compiler, compiler_flags)
 
-    os.system("bash -c \"" + " ; ".join([
-        "pushd '" + paths["build"] + "' > /dev/null",
-        compile_command,
-        "popd > /dev/null"
-    ]) + "\"")
+    return unix_compile_and_link(target, compile_mode, compiler, compiler_flags, linker_flags,
+        if_changed, pch)
 
-def linux_run():
-    os.system(paths["build"] + os.sep + app_info.PROJECT_NAME + "_linux")
+def linux_run(target, run_args=[]):
+    return subprocess.call([os.path.join(paths["build"], target.get_output_name())] + run_args,
+        cwd=paths["build"])
 
-def mac_compile(target, compile_mode):
-    compiler_flags = ""
+def mac_get_build_flags(target, compile_mode):
+    compiler_flags = []
 
     # Add defines/macros
-    compiler_flags = " ".join([
-        compiler_flags
-    ] + [d.to_compiler_flag() for d in get_common_defines(compile_mode)])
+    compiler_flags += [d.to_compiler_flag() for d in get_common_defines(compile_mode)]
 
     # Add general compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
+    compiler_flags += [
         "-std=c++17",     # use C++17 standard
-        "-ggdb3",         # generate level 3 (max) GDB debug info.
         "-fno-rtti",      # disable run-time type info
         "-fno-exceptions" # disable C++ exceptions (ew)
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-O0", # no optimization
-        ])
-    elif compile_mode == CompileMode.INTERNAL or compile_mode == CompileMode.RELEASE:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-O3", # level 3 optimizations
-        ])
+    ]
+    compiler_flags += toolchain.get_debug_flags()
 
     # Add compiler warning flags
-    compiler_flags = " ".join([
-        compiler_flags,
+    compiler_flags += [
         "-Werror",  # treat warnings as errors
         "-Wall",    # enable all warnings
 
         "-Wno-char-subscripts", # using char as an array subscript
-    ])
-    if compile_mode == CompileMode.DEBUG:
-        compiler_flags = " ".join([
-            compiler_flags,
-            "-Wno-unused-function"  # unused function
-        ])
+    ]
+
+    # Add the compile mode's flags (optimization, warnings, code generation)
+    compiler_flags += compile_mode.get_compiler_flag_list()
 
     # Add include paths
-    compiler_flags = " ".join([
-        compiler_flags,
-        "-I'" + paths["src"] + "'",
-        "-I'" + paths["libs-internal"] + "'"
-    ] + [ "-I'" + path + "'" for path in includeDirs.values() ])
+    compiler_flags += [
+        "-I" + paths["src"],
+        "-I" + paths["libs-internal"]
+    ] + [ "-I" + path for path in includeDirs.values() ]
 
     # Add all custom defines + compiler flags
-    compiler_flags = " ".join([
-        compiler_flags,
-        target.get_compiler_flags()
-    ])
+    compiler_flags += target.get_compiler_flag_list()
 
-    frameworks = " ".join([
-        "-framework Cocoa",
-        "-framework OpenGL",
-        "-framework AudioToolbox",
-        "-framework CoreMIDI"
-    ])
+    pgo_compiler_flags, pgo_linker_flags = get_pgo_flags(target, compile_mode)
+    compiler_flags += pgo_compiler_flags
 
-    linker_flags = ""
+    frameworks = [
+        "-framework", "Cocoa",
+        "-framework", "OpenGL",
+        "-framework", "AudioToolbox",
+        "-framework", "CoreMIDI"
+    ]
+
+    linker_flags = []
 
     # Add general linker flags
-    linker_flags = " ".join([
+    linker_flags += [
         "-fvisibility=hidden"
-    ])
+    ]
+    linker_flags += compile_mode.get_linker_flag_list()
+    linker_flags += pgo_linker_flags
+    linker_flags += toolchain.get_linker_flags()
 
-    # Add libraries
-    linker_flags = " ".join([
-        linker_flags,
+    # Add library targets and compiled external libs, then system libraries
+    linker_flags += get_library_linker_flags(target, compile_mode)
+    linker_flags += [
         "-lm",
         "-lpthread"
-    ])
-
-    # TODO compiled libs aren't added
+    ]
+    linker_flags += frameworks
 
     # Add all custom linker flags
-    linker_flags = " ".join([
-        linker_flags,
-        target.get_linker_flags()
-    ])
+    linker_flags += target.get_linker_flag_list()
 
-    exe_name = target.get_output_name()
-    src_name = os.path.join(paths["root"], target.source_file)
+    return toolchain.compiler, compiler_flags, linker_flags
 
-    compile_command = " ".join([
-        "clang", compiler_flags, "'" + src_name + "'", "-o " + exe_name, linker_flags
-    ])
+def mac_compile(target, compile_mode, if_changed=False):
+    compiler, compiler_flags, linker_flags = mac_get_build_flags(target, compile_mode)
+    return unix_compile_and_link(target, compile_mode, compiler, compiler_flags, linker_flags,
+        if_changed)
 
-    os.system("bash -c \"" + " ; ".join([
-        "pushd '" + paths["build"] + "' > /dev/null",
-        compile_command,
-        "popd > /dev/null"
-    ]) + "\"")
+def mac_run(target, run_args=[]):
+    return subprocess.call([os.path.join(paths["build"], target.get_output_name())] + run_args,
+        cwd=paths["build"])
 
-def mac_run():
-    os.system(paths["build"] + os.sep + app_info.PROJECT_NAME + "_macos")
+HASH_ALGORITHMS = {
+    "md5":     lambda: hashlib.md5(),
+    "sha1":    lambda: hashlib.sha1(),
+    "sha256":  lambda: hashlib.sha256(),
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+}
+hash_algorithm = "md5"
+hash_threads = os.cpu_count() or 1
+
+HASH_READ_SIZE     = 1024 * 1024
+HASH_MMAP_SIZE     = 64 * 1024 * 1024 # files at least this big are mmapped
+HASH_MMAP_SLICE    = 16 * 1024 * 1024
+HASH_SMALL_SIZE    = 64 * 1024        # files under this size are hashed in batches
+HASH_BATCH_SIZE    = 64
+
+def new_hasher(algorithm=None):
+    if algorithm is None:
+        algorithm = hash_algorithm
+    if algorithm not in HASH_ALGORITHMS:
+        raise Exception("Unknown hash algorithm: {}".format(algorithm))
+    return HASH_ALGORITHMS[algorithm]()
+
+def hash_file(file_path, algorithm=None, size=None):
+    hasher = new_hasher(algorithm)
+    with open(file_path, "rb") as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_SIZE:
+            # hashlib drops the GIL on big updates, so mmapped slices hash
+            # without copying and without blocking other hashing threads
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    for offset in range(0, size, HASH_MMAP_SLICE):
+                        hasher.update(view[offset:offset + HASH_MMAP_SLICE])
+                finally:
+                    view.release()
+        elif size < HASH_SMALL_SIZE:
+            hasher.update(f.read())
+        else:
+            buf = bytearray(HASH_READ_SIZE)
+            view = memoryview(buf)
+            while True:
+                num_read = f.readinto(buf)
+                if not num_read:
+                    break
+                hasher.update(view[:num_read])
+
+    return hasher.hexdigest()
+
+# Files that disappear before they're hashed are left out
+def hash_file_batch(file_paths, algorithm, sizes={}):
+    digests = []
+    for file_path in file_paths:
+        try:
+            digests.append((file_path, hash_file(file_path, algorithm, sizes.get(file_path))))
+        except OSError:
+            continue
+    return digests
+
+def hash_files(file_paths, algorithm=None, num_threads=None):
+    if algorithm is None:
+        algorithm = hash_algorithm
+    if num_threads is None:
+        num_threads = hash_threads
+
+    sizes = {}
+    for file_path in file_paths:
+        try:
+            sizes[file_path] = os.path.getsize(file_path)
+        except OSError:
+            sizes[file_path] = 0
+    if num_threads <= 1 or len(file_paths) <= 1:
+        return dict(hash_file_batch(file_paths, algorithm, sizes))
+
+    # Small files are grouped so each task does enough work to be worth
+    # scheduling, big files go out one per task, largest first
+    small_files = [p for p in file_paths if sizes[p] < HASH_SMALL_SIZE]
+    large_files = sorted([p for p in file_paths if sizes[p] >= HASH_SMALL_SIZE],
+        key=lambda p: sizes[p], reverse=True)
+    batches = [[p] for p in large_files] + [
+        small_files[i:i + HASH_BATCH_SIZE] for i in range(0, len(small_files), HASH_BATCH_SIZE)
+    ]
+
+    digests = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for batch_result in executor.map(lambda batch: hash_file_batch(batch, algorithm), batches):
+            digests.update(batch_result)
+    return digests
 
 def calc_file_md5(filePath):
-    md5 = hashlib.md5()
-    with open(filePath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5.update(chunk)
-    
-    return md5.hexdigest()
+    return hash_file(filePath, "md5")
+
+class ManifestDiff:
+    def __init__(self, added, removed, modified, first_scan=False):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+        self.first_scan = first_scan
+
+    def changed_paths(self):
+        return self.added + self.removed + self.modified
+
+    def is_empty(self):
+        return not self.first_scan and not (self.added or self.removed or self.modified)
+
+    def summary(self):
+        return "{} added, {} removed, {} modified".format(
+            len(self.added), len(self.removed), len(self.modified))
+
+class SourceManifest:
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {} # path -> [size, mtime_ns, inode, digest]
+        self.loaded = False
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == SourceManifest.VERSION \
+                and data.get("algorithm") == hash_algorithm:
+                    self.files = data["files"]
+                    self.loaded = True
+            except (ValueError, KeyError):
+                print("Source manifest {} is corrupt, rehashing everything".format(self.path))
+
+    @staticmethod
+    def walk_files(root):
+        dirs = [root]
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                entries = list(os.scandir(dir_path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    # Editors' swap and temp files come and go during the scan
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    yield entry.path, stat
+
+    def stat_matches(self, entry, stat):
+        return entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns \
+            and entry[2] == stat.st_ino
+
+    def get_digest(self, file_path, stat=None):
+        if stat is None:
+            stat = os.stat(file_path)
+        with self.lock:
+            entry = self.files.get(file_path)
+            if entry is not None and self.stat_matches(entry, stat):
+                return entry[3]
+
+        digest = hash_file(file_path, size=stat.st_size)
+        with self.lock:
+            self.files[file_path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+            self.dirty = True
+        return digest
+
+    def update(self, roots):
+        roots = [os.path.join(root, "") for root in roots]
+        seen = set()
+        stale = {}
+        with self.lock:
+            for root in roots:
+                for file_path, stat in SourceManifest.walk_files(root):
+                    seen.add(file_path)
+                    old_entry = self.files.get(file_path)
+                    if old_entry is None or not self.stat_matches(old_entry, stat):
+                        stale[file_path] = stat
+
+        added = []
+        modified = []
+        digests = hash_files(list(stale))
+        with self.lock:
+            for file_path, stat in stale.items():
+                if file_path not in digests:
+                    seen.discard(file_path) # gone before it was hashed
+                    continue
+                old_entry = self.files.get(file_path)
+                if old_entry is None:
+                    added.append(file_path)
+                elif old_entry[3] != digests[file_path]:
+                    modified.append(file_path)
+                self.files[file_path] = [
+                    stat.st_size, stat.st_mtime_ns, stat.st_ino, digests[file_path]
+                ]
+                self.dirty = True
+
+        # Files outside the scanned roots (e.g. system headers) are left alone
+        removed = []
+        with self.lock:
+            for file_path in list(self.files):
+                if file_path not in seen and file_path.startswith(tuple(roots)):
+                    removed.append(file_path)
+                    del self.files[file_path]
+                    self.dirty = True
+
+        return ManifestDiff(sorted(added), sorted(removed), sorted(modified),
+            first_scan=not self.loaded)
+
+    def apply_changes(self, file_paths):
+        added = []
+        removed = []
+        modified = []
+        for file_path in sorted(file_paths):
+            with self.lock:
+                old_entry = self.files.get(file_path)
+            digest = None
+            if os.path.isfile(file_path):
+                try:
+                    digest = self.get_digest(file_path)
+                except OSError:
+                    pass # removed since
+            if digest is not None:
+                old_digest = old_entry[3] if old_entry is not None else None
+                if old_entry is None:
+                    added.append(file_path)
+                elif old_digest != digest:
+                    modified.append(file_path)
+            elif old_entry is not None:
+                with self.lock:
+                    del self.files[file_path]
+                    self.dirty = True
+                removed.append(file_path)
+        return ManifestDiff(added, removed, modified)
+
+    def retain(self, file_paths):
+        file_paths = set(file_paths)
+        with self.lock:
+            for file_path in list(self.files):
+                if file_path not in file_paths:
+                    del self.files[file_path]
+                    self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty and self.loaded:
+                return
+            data = {
+                "version": SourceManifest.VERSION,
+                "algorithm": hash_algorithm,
+                "files": self.files
+            }
+            write_file_atomic(self.path, json.dumps(data).encode("utf-8"))
+            self.dirty = False
+            self.loaded = True
+
+source_manifest = None
+
+def get_source_manifest():
+    global source_manifest
+    if source_manifest is None:
+        source_manifest = SourceManifest(paths["src-manifest"])
+    return source_manifest
+
+def get_manifest_roots():
+    return [path for path in [paths["src"], paths["libs-internal"]] if os.path.isdir(path)]
 
 def compute_src_hashes():
-    with open(paths["src-hashes"], "w") as out:
-        for root, _, files in os.walk(paths["src"]):
-            for fileName in files:
-                filePath = os.path.join(root, fileName)
-                out.write(filePath + "\n")
-                out.write(calc_file_md5(filePath) + "\n")
+    with tracer.span("source manifest", "manifest-hashing") as span:
+        manifest = get_source_manifest()
+        diff = manifest.update(get_manifest_roots())
+        manifest.save()
+        span.args = { "changes": diff.summary() }
+    return diff
 
 def did_files_change():
-    hashPath = paths["src-hashes"]
-    oldHashPath = paths["src-hashes-old"]
-
-    if os.path.exists(hashPath):
-        if os.path.exists(oldHashPath):
-            os.remove(oldHashPath)
-        os.rename(hashPath, oldHashPath)
-    else:
+    diff = compute_src_hashes()
+    if diff.first_scan:
         return True
+    if not diff.is_empty():
+        print("Source changes: " + diff.summary())
+    return not diff.is_empty()
 
-    compute_src_hashes()
-    if os.path.getsize(hashPath) != os.path.getsize(oldHashPath) \
-    or open(hashPath, "r").read() != open(oldHashPath, "r").read():
-        return True
+ASSET_CACHE_VERSION = 1
 
-    return False
+class AssetStats:
+    def __init__(self, processor):
+        self.processor = processor
+        self.processed = 0
+        self.restored = 0
+        self.up_to_date = 0
+        self.failed = 0
+        self.time = 0.0 # summed over processes
+
+    def to_json(self):
+        return {
+            "version": self.processor.version, "processed": self.processed,
+            "restored": self.restored, "up_to_date": self.up_to_date, "failed": self.failed,
+            "time": round(self.time, 3)
+        }
+
+def get_asset_processor(rel_path):
+    for processor in app_info.ASSET_PROCESSORS:
+        if processor.matches(rel_path):
+            return processor
+    return None
+
+def get_asset_key(processor, digest):
+    key = hashlib.sha256()
+    for part in [ASSET_CACHE_VERSION, app_info.PROJECT_NAME, processor.name, processor.version,
+        hash_algorithm, digest]:
+        key.update(str(part).encode("utf-8") + b"\0")
+    return key.hexdigest()
+
+# Runs in a pool process
+def run_asset_processor(func, src_path, dst_path):
+    start = time.perf_counter()
+    func(src_path, dst_path)
+    return time.perf_counter() - start
+
+def load_asset_outputs():
+    if os.path.exists(paths["asset-outputs"]):
+        try:
+            with open(paths["asset-outputs"], "r") as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return {}
+
+def process_assets(num_processes=None):
+    processors = getattr(app_info, "ASSET_PROCESSORS", [])
+    if not processors or not os.path.isdir(paths["data"]):
+        return 0
+    if num_processes is None:
+        num_processes = os.cpu_count() or 1
+
+    start = time.perf_counter()
+    stats = { processor.name: AssetStats(processor) for processor in processors }
+    manifest = SourceManifest(paths["asset-manifest"])
+    cache = CompileCache(paths["asset-cache"],
+        getattr(app_info, "ASSET_CACHE_SIZE_MB", 5 * 1024) * 1024 * 1024)
+    old_outputs = load_asset_outputs() # output path -> key it was made from
+    outputs = {}
+
+    with tracer.span("assets", "assets") as span:
+        assets = []
+        for file_path, stat in SourceManifest.walk_files(paths["data"]):
+            rel_path = os.path.relpath(file_path, paths["data"]).replace(os.sep, "/")
+            processor = get_asset_processor(rel_path)
+            if processor is not None:
+                assets.append((file_path, stat, rel_path, processor))
+        with ThreadPoolExecutor(max_workers=hash_threads) as executor:
+            digests = list(executor.map(
+                lambda asset: manifest.get_digest(asset[0], asset[1]), assets))
+        manifest.retain(asset[0] for asset in assets)
+        manifest.save()
+
+        todo = []
+        for (file_path, stat, rel_path, processor), digest in zip(assets, digests):
+            output_rel_path = processor.get_output_path(rel_path)
+            output_path = os.path.join(paths["build-assets"], normalize_path_slashes(output_rel_path))
+            key = get_asset_key(processor, digest)
+            if output_rel_path in outputs:
+                raise Exception("Assets {} and {} both produce {}".format(
+                    outputs[output_rel_path][1], rel_path, output_rel_path))
+            outputs[output_rel_path] = (key, rel_path)
+
+            if old_outputs.get(output_rel_path) == key and os.path.exists(output_path):
+                stats[processor.name].up_to_date += 1
+                continue
+            if not os.path.exists(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            if cache.restore(key, output_path):
+                stats[processor.name].restored += 1
+                continue
+            todo.append((file_path, stat.st_size, output_path, key, rel_path, processor))
+
+        # Outputs whose source is gone
+        for output_rel_path in old_outputs:
+            output_path = os.path.join(paths["build-assets"], normalize_path_slashes(output_rel_path))
+            if output_rel_path not in outputs and os.path.exists(output_path):
+                os.remove(output_path)
+
+        # Biggest first, so one large asset doesn't finish last on its own
+        todo.sort(key=lambda asset: asset[1], reverse=True)
+        failed = set()
+        if todo:
+            with ProcessPoolExecutor(max_workers=max(1, min(num_processes, len(todo)))) as executor:
+                futures = [
+                    (executor.submit(run_asset_processor, processor.func, file_path,
+                        output_path + ".asset-tmp"), output_path, key, rel_path, processor)
+                    for file_path, _, output_path, key, rel_path, processor in todo
+                ]
+                for future, output_path, key, rel_path, processor in futures:
+                    try:
+                        stats[processor.name].time += future.result()
+                        os.replace(output_path + ".asset-tmp", output_path)
+                    except Exception as e:
+                        print("{}: {} failed: {}".format(rel_path, processor.name, str(e)))
+                        stats[processor.name].failed += 1
+                        failed.add(processor.get_output_path(rel_path))
+                        if os.path.exists(output_path + ".asset-tmp"):
+                            os.remove(output_path + ".asset-tmp")
+                        continue
+                    cache.store(key, output_path, evict=False)
+                    stats[processor.name].processed += 1
+            cache.evict()
+        cache.save_stats()
+
+        write_file_atomic(paths["asset-outputs"], json.dumps({
+            output_rel_path: key for output_rel_path, (key, _) in outputs.items()
+            if output_rel_path not in failed
+        }, indent=2, sort_keys=True).encode("utf-8"))
+        span.args = { name: stat.to_json() for name, stat in stats.items() }
+
+    elapsed = time.perf_counter() - start
+    print("Assets: {} processed, {} from cache, {} up to date{} in {:.2f}s".format(
+        sum(stat.processed for stat in stats.values()),
+        sum(stat.restored for stat in stats.values()),
+        sum(stat.up_to_date for stat in stats.values()),
+        ", {} FAILED".format(len(failed)) if failed else "", elapsed))
+    for name, stat in stats.items():
+        if stat.processed or stat.failed:
+            print("  {:<24} {:5} processed {:9.2f}s ({:.3f}s each)".format(
+                "{} (v{})".format(name, stat.processor.version), stat.processed, stat.time,
+                stat.time / max(1, stat.processed + stat.failed)))
+    if os.path.exists(paths["build-logs"]):
+        write_file_atomic(os.path.join(paths["build-logs"], "asset_stats.json"), json.dumps({
+            "time": round(elapsed, 3),
+            "processors": { name: stat.to_json() for name, stat in stats.items() }
+        }, indent=2).encode("utf-8"))
+    return 1 if failed else 0
 
 def clean():
-    make_and_clear_dir(paths["build"])
+    # Build history outlives clean
+    make_and_clear_dir(paths["build"], [paths["build-logs"]])
+    make_and_clear_dir(paths["build-logs"], [paths["build-history"]])
     make_and_clear_dir(paths["deploy"])
 
-def run(target):
+def run(target, run_args=[]):
+    if PLATFORM == Platform.WINDOWS:
+        return win_run(target, run_args)
+    elif PLATFORM == Platform.LINUX:
+        return linux_run(target, run_args)
+    elif PLATFORM == Platform.MAC:
+        return mac_run(target, run_args)
+    else:
+        raise Exception("Unsupported platform: " + PLATFORM)
+
+RUN_LOG_TAIL_LINES = 10
+
+class TargetRun:
+    def __init__(self, name, target, run_args):
+        self.name = name
+        self.target = target
+        self.run_args = run_args
+        self.env = None
+        self.result = None
+
+    def get_command(self):
+        return [os.path.join(paths["build"], self.target.get_output_name())] + self.run_args
+
+def get_executable_targets(names=None):
+    executables = [
+        target for target in app_info.TARGETS if target.type.value == TargetType.EXECUTABLE.value
+    ]
+    if names is None:
+        return executables
+    targets = []
+    for name in names:
+        target = get_target(name)
+        if target is None:
+            raise Exception("Unknown target: " + name)
+        if target not in executables:
+            raise Exception("{} isn't an executable, it can't be run".format(name))
+        targets.append(target)
+    return targets
+
+# run takes the first executable, test every executable, or the ones in
+# app_info.TEST_RUNS ({ target name: [args, ...] }, one run per args).
+# profile takes app_info.PROFILE_RUNS the same way, or else TEST_RUNS.
+# Targets and args given on the command line replace any of them.
+def get_target_runs(mode, target_names=None, run_args=None):
+    test_runs = getattr(app_info, "TEST_RUNS", {})
+    if mode == "profile":
+        test_runs = getattr(app_info, "PROFILE_RUNS", test_runs)
+    if target_names is not None:
+        targets = get_executable_targets(target_names)
+    elif mode in ["test", "profile"]:
+        targets = get_executable_targets(list(test_runs) if test_runs else None)
+    else:
+        targets = get_executable_targets()[:1]
+    if not targets:
+        raise Exception("There are no executable targets to run")
+
+    runs = []
+    for target in targets:
+        if run_args is not None:
+            arg_sets = [shlex.split(args) for args in run_args]
+        elif mode in ["test", "profile"]:
+            arg_sets = [list(args) for args in test_runs.get(target.name, [[]])]
+        else:
+            arg_sets = [[]]
+        for i, args in enumerate(arg_sets):
+            name = target.name if len(arg_sets) == 1 else "{}#{}".format(target.name, i + 1)
+            runs.append(TargetRun(name, target, args))
+    return runs
+
+def run_targets(runs, num_jobs, timeout=None, fail_fast=False):
+    for target_run in runs:
+        if not os.path.exists(target_run.get_command()[0]):
+            raise Exception("{} isn't built, compile it first".format(target_run.target.name))
+
+    # Several at once would interleave their output, so it only goes to the logs
+    quiet = len(runs) > 1 and num_jobs > 1
+    scheduler = BuildScheduler(num_jobs, fail_fast)
+    for target_run in runs:
+        def run_one(target_run=target_run):
+            target_run.result = run_process(target_run.get_command(), paths["build"],
+                "run/" + target_run.name, (lambda line: False) if quiet else None,
+                env=target_run.env, timeout=timeout)
+            if target_run.result.timed_out:
+                print_job_line("run/" + target_run.name, "Timed out after {:.0f}s".format(timeout))
+            return target_run.result.exit_code
+        scheduler.add_job("run/" + target_run.name, run_one)
+    start = time.perf_counter()
+    exit_code = scheduler.run()
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in runs if r.result is not None and r.result.exit_code != 0]
+    print("")
+    print("Ran {} processes in {:.2f}s (sum {:.2f}s, -j {}), {} failed".format(
+        len(runs), elapsed, sum(r.result.wall_time for r in runs if r.result is not None),
+        num_jobs, len(failed)))
+    print("  {:<24} {:>9} {:>9} {:>9}  {}".format("run", "exit", "time", "peak RSS", "log"))
+    summary = []
+    for target_run in runs:
+        result = target_run.result
+        if result is None:
+            print("  {:<24} {:>9}".format(target_run.name, "skipped"))
+            continue
+        status = "timeout" if result.timed_out else str(result.exit_code)
+        print("  {:<24} {:>9} {:>8.2f}s {:>6.0f} MB  {}".format(target_run.name, status,
+            result.wall_time, result.peak_rss / (1024 * 1024),
+            os.path.relpath(result.log_path, paths["root"])))
+        summary.append({
+            "name": target_run.name, "target": target_run.target.name,
+            "args": target_run.run_args, "exit_code": result.exit_code,
+            "timed_out": result.timed_out, "time": round(result.wall_time, 3),
+            "peak_rss": result.peak_rss, "log": result.log_path
+        })
+    write_file_atomic(os.path.join(paths["build-logs"], "run_summary.json"),
+        json.dumps(summary, indent=2).encode("utf-8"))
+
+    # The end of each failure's output, the rest is in its log
+    if quiet:
+        for target_run in failed:
+            with open(target_run.result.log_path, "r", errors="replace") as f:
+                lines = [line for line in f.read().splitlines() if not line.startswith(("$ ", "# "))]
+            print("")
+            print("{} (last {} lines):".format(target_run.name, RUN_LOG_TAIL_LINES))
+            for line in lines[-RUN_LOG_TAIL_LINES:]:
+                print("  " + line)
+    return exit_code
+
+def compile_target(target, compile_mode, if_changed=False):
     if PLATFORM == Platform.WINDOWS:
-        win_run(target)
+        if target.is_library():
+            raise Exception("{}: library targets aren't supported on Windows".format(target.name))
+        return win_compile(target, compile_mode)
     elif PLATFORM == Platform.LINUX:
-        linux_run(target)
+        return linux_compile(target, compile_mode, if_changed)
     elif PLATFORM == Platform.MAC:
-        mac_run(target)
+        return mac_compile(target, compile_mode, if_changed)
     else:
         raise Exception("Unsupported platform: " + PLATFORM)
 
+def schedule_targets(scheduler, compile_mode, deploy, if_changed=False, num_shards=None,
+    targets=None, size_reports=False, size_threshold=None):
+    if targets is None:
+        targets = app_info.TARGETS
+    target_names = set(target.name for target in targets)
+
+    for target in targets:
+        # Dependencies left out of a partial build are assumed up to date
+        depends = [dep for dep in target.depends if dep in target_names]
+        shards = None
+        if target.is_sharded():
+            if PLATFORM == Platform.WINDOWS:
+                print("{}: sharded builds aren't supported on Windows, compiling {}".format(
+                    target.name, target.source_file))
+            else:
+                shards = get_target_shards(target, num_shards)
+        object_build = worker_pool is not None or target.is_library() \
+            or (toolchain is not None and toolchain.fast_iteration)
+        if shards is None and object_build and PLATFORM != Platform.WINDOWS:
+            # Libraries are archived or linked from objects, workers only take object
+            # compiles, and split DWARF needs an object for its .dwo to sit next to,
+            # so build the unity file as one object
+            shards = [SourceShard(target.name, target.name,
+                os.path.join(paths["root"], target.source_file))]
+
+        if shards is None:
+            scheduler.add_job(target.name,
+                lambda target=target: compile_target(target, compile_mode, if_changed),
+                depends)
+            continue
+
+        # One job per object, then the target's own job links them
+        for shard in shards:
+            scheduler.add_job(shard.job_name,
+                lambda target=target, shard=shard: compile_shard(target, compile_mode, shard,
+                    if_changed),
+                depends)
+        scheduler.add_job(target.name,
+            lambda target=target, shards=shards: link_shards(target, compile_mode, shards,
+                if_changed),
+            depends + [shard.job_name for shard in shards])
+
+    # Size reports read ELF binaries, or the .map files Windows links write
+    if size_reports and PLATFORM != Platform.MAC:
+        for target in targets:
+            if not target.is_static_library():
+                scheduler.add_job("size-" + target.name,
+                    lambda target=target: report_binary_size(target, compile_mode, size_threshold),
+                    [target.name])
+
+    # Deploys package the whole build directory, so they wait for every
+    # compile, and run one after the other (each one compresses on all cores)
+    if deploy:
+        deploy_func = win_deploy if PLATFORM == Platform.WINDOWS else unix_deploy
+        deploy_depends = [target.name for target in targets]
+        for target in targets:
+            if target.is_library():
+                continue
+            job = scheduler.add_job("deploy-" + target.name,
+                lambda target=target: deploy_func(target),
+                list(deploy_depends))
+            deploy_depends.append(job.name)
+
+HISTORY_VERSION = 1
+HISTORY_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS builds (
+        id INTEGER PRIMARY KEY, started REAL, mode TEXT, platform TEXT, revision TEXT,
+        toolchain TEXT, flag_hash TEXT, jobs INTEGER, if_changed INTEGER, duration REAL,
+        exit_code INTEGER, num_targets INTEGER, compiled_objects INTEGER, cache_hits INTEGER,
+        copied_bytes INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS targets (
+        build_id INTEGER REFERENCES builds (id), name TEXT, flag_hash TEXT, exit_code INTEGER,
+        objects INTEGER, compiled_objects INTEGER, cached_objects INTEGER, compile_time REAL,
+        link_time REAL, binary_size INTEGER)""",
+    "CREATE INDEX IF NOT EXISTS targets_name ON targets (name, build_id)",
+]
+HISTORY_WINDOW = 10       # builds in the rolling baseline
+HISTORY_MIN_BASELINE = 3  # fewer comparable builds than this aren't judged
+HISTORY_MIN_DELTA = 0.25  # seconds, smaller slowdowns are noise
+
+def open_build_history():
+    history_dir = os.path.dirname(paths["build-history"])
+    if not os.path.exists(history_dir):
+        os.makedirs(history_dir)
+    # Builds of several modes at once write from separate processes
+    db = sqlite3.connect(paths["build-history"], timeout=30)
+    if db.execute("PRAGMA user_version").fetchone()[0] != HISTORY_VERSION:
+        for statement in HISTORY_SCHEMA:
+            db.execute(statement)
+        db.execute("PRAGMA user_version = {}".format(HISTORY_VERSION))
+        db.commit()
+    return db
+
+def get_source_revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=paths["root"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return result.stdout.decode("utf-8").strip() if result.returncode == 0 else None
+
+def get_target_flag_hash(target, compile_mode):
+    if PLATFORM == Platform.WINDOWS:
+        return None
+    compiler, compiler_flags, linker_flags = get_unix_build_flags(target, compile_mode)
+    return hash_string(command_to_string([get_compiler_version(compiler) or compiler]
+        + compiler_flags + ["--"] + linker_flags))
+
+def record_build_history(scheduler, compile_mode, args, if_changed, targets, exit_code):
+    with tracer.lock:
+        events = list(tracer.events)
+    duration = time.perf_counter() - tracer.start
+
+    rows = []
+    for target in targets:
+        prefix = target.name + "/"
+        compiles = [e for e in events if e["cat"] in ["compile", "compile+link"]
+            and (e["name"] == target.name or e["name"].startswith(prefix))]
+        links = [e for e in events if e["cat"] == "link" and e["name"] == target.name]
+        cached = sum(1 for e in compiles if e.get("args", {}).get("cached"))
+        output_path = os.path.join(paths["build"], target.get_output_name())
+        job = scheduler.jobs.get(target.name)
+        rows.append({
+            "name": target.name,
+            "flag_hash": get_target_flag_hash(target, compile_mode),
+            "exit_code": job.exit_code if job is not None else None,
+            "objects": max(1, sum(1 for name in scheduler.jobs if name.startswith(prefix))),
+            "compiled_objects": len(compiles) - cached,
+            "cached_objects": cached,
+            "compile_time": sum(e["dur"] for e in compiles) / 1000000,
+            "link_time": sum(e["dur"] for e in links) / 1000000 if links else None,
+            "binary_size": os.path.getsize(output_path) if os.path.exists(output_path) else None,
+        })
+
+    build_row = {
+        "started": time.time() - duration,
+        "mode": compile_mode.name,
+        "platform": PLATFORM.value,
+        "revision": get_source_revision(),
+        "toolchain": toolchain.describe() if toolchain is not None else None,
+        "flag_hash": hash_string("".join(str(row["flag_hash"]) for row in rows)),
+        "jobs": args.jobs,
+        "if_changed": 1 if if_changed else 0,
+        "duration": duration,
+        "exit_code": exit_code,
+        "num_targets": len(rows),
+        "compiled_objects": sum(row["compiled_objects"] for row in rows),
+        "cache_hits": sum(row["cached_objects"] for row in rows),
+        "copied_bytes": sum(e.get("args", {}).get("copied bytes", 0) for e in events
+            if e["cat"] == "copy-dirs"),
+    }
+
+    db = open_build_history()
+    try:
+        cursor = db.execute("INSERT INTO builds ({}) VALUES ({})".format(
+            ", ".join(build_row), ", ".join("?" * len(build_row))), list(build_row.values()))
+        for row in rows:
+            row["build_id"] = cursor.lastrowid
+            db.execute("INSERT INTO targets ({}) VALUES ({})".format(
+                ", ".join(row), ", ".join("?" * len(row))), list(row.values()))
+        db.commit()
+    finally:
+        db.close()
+
+# Compares a value against the median of earlier comparable ones, returns
+# (baseline, change) when it's more than threshold (a fraction) above it
+def check_regression(value, earlier, threshold, min_delta=0.0):
+    if value is None or len(earlier) < HISTORY_MIN_BASELINE:
+        return None
+    baseline = statistics.median(earlier)
+    if baseline > 0 and value > baseline * (1 + threshold) and value - baseline > min_delta:
+        return baseline, value / baseline - 1
+    return None
+
+def format_size(size):
+    if size is None:
+        return "-"
+    if size < 1024 * 1024:
+        return "{:.1f} KB".format(size / 1024)
+    return "{:.1f} MB".format(size / (1024 * 1024))
+
+def format_regression(regression, format_value):
+    baseline, change = regression
+    return "REGRESSED +{:.0f}% (baseline {})".format(change * 100, format_value(baseline))
+
+# Builds are compared with earlier ones of the same mode and flags that
+# compiled the same number of objects. Targets are compared by full compiles
+# (no object skipped or restored from cache), links and output size.
+def show_history(mode, limit, threshold, window):
+    if not os.path.exists(paths["build-history"]):
+        print("No build history yet, it's recorded by every build")
+        return 0
+    db = open_build_history()
+    db.row_factory = sqlite3.Row
+    try:
+        where = "WHERE mode = ?" if mode is not None else ""
+        builds = db.execute("SELECT * FROM builds {} ORDER BY id DESC LIMIT ?".format(where),
+            ([mode] if mode is not None else []) + [limit]).fetchall()[::-1]
+        if not builds:
+            print("No builds recorded{}".format(" for " + mode if mode is not None else ""))
+            return 0
+
+        print("Build history ({}), last {} builds, regressions over {:.0f}%:".format(
+            os.path.relpath(paths["build-history"], paths["root"]), len(builds), threshold * 100))
+        mode_width = max(len("mode"), max(len(build_row["mode"]) for build_row in builds))
+        row_format = "  {:>5}  {:<16}  {:<" + str(mode_width) + "} {:>9} {:>6} {:>6} {:>10}  {}"
+        print(row_format.format("#", "date", "mode", "time", "built", "cached", "copied", "result"))
+        regressed_builds = 0
+        for build_row in builds:
+            earlier = [row["duration"] for row in db.execute(
+                "SELECT duration FROM builds WHERE id < ? AND mode = ? AND flag_hash = ? "
+                "AND compiled_objects = ? AND exit_code = 0 ORDER BY id DESC LIMIT ?",
+                [build_row["id"], build_row["mode"], build_row["flag_hash"],
+                    build_row["compiled_objects"], window])]
+            result = "ok" if build_row["exit_code"] == 0 else "FAILED"
+            regression = check_regression(build_row["duration"], earlier, threshold,
+                HISTORY_MIN_DELTA) if build_row["exit_code"] == 0 else None
+            if regression is not None:
+                result += "  " + format_regression(regression, "{:.2f}s".format)
+                regressed_builds += 1
+            print(row_format.format(
+                build_row["id"], time.strftime("%Y-%m-%d %H:%M",
+                    time.localtime(build_row["started"])),
+                build_row["mode"], "{:.2f}s".format(build_row["duration"]),
+                build_row["compiled_objects"],
+                build_row["cache_hits"], format_size(build_row["copied_bytes"]), result))
+
+        regressed_targets = 0
+        for build_mode in sorted(set(build_row["mode"] for build_row in builds)):
+            print("")
+            print("Targets ({}), latest against the median of up to {} earlier builds:".format(
+                build_mode, window))
+            names = [row["name"] for row in db.execute(
+                "SELECT DISTINCT targets.name FROM targets JOIN builds ON builds.id = build_id "
+                "WHERE builds.mode = ? ORDER BY targets.name", [build_mode])]
+            for name in names:
+                lines = []
+                for label, column, condition, format_value, min_delta in [
+                    ("compile", "compile_time",
+                        "targets.compiled_objects = objects AND cached_objects = 0",
+                        "{:.2f}s".format, HISTORY_MIN_DELTA),
+                    ("link", "link_time", "link_time IS NOT NULL",
+                        "{:.2f}s".format, HISTORY_MIN_DELTA),
+                    ("size", "binary_size", "binary_size IS NOT NULL", format_size, 0),
+                ]:
+                    rows = db.execute(
+                        "SELECT {0}, targets.flag_hash FROM targets JOIN builds ON builds.id = build_id "
+                        "WHERE name = ? AND builds.mode = ? AND targets.exit_code = 0 AND {1} "
+                        "ORDER BY build_id DESC LIMIT ?".format(column, condition),
+                        [name, build_mode, window + 1]).fetchall()
+                    if not rows:
+                        continue
+                    latest = rows[0]
+                    # Only builds with the same flags count towards the baseline
+                    earlier = [row[0] for row in rows[1:] if row[1] == latest[1]]
+                    trend = " ".join(format_value(row[0]) for row in reversed(rows[:8]))
+                    line = "{:<8} {:>10}   recent: {}".format(label, format_value(latest[0]), trend)
+                    regression = check_regression(latest[0], earlier, threshold, min_delta)
+                    if regression is not None:
+                        line += "   " + format_regression(regression, format_value)
+                        regressed_targets += 1
+                    lines.append(line)
+                for i, line in enumerate(lines):
+                    print("  {:<20} {}".format(name if i == 0 else "", line))
+    finally:
+        db.close()
+
+    if regressed_builds or regressed_targets:
+        print("")
+        print("{} build and {} target regressions".format(regressed_builds, regressed_targets))
+        return 1
+    return 0
+
+def build(compile_mode, args, if_changed, targets=None):
+    global tracer, pch_time_saved
+    # The first build keeps the tracer that saw startup (copies, assets)
+    if tracer.written:
+        tracer = BuildTracer()
+    tracer.metadata["mode"] = compile_mode.name
+    if toolchain is not None:
+        tracer.metadata["toolchain"] = toolchain.describe()
+    pch_time_saved = 0.0
+
+    throttle = None
+    if not args.no_throttle:
+        throttle = JobThrottle(resource_history, args.max_load,
+            args.memory_reserve * 1024 * 1024 if args.memory_reserve is not None else None)
+    scheduler = BuildScheduler(args.jobs, args.fail_fast, throttle, jobserver)
+    schedule_targets(scheduler, compile_mode, args.deploy, if_changed, args.shards, targets,
+        not args.no_size_report, args.regression_threshold / 100)
+    exit_code = scheduler.run()
+    if scheduler.waits:
+        tracer.metadata["throttled"] = { reason: round(duration, 3)
+            for reason, duration in scheduler.waits.items() }
+    get_source_manifest().save()
+    if resource_history is not None:
+        resource_history.save()
+    if exit_code == 0:
+        with open(paths["last-build-mode"], "w") as f:
+            f.write(compile_mode.name)
+    tracer.write(paths["build-trace"], paths["build-summary"])
+    print("Build trace written to " + paths["build-trace"])
+    # A PGO build records one row, for the build with the profile, not the
+    # instrumented build of the trained targets before it
+    if pgo_phase != "generate":
+        try:
+            record_build_history(scheduler, compile_mode, args, if_changed,
+                targets if targets is not None else app_info.TARGETS, exit_code)
+        except sqlite3.Error as e:
+            print("Failed to record build history: {}".format(str(e)))
+    if pch_time_saved > 0:
+        print("Precompiled headers saved ~{:.2f}s of compile time".format(pch_time_saved))
+    if compile_cache is not None:
+        compile_cache.print_stats()
+    if worker_pool is not None:
+        worker_pool.print_stats()
+    return exit_code
+
+def get_last_build_mode():
+    last_mode_path = os.path.join(paths["root"], "build", "last_mode")
+    if os.path.exists(last_mode_path):
+        with open(last_mode_path, "r") as f:
+            return f.read().strip()
+    return "debug"
+
+def get_forwarded_args(argv, mode_arg):
+    forwarded = []
+    skip_next = False
+    mode_seen = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+        elif arg == mode_arg and not mode_seen:
+            mode_seen = True
+        elif arg in ["-j", "--jobs"]:
+            skip_next = True
+        elif not arg.startswith("--jobs=") and not (arg.startswith("-j") and arg[2:].isdigit()):
+            forwarded.append(arg)
+    return forwarded
+
+# Builds several compile modes at once. Each one runs in its own process,
+# since build state (paths, manifest, dependency graph) is per process.
+def build_modes(compile_modes, args):
+    global prefix_output
+    prefix_output = True
+    # No more modes at once than -j allows, and the jobs left over from an
+    # uneven split go to the first ones
+    running = max(1, min(len(compile_modes), args.jobs))
+    mode_jobs = [
+        max(1, args.jobs // running + (1 if index < args.jobs % running else 0))
+        for index in range(len(compile_modes))
+    ]
+    forwarded = get_forwarded_args(sys.argv[1:], args.mode)
+    env = dict(os.environ)
+    env["PYTHONUNBUFFERED"] = "1"
+    pass_fds = ()
+    if jobserver is not None:
+        # Each mode holds a token here for its own first job, and takes more
+        # from make as it goes, so there's no need to split -j
+        running = len(compile_modes)
+        mode_jobs = [args.jobs] * len(compile_modes)
+        pass_fds = jobserver.pass_fds
+
+    scheduler = BuildScheduler(running, args.fail_fast, jobserver=jobserver)
+    for mode, jobs in zip(compile_modes, mode_jobs):
+        command = [sys.executable, os.path.abspath(__file__), mode, "-j", str(jobs)] + forwarded
+        scheduler.add_job(mode,
+            lambda command=command, mode=mode: run_process(command, paths["root"], mode,
+                env=env, pass_fds=pass_fds).exit_code)
+    start = time.time()
+    exit_code = scheduler.run()
+    print("Built {} in {:.2f}s, into {}".format(", ".join(compile_modes), time.time() - start,
+        ", ".join(os.path.relpath(os.path.join(paths["build-root"], mode), paths["root"])
+            for mode in compile_modes)))
+    return exit_code
+
+def deploy_targets():
+    for target in app_info.TARGETS:
+        if target.is_library():
+            continue
+        if PLATFORM == Platform.WINDOWS:
+            win_deploy(target)
+        else:
+            exit_code = unix_deploy(target)
+            if exit_code != 0:
+                return exit_code
+    return 0
+
+def get_affected_targets(changed_paths):
+    nodes = set(dependency_graph.get_nodes_using(changed_paths))
+    # Headers behind a PCH are only in its pch:<key> node (they're left out of
+    # the depfiles of compiles using it), which leads to those through the .gch
+    pch_dirs = [
+        os.path.join(paths["build-pch"], node[len("pch:"):])
+        for node in nodes if node.startswith("pch:")
+    ]
+    if pch_dirs:
+        nodes |= set(dependency_graph.get_nodes_using_dirs(pch_dirs))
+    affected = set()
+    for target in app_info.TARGETS:
+        prefixes = (target.name, "obj:" + target.name + "/", "link:" + target.name)
+        recorded = dependency_graph.has_node(target.name) \
+            or dependency_graph.has_node("link:" + target.name)
+        if not recorded or any(node == target.name or node.startswith(prefixes) for node in nodes):
+            affected.add(target.name)
+
+    # Anything built on top of an affected target gets checked as well
+    while True:
+        dependents = set(
+            target.name for target in app_info.TARGETS
+            if target.name not in affected and not affected.isdisjoint(target.depends)
+        )
+        if not dependents:
+            break
+        affected |= dependents
+    return [target for target in app_info.TARGETS if target.name in affected]
+
+def watch(compile_mode, args, debounce=0.2):
+    global tracer
+    copy_roots = [
+        (copy_dir, os.path.join(os.path.join(paths["root"], copy_dir.src), ""))
+        for copy_dir in app_info.COPY_DIRS
+    ]
+    src_roots = [os.path.join(root, "") for root in get_manifest_roots()]
+    asset_root = None
+    if getattr(app_info, "ASSET_PROCESSORS", []) and os.path.isdir(paths["data"]):
+        asset_root = os.path.join(paths["data"], "")
+    watcher = create_watcher([root.rstrip(os.sep) for root in src_roots]
+        + [root.rstrip(os.sep) for _, root in copy_roots]
+        + ([asset_root.rstrip(os.sep)] if asset_root is not None else []))
+    print("Watching for changes ({}), Ctrl+C to stop".format(watcher.name))
+
+    try:
+        while True:
+            changed = watcher.wait(None)
+            change_time = time.time()
+            tracer = BuildTracer()
+            # Editors and VCS checkouts write in bursts, wait for them to settle
+            while True:
+                more_changes = watcher.wait(debounce)
+                if not more_changes:
+                    break
+                changed |= more_changes
+            changed = set(path for path in changed if not is_watch_ignored(path))
+            if not changed:
+                continue
+
+            synced = False
+            for copy_dir, root in copy_roots:
+                if any(path == root.rstrip(os.sep) or path.startswith(root) for path in changed):
+                    copy_dirs_to_build(args.copy_mode, [copy_dir])
+                    synced = True
+            asset_exit_code = 0
+            if asset_root is not None and any(path.startswith(asset_root) for path in changed):
+                asset_exit_code = process_assets()
+                synced = True
+
+            src_changes = [
+                path for path in changed
+                if any(path == root.rstrip(os.sep) or path.startswith(root) for root in src_roots)
+            ]
+            diff = get_source_manifest().apply_changes(src_changes)
+            exit_code = 0
+            if diff.is_empty() and not synced:
+                continue # touched, but no content changed
+            if not diff.is_empty():
+                print("Source changes: " + diff.summary())
+                targets = get_affected_targets(diff.changed_paths())
+                if targets:
+                    exit_code = build(compile_mode, args, True, targets)
+            if exit_code == 0:
+                exit_code = asset_exit_code
+
+            print("Rebuild {} in {:.2f}s ({} changed files)".format(
+                "succeeded" if exit_code == 0 else "FAILED", time.time() - change_time, len(changed)))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+        return 0
+
 def main():
+    compile_mode_dict = get_compile_modes()
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("mode", help="compilation mode")
+    parser.add_argument("mode", help="compilation mode ({}), or several separated by commas to "
+        "build them side by side (release,release-v3), or clean, run, test to run executables "
+        "in parallel, deploy, history to show past builds and regressions, or worker to serve "
+        "compile workers".format(", ".join(compile_mode_dict)))
     parser.add_argument("--ifchanged", action="store_true",
         help="run the specified compile command only if files have changed")
     parser.add_argument("--deploy", action="store_true",
         help="package and deploy a game build after compiling")
+    parser.add_argument("--deploy-format", default=getattr(app_info, "DEPLOY_FORMAT", "tar.gz"),
+        choices=DEPLOY_FORMATS,
+        help="archive format for deploys outside Windows (tar.gz and tar.xz compress in parallel)")
+    parser.add_argument("--deploy-level", type=int, choices=range(0, 10), metavar="0-9",
+        help="deploy compression level, lower is faster")
+    parser.add_argument("--build-mode", choices=list(compile_mode_dict),
+        help="build to use for run, test and deploy, defaults to the last one built "
+        "(history shows all modes unless given)")
+    parser.add_argument("--targets",
+        help="comma-separated executables for run, test and profile to start, all at once "
+        "up to -j")
+    parser.add_argument("--run-args", action="append",
+        help="arguments for run, test and profile to pass, given several times to run each "
+        "target once per set of arguments")
+    parser.add_argument("--timeout", type=float, default=getattr(app_info, "RUN_TIMEOUT", None),
+        help="seconds a run or test process may take before it's killed")
+    parser.add_argument("--history-limit", type=int, default=20,
+        help="number of recent builds history shows")
+    parser.add_argument("--regression-threshold", type=float,
+        default=getattr(app_info, "REGRESSION_THRESHOLD", 10.0),
+        help="percent over the rolling baseline that history flags as a regression, and "
+        "growth since the last build that size reports warn about")
+    parser.add_argument("--baseline-window", type=int, default=HISTORY_WINDOW,
+        help="number of earlier comparable builds history takes the baseline (median) from")
+    parser.add_argument("--compiler", default=getattr(app_info, "COMPILER", None),
+        help="compiler program (g++-12, clang++) or family (gcc, clang), "
+        "defaults to the newest g++ found (clang on macOS)")
+    parser.add_argument("--linker", default=getattr(app_info, "LINKER", "auto"),
+        choices=["auto"] + LINKERS,
+        help="linker to use, auto picks the fastest one with --fast-iteration")
+    parser.add_argument("--fast-iteration", action="store_true",
+        default=getattr(app_info, "FAST_ITERATION", False),
+        help="favor edit-compile-link turnaround: fastest linker, split DWARF, lighter debug info")
+    parser.add_argument("--probe-toolchains", action="store_true",
+        help="detect compilers and linkers again instead of using the cached results")
+    parser.add_argument("-j", "--jobs", type=int,
+        help="number of targets to compile at the same time, defaults to 1, or to the "
+        "number of cores when make's jobserver decides instead")
+    parser.add_argument("--max-load", type=float,
+        default=getattr(app_info, "MAX_LOAD", os.cpu_count() or 1),
+        help="don't start new jobs while the load average is at least this, 0 for no limit")
+    parser.add_argument("--memory-reserve", type=int,
+        help="memory in MB to leave free when starting jobs, defaults to 5%% of total memory")
+    parser.add_argument("--no-throttle", action="store_true",
+        help="start jobs up to -j regardless of load average and free memory")
+    parser.add_argument("--fail-fast", action="store_true",
+        help="stop all running compiles as soon as one of them fails")
+    parser.add_argument("--watch", action="store_true",
+        help="keep running and rebuild affected targets and copy dirs whenever files change")
+    parser.add_argument("--pgo-train", action="store_true",
+        help="for release-pgo, run PGO_TRAINING again even if a cached profile is fresh enough")
+    parser.add_argument("--profile-baseline",
+        help="for profile, earlier run id to compare with, instead of the last run with the "
+        "same arguments")
+    parser.add_argument("--no-size-report", action="store_true",
+        default=not getattr(app_info, "SIZE_REPORTS", True),
+        help="don't write binary size reports (sections, symbols, files, libraries) to build/logs")
+    parser.add_argument("--time-report", action="store_true",
+        help="add the compiler's own per-phase timings to the build trace")
+    parser.add_argument("--shards", type=int,
+        help="number of shards to split unity builds into, for targets that allow sharding")
+    parser.add_argument("--hash", default=getattr(app_info, "HASH_ALGORITHM", "md5"),
+        choices=sorted(HASH_ALGORITHMS.keys()),
+        help="digest used for change detection (blake2b is fastest on 64-bit machines)")
+    parser.add_argument("--copy-mode", default=getattr(app_info, "COPY_MODE", "sync"),
+        choices=COPY_MODES,
+        help="how COPY_DIRS reach the build directory: sync copies only changed files, "
+        "hardlink links them instead (don't edit them in the build directory), "
+        "remake deletes and copies everything")
+    parser.add_argument("--no-cache", action="store_true",
+        help="always run the compiler, don't use the compile cache")
+    parser.add_argument("--cache-size", type=int,
+        default=getattr(app_info, "COMPILE_CACHE_SIZE_MB", 5 * 1024),
+        help="compile cache size limit in MB, least recently used entries are evicted")
+    parser.add_argument("--workers", default=",".join(getattr(app_info, "COMPILE_WORKERS", [])),
+        help="comma-separated compile workers as host[:port][/max jobs], objects are compiled "
+        "there and linked here (raise -j to keep them busy)")
+    parser.add_argument("--port", type=int, default=WORKER_DEFAULT_PORT,
+        help="port for worker mode to listen on")
+    parser.add_argument("--bind", default="127.0.0.1",
+        help="address for worker mode to listen on")
+    parser.add_argument("--worker-compilers", default="",
+        help="comma-separated compilers worker mode runs besides the g++ and clang++ found "
+        "on PATH")
     args = parser.parse_args()
 
-    fill_paths_and_include_dirs()
+    global jobserver
+    jobserver = get_jobserver()
+    if args.jobs is None:
+        # With a jobserver, make's -j is the real limit
+        args.jobs = 1
+        if jobserver is not None:
+            args.jobs = jobserver.max_jobs or os.cpu_count() or 1
+        elif args.mode == "test":
+            args.jobs = os.cpu_count() or 1
+    if jobserver is not None:
+        print("Using make's jobserver ({}), up to {} jobs".format(
+            jobserver.description, args.jobs))
+
+    if args.mode == "worker":
+        return run_worker(args.bind, args.port, args.jobs,
+            [name.strip() for name in args.worker_compilers.split(",") if name.strip()])
+
+    compile_modes = args.mode.split(",")
+    if len(compile_modes) > 1:
+        for mode in compile_modes:
+            if mode not in compile_mode_dict:
+                raise Exception("Unrecognized compile mode: " + mode)
+        fill_paths_and_include_dirs()
+        return build_modes(compile_modes, args)
+
+    global hash_algorithm, deploy_format, deploy_level, build_mode, resource_history
+    if args.mode in compile_mode_dict:
+        build_mode = args.mode
+    elif args.mode in ["run", "test", "deploy"]:
+        build_mode = args.build_mode if args.build_mode is not None else get_last_build_mode()
+    fill_paths_and_include_dirs(build_mode)
+
+    hash_algorithm = args.hash
+    deploy_format = args.deploy_format
+    deploy_level = args.deploy_level
 
+    if args.mode in ["run", "test", "deploy"] and not os.path.exists(paths["build"]):
+        raise Exception("There is no {} build, compile it first".format(build_mode))
     if not os.path.exists(paths["build"]):
         os.makedirs(paths["build"])
     if not os.path.exists(paths["deploy"]):
         os.makedirs(paths["deploy"])
 
-    if args.ifchanged:
+    # Windows has no depfiles, so it falls back to checking the whole src tree.
+    # Other platforms decide per target from the recorded dependency graph.
+    if args.ifchanged and PLATFORM == Platform.WINDOWS:
         if not did_files_change():
             print("No changes, nothing to compile")
             return
 
-    compile_mode_dict = { cm.value: cm for cm in list(CompileMode) }
-
     if args.mode == "clean":
         clean()
-    elif args.mode == "run":
-        run(app_info.TARGETS[0])
+    elif args.mode == "history":
+        return show_history(args.build_mode, args.history_limit,
+            args.regression_threshold / 100, args.baseline_window)
+    elif args.mode in ["run", "test"]:
+        runs = get_target_runs(args.mode,
+            args.targets.split(",") if args.targets is not None else None, args.run_args)
+        if args.mode == "run" and len(runs) == 1 and args.timeout is None:
+            # Interactive, straight on the terminal
+            return run(runs[0].target, runs[0].run_args)
+        return run_targets(runs, args.jobs, args.timeout, args.fail_fast)
+    elif args.mode == "deploy":
+        return deploy_targets()
     elif args.mode in compile_mode_dict:
         compute_src_hashes()
-        for copy_dir in app_info.COPY_DIRS:
-            dir_src_path = os.path.join(paths["root"], copy_dir.src)
-            dir_dst_path = os.path.join(paths["build"], copy_dir.dst)
-            remake_dest_and_copy_dir(dir_src_path, dir_dst_path)
+        copy_dirs_to_build(args.copy_mode)
+        if PLATFORM != Platform.WINDOWS:
+            copy_external_libs_to_build(compile_mode_dict[args.mode])
         if not os.path.exists(paths["build-logs"]):
             os.makedirs(paths["build-logs"])
+        if not os.path.exists(paths["build-deps"]):
+            os.makedirs(paths["build-deps"])
+        if not os.path.exists(paths["build-pch"]):
+            os.makedirs(paths["build-pch"])
+        asset_exit_code = process_assets()
+
+        global compile_cache, dependency_graph, compiler_time_report, worker_pool, toolchain
+        compiler_time_report = args.time_report
+        if PLATFORM != Platform.WINDOWS:
+            toolchain = select_toolchain(args.compiler, args.linker, args.fast_iteration,
+                args.probe_toolchains)
+            print("Toolchain: " + toolchain.describe())
+            write_file_atomic(os.path.join(paths["build-logs"], "toolchain.json"),
+                json.dumps(toolchain.to_json(), indent=2).encode("utf-8"))
+        dependency_graph = DependencyGraph(paths["dep-graph"])
+        resource_history = ResourceHistory(paths["job-resources"])
+        if not args.no_cache and PLATFORM != Platform.WINDOWS:
+            compile_cache = CompileCache(paths["compile-cache"], args.cache_size * 1024 * 1024)
+        if args.workers:
+            if PLATFORM == Platform.WINDOWS:
+                raise Exception("Compile workers aren't supported on Windows")
+            worker_pool = WorkerPool([parse_worker_address(spec.strip())
+                for spec in args.workers.split(",") if spec.strip()])
+            worker_pool.probe()
 
         compile_mode = compile_mode_dict[args.mode]
-        for target in app_info.TARGETS:
+        build_func = build
+        if compile_mode.uses_pgo():
             if PLATFORM == Platform.WINDOWS:
-                win_compile(target, compile_mode)
-                if args.deploy:
-                    win_deploy(target)
-            elif PLATFORM == Platform.LINUX:
-                linux_compile(target, compile_mode)
-            elif PLATFORM == Platform.MAC:
-                mac_compile(target, compile_mode)
-            else:
-                raise Exception("Unsupported platform: " + PLATFORM)
+                raise Exception("{} builds need GCC or clang, they aren't supported "
+                    "on Windows".format(compile_mode.name))
+            build_func = build_pgo
+        elif compile_mode.uses_profile():
+            if PLATFORM != Platform.LINUX:
+                raise Exception("{} builds use gprof, they're only supported on Linux".format(
+                    compile_mode.name))
+            build_func = build_profile
+        if args.watch:
+            if PLATFORM == Platform.WINDOWS:
+                raise Exception("Watch mode needs depfiles, it isn't supported on Windows")
+            build_func(compile_mode, args, True)
+            return watch(compile_mode, args)
+
+        exit_code = build_func(compile_mode, args, args.ifchanged and PLATFORM != Platform.WINDOWS)
+        return exit_code if exit_code != 0 else asset_exit_code
     else:
         raise Exception("Unrecognized argument: " + args.mode)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())